@@ -0,0 +1,430 @@
+import base64
+import glob
+import gzip
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+import pytz
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+# Buffered writes: entries are flushed with one unordered insert_many once the
+# buffer reaches ACTIVITY_LOG_BATCH_SIZE or every ACTIVITY_LOG_FLUSH_INTERVAL seconds
+ACTIVITY_LOG_BATCH_SIZE = int(os.getenv('ACTIVITY_LOG_BATCH_SIZE', 100))
+ACTIVITY_LOG_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_LOG_FLUSH_INTERVAL', 2))
+# Entries that could not be written (Mongo unreachable on shutdown, or rejected by
+# the server) are spilled to a file here and replayed on the next start. On Cloud
+# Run the local disk is in-memory and goes away with the instance, so spills only
+# survive a restart when ACTIVITY_LOG_SPILL_DIR is a mounted volume.
+ACTIVITY_LOG_SPILL_DIR = os.getenv('ACTIVITY_LOG_SPILL_DIR', '.')
+ACTIVITY_LOG_SPILL_PATH = os.getenv(
+    'ACTIVITY_LOG_SPILL_PATH', os.path.join(ACTIVITY_LOG_SPILL_DIR, 'activity_logs.spill.ndjson')
+)
+
+# Retention: 'none' keeps everything, 'ttl' lets Mongo expire old entries,
+# 'archive' moves old entries to gzipped NDJSON files in ACTIVITY_LOG_ARCHIVE_DIR
+ACTIVITY_LOG_RETENTION = os.getenv('ACTIVITY_LOG_RETENTION', 'none')
+ACTIVITY_LOG_RETENTION_DAYS = int(os.getenv('ACTIVITY_LOG_RETENTION_DAYS', 90))
+ACTIVITY_LOG_ARCHIVE_DIR = os.getenv('ACTIVITY_LOG_ARCHIVE_DIR', 'archive/activity_logs')
+ACTIVITY_LOG_ARCHIVE_INTERVAL = int(os.getenv('ACTIVITY_LOG_ARCHIVE_INTERVAL', 3600))
+
+ARCHIVE_FILE_PATTERN = 'activity-logs-*.ndjson.gz'
+
+# Fields /api/activity-logs can return, mapped to the document fields they need
+ACTIVITY_LOG_FIELDS = {
+    'id': '_id',
+    'action': 'action',
+    'userId': 'userId',
+    'userName': 'userName',
+    'userEmail': 'userEmail',
+    'phone': 'phone',
+    'message': 'message',
+    'timestamp': 'timestamp',
+    'status': 'status',
+    'details': 'details'
+}
+
+def activity_log_projection(fields=None):
+    """Projection for the requested API fields (all of them by default).
+
+    Anything else stored on a log entry, like the raw invite API response,
+    never leaves Mongo.
+    """
+    fields = fields or list(ACTIVITY_LOG_FIELDS)
+    projection = {ACTIVITY_LOG_FIELDS[f]: 1 for f in fields if f in ACTIVITY_LOG_FIELDS}
+    # Needed for the paging cursor
+    projection['timestamp'] = 1
+    return projection
+
+def parse_activity_log_fields(value):
+    """Parse a comma separated `fields` parameter, ignoring unknown names"""
+    if not value:
+        return None
+    fields = [f.strip() for f in value.split(',') if f.strip() in ACTIVITY_LOG_FIELDS]
+    return fields or None
+
+def build_activity_log_query(user_id=None, phone=None, action=None, start=None, end=None):
+    """Build the activity_logs query shared by /api/activity-logs and its export"""
+    query = {}
+    if user_id:
+        query['userId'] = user_id
+    if phone:
+        query['phone'] = phone
+    if action:
+        query['action'] = action
+    if start or end:
+        query['timestamp'] = {}
+        if start:
+            query['timestamp']['$gte'] = start
+        if end:
+            query['timestamp']['$lte'] = end
+    return query
+
+def _as_utc_naive(timestamp):
+    # Mongo returns naive UTC datetimes, so cursors and archive comparisons use the same
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(pytz.utc).replace(tzinfo=None)
+    return timestamp
+
+def encode_log_cursor(log):
+    """Opaque cursor pointing just past `log` in (timestamp, _id) descending order"""
+    raw = f"{_as_utc_naive(log['timestamp']).isoformat()}|{log['_id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_log_cursor(cursor):
+    """Decode a cursor into (timestamp, id). Raises ValueError if it is malformed."""
+    try:
+        timestamp, log_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|', 1)
+        timestamp = datetime.fromisoformat(timestamp)
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not ObjectId.is_valid(log_id):
+        raise ValueError('Invalid cursor')
+    return timestamp, log_id
+
+def apply_log_cursor(query, cursor):
+    """Restrict `query` to entries strictly older than the cursor position"""
+    timestamp, log_id = decode_log_cursor(cursor)
+    query = dict(query)
+    query['$or'] = [
+        {'timestamp': {'$lt': timestamp}},
+        {'timestamp': timestamp, '_id': {'$lt': ObjectId(log_id)}}
+    ]
+    return query
+
+def ensure_activity_log_query_indexes(db):
+    """Compound indexes matching each filter followed by the (timestamp, _id) sort"""
+    for prefix in (None, 'userId', 'phone', 'action'):
+        keys = [(prefix, ASCENDING)] if prefix else []
+        keys += [('timestamp', DESCENDING), ('_id', DESCENDING)]
+        db.activity_logs.create_index(keys)
+
+def format_activity_log(log, fields=None):
+    """Convert an activity_logs document to its API representation"""
+    timestamp = log.get('timestamp')
+    result = {
+        'id': str(log['_id']),
+        'action': log.get('action'),
+        'userId': log.get('userId'),
+        'userName': log.get('userName'),
+        'userEmail': log.get('userEmail'),
+        'phone': log.get('phone'),
+        'message': log.get('message'),
+        'timestamp': timestamp.isoformat() if isinstance(timestamp, datetime) else timestamp,
+        'status': log.get('status', 'success'),
+        'details': log.get('details', {})
+    }
+    if fields:
+        result = {f: result[f] for f in fields}
+    return result
+
+def log_status_change(activity_logger, phone, status, updated_by='system'):
+    """Record a user status transition (feeds the analytics funnel)"""
+    activity_logger.log({
+        'action': 'status_changed',
+        'phone': phone,
+        'status': status,
+        'timestamp': datetime.now(pytz.timezone('Asia/Kolkata')),
+        'updatedBy': updated_by
+    })
+
+class ActivityLogWriter:
+    """Buffers activity log entries and writes them in batches.
+
+    `log()` only appends to an in-memory buffer; a background thread flushes it
+    with an unordered insert_many when it fills up or the flush interval passes.
+    `close()` flushes what is left and spills it to disk if Mongo is unreachable.
+    """
+
+    def __init__(self, db, batch_size=ACTIVITY_LOG_BATCH_SIZE, flush_interval=ACTIVITY_LOG_FLUSH_INTERVAL,
+                 spill_path=ACTIVITY_LOG_SPILL_PATH):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.replay_spill()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def log(self, entry):
+        with self._lock:
+            self._buffer.append(entry)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._buffer)
+
+    def flush(self):
+        """Write out everything buffered so far. Returns the number of entries written."""
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+        if not batch:
+            return 0
+
+        try:
+            batch = self._assign_ids(batch)
+            if not batch:
+                return 0
+            self.db.activity_logs.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            # Duplicate keys mean an earlier attempt wrote the entry already;
+            # anything else is kept on disk rather than dropped
+            failed = [batch[err['index']] for err in errors if err.get('code') != 11000]
+            if failed:
+                logger.error("Error flushing %d activity log entries, spilling them: %s", len(failed), errors[:3])
+                self._spill(failed)
+            return len(batch) - len(failed)
+        except Exception as e:
+            logger.warning("Error flushing activity logs, re-queueing %d entries: %s", len(batch), e)
+            with self._lock:
+                self._buffer = batch + self._buffer
+            return 0
+        return len(batch)
+
+    def _assign_ids(self, batch):
+        """Give entries their _id at write time.
+
+        Analytics reads activity_logs by _id up to a settle horizon, so an _id
+        minted long before the write would fall behind its watermark. Entries
+        that already have one were re-queued or spilled after a failed write:
+        those that reached Mongo anyway are dropped, the rest get a fresh _id.
+        """
+        retried = [entry['_id'] for entry in batch if '_id' in entry]
+        written = set()
+        if retried:
+            written = {doc['_id'] for doc in self.db.activity_logs.find({'_id': {'$in': retried}}, {'_id': 1})}
+        fresh = []
+        for entry in batch:
+            if entry.get('_id') in written:
+                continue
+            entry['_id'] = ObjectId()
+            fresh.append(entry)
+        return fresh
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        """Stop the flusher and persist anything still buffered"""
+        self._stopped.set()
+        self._wakeup.set()
+        self.flush()
+
+        with self._lock:
+            remaining, self._buffer = self._buffer, []
+        if remaining:
+            self._spill(remaining)
+
+    def _spill(self, entries):
+        spill_dir = os.path.dirname(self.spill_path)
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+        with open(self.spill_path, 'a') as f:
+            for entry in entries:
+                entry = dict(entry)
+                if '_id' in entry:
+                    entry['_id'] = str(entry['_id'])
+                if isinstance(entry.get('timestamp'), datetime):
+                    entry['timestamp'] = entry['timestamp'].isoformat()
+                f.write(json.dumps(entry, default=str) + '\n')
+        logger.warning("Spilled %d activity log entries to %s", len(entries), self.spill_path)
+
+    def replay_spill(self):
+        """Re-queue entries spilled by a previous shutdown"""
+        if not os.path.exists(self.spill_path):
+            return 0
+
+        from dateutil import parser
+        entries = []
+        with open(self.spill_path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if '_id' in entry:
+                    entry['_id'] = ObjectId(entry['_id'])
+                if isinstance(entry.get('timestamp'), str):
+                    entry['timestamp'] = parser.isoparse(entry['timestamp'])
+                entries.append(entry)
+
+        with self._lock:
+            self._buffer = entries + self._buffer
+        os.unlink(self.spill_path)
+        logger.info("Replaying %d spilled activity log entries", len(entries))
+        return len(entries)
+
+def ensure_activity_log_indexes(db):
+    """Create the retention index if TTL retention is configured"""
+    if ACTIVITY_LOG_RETENTION == 'ttl':
+        db.activity_logs.create_index(
+            [('timestamp', ASCENDING)],
+            name='timestamp_ttl',
+            expireAfterSeconds=ACTIVITY_LOG_RETENTION_DAYS * 86400
+        )
+
+def _archive_path(day):
+    return os.path.join(ACTIVITY_LOG_ARCHIVE_DIR, f'activity-logs-{day}.ndjson.gz')
+
+def _archive_day(timestamp):
+    """The IST day (YYYY-MM-DD) whose archive file holds entries from `timestamp`"""
+    if timestamp.tzinfo is None:
+        timestamp = pytz.utc.localize(timestamp)
+    return timestamp.astimezone(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d')
+
+def _path_day(path):
+    return os.path.basename(path)[len('activity-logs-'):-len('.ndjson.gz')]
+
+def archive_activity_logs(db, batch_size=1000):
+    """Move activity logs older than the retention window into gzipped NDJSON files.
+
+    Files are split per IST day and appended to as new gzip members. Entries are
+    deleted from Mongo only after their file has been written, so a crash can at
+    worst leave a duplicate in the archive, never lose an entry.
+    """
+    if ACTIVITY_LOG_RETENTION != 'archive':
+        return 0
+
+    os.makedirs(ACTIVITY_LOG_ARCHIVE_DIR, exist_ok=True)
+    cutoff = datetime.now(pytz.timezone('Asia/Kolkata')) - timedelta(days=ACTIVITY_LOG_RETENTION_DAYS)
+    archived = 0
+
+    while True:
+        logs = list(db.activity_logs.find({'timestamp': {'$lt': cutoff}})
+                    .sort('timestamp', ASCENDING)
+                    .limit(batch_size))
+        if not logs:
+            break
+
+        by_day = {}
+        for log in logs:
+            by_day.setdefault(_archive_day(log['timestamp']), []).append(log)
+
+        for day, day_logs in by_day.items():
+            with gzip.open(_archive_path(day), 'at') as f:
+                for log in day_logs:
+                    f.write(json.dumps(dict(format_activity_log(log), **{
+                        k: v for k, v in log.items() if k not in ('_id', 'timestamp')
+                    }), default=str) + '\n')
+
+        db.activity_logs.delete_many({'_id': {'$in': [log['_id'] for log in logs]}})
+        archived += len(logs)
+
+    if archived:
+        logger.info("Archived %d activity log entries to %s", archived, ACTIVITY_LOG_ARCHIVE_DIR)
+    return archived
+
+def format_archived_log(entry, fields=None):
+    """Convert an archived entry to the same shape as format_activity_log"""
+    timestamp = entry.get('timestamp')
+    result = {
+        'id': entry.get('id'),
+        'action': entry.get('action'),
+        'userId': entry.get('userId'),
+        'userName': entry.get('userName'),
+        'userEmail': entry.get('userEmail'),
+        'phone': entry.get('phone'),
+        'message': entry.get('message'),
+        'timestamp': timestamp.isoformat() if isinstance(timestamp, datetime) else timestamp,
+        'status': entry.get('status', 'success'),
+        'details': entry.get('details', {})
+    }
+    if fields:
+        result = {f: result[f] for f in fields}
+    result['archived'] = True
+    return result
+
+def _matches(entry, query):
+    return all(entry.get(field) == value for field, value in query.items())
+
+def read_archived_logs(query, limit, start=None, end=None, cursor=None):
+    """Read archived entries newest first, up to `limit`.
+
+    `query` holds equality filters only; the date range and paging cursor are
+    applied to the entry timestamps. Only the day files the range and cursor
+    can match are opened, and lines are parsed only until `limit` is reached.
+    """
+    results = []
+    if limit <= 0:
+        return results
+
+    start = _as_utc_naive(start) if start else None
+    end = _as_utc_naive(end) if end else None
+    before = decode_log_cursor(cursor) if cursor else None
+
+    first_day = _archive_day(start) if start else None
+    last_day = min(
+        (_archive_day(bound) for bound in (end, before and before[0]) if bound),
+        default=None
+    )
+
+    # Newest day first; within a day entries were appended oldest first
+    for path in sorted(glob.glob(os.path.join(ACTIVITY_LOG_ARCHIVE_DIR, ARCHIVE_FILE_PATTERN)), reverse=True):
+        day = _path_day(path)
+        if last_day and day > last_day:
+            continue
+        if first_day and day < first_day:
+            break
+        with gzip.open(path, 'rt') as f:
+            lines = f.readlines()
+        for line in reversed(lines):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if not _matches(entry, query):
+                continue
+            timestamp = _as_utc_naive(datetime.fromisoformat(entry['timestamp']))
+            if end and timestamp > end:
+                continue
+            if start and timestamp < start:
+                # Entries only get older from here on
+                return results
+            if before and (timestamp, entry['id']) >= before:
+                continue
+            entry['timestamp'] = timestamp
+            entry['_id'] = entry['id']
+            results.append(entry)
+            if len(results) >= limit:
+                return results
+    return results
+
+def archive_enabled():
+    return ACTIVITY_LOG_RETENTION == 'archive'
@@ -0,0 +1,247 @@
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+import pytz
+from bson import ObjectId
+from pymongo import ASCENDING, UpdateOne
+
+from tenants import conversation_key
+
+# Pre-aggregated message volume, agent response time and funnel counters.
+#
+# A background job reads new documents from messages, users and activity_logs
+# (tracked by an _id watermark per source in analytics_state) and folds them into
+# hourly and daily bucket documents keyed by the bucket start:
+#
+#   {'_id': <bucket start>, 'inbound': int, 'outbound': int, 'outboundAgent': int,
+#    'outboundAuto': int, 'responseCount': int, 'responseTimeTotalMs': int,
+#    'responseTimeMaxMs': int, 'funnel': {'priority': int, 'call_scheduled': int,
+#    'onboarded': int}}
+#
+# Response times need to know since when each conversation has been waiting
+# on an agent, kept in analytics_conversations under the same key as users:
+#
+#   {'_id': {'tenantId': ..., 'phone': ...}, 'awaitingSince': datetime | None}
+#
+# Serving /api/analytics is then a range scan on _id over at most a few hundred
+# small documents, independent of how much history there is.
+#
+# ObjectIds are generated by the writers (greenlets, instances, the buffered
+# activity log), so documents don't commit in _id order. A rollup only reads
+# _ids older than ANALYTICS_SETTLE_SECONDS; anything still in flight by then
+# lands above the watermark and is picked up by a later run.
+
+ANALYTICS_ROLLUP_INTERVAL = int(os.getenv('ANALYTICS_ROLLUP_INTERVAL', 60))
+ANALYTICS_BATCH_SIZE = int(os.getenv('ANALYTICS_BATCH_SIZE', 5000))
+ANALYTICS_SETTLE_SECONDS = int(os.getenv('ANALYTICS_SETTLE_SECONDS', 30))
+
+BUCKET_COLLECTIONS = {
+    'hour': 'analytics_hourly',
+    'day': 'analytics_daily'
+}
+
+FUNNEL_STAGES = ('priority', 'call_scheduled', 'onboarded')
+
+IST = pytz.timezone('Asia/Kolkata')
+
+def _to_ist(timestamp):
+    # Mongo hands datetimes back as naive UTC
+    if timestamp.tzinfo is None:
+        timestamp = pytz.utc.localize(timestamp)
+    return timestamp.astimezone(IST)
+
+def bucket_start(timestamp, granularity):
+    """Return the start of the IST hour/day bucket containing `timestamp`"""
+    local = _to_ist(timestamp)
+    if granularity == 'day':
+        return IST.localize(datetime(local.year, local.month, local.day))
+    return IST.localize(datetime(local.year, local.month, local.day, local.hour))
+
+class _Rollup:
+    """Accumulates $inc/$max updates for one batch before writing them out"""
+    def __init__(self):
+        self.inc = {g: defaultdict(lambda: defaultdict(int)) for g in BUCKET_COLLECTIONS}
+        self.max = {g: defaultdict(dict) for g in BUCKET_COLLECTIONS}
+
+    def add(self, timestamp, field, amount=1):
+        for granularity in BUCKET_COLLECTIONS:
+            self.inc[granularity][bucket_start(timestamp, granularity)][field] += amount
+
+    def add_max(self, timestamp, field, value):
+        for granularity in BUCKET_COLLECTIONS:
+            bucket = self.max[granularity][bucket_start(timestamp, granularity)]
+            bucket[field] = max(bucket.get(field, value), value)
+
+    def write(self, db):
+        for granularity, collection in BUCKET_COLLECTIONS.items():
+            buckets = set(self.inc[granularity]) | set(self.max[granularity])
+            operations = []
+            for bucket in buckets:
+                update = {}
+                if self.inc[granularity].get(bucket):
+                    update['$inc'] = dict(self.inc[granularity][bucket])
+                if self.max[granularity].get(bucket):
+                    update['$max'] = self.max[granularity][bucket]
+                operations.append(UpdateOne({'_id': bucket}, update, upsert=True))
+            if operations:
+                db[collection].bulk_write(operations, ordered=False)
+
+def _now():
+    return datetime.now(IST)
+
+def _read_batch(db, source, query=None, projection=None):
+    """Read the next batch of a source collection after its watermark, up to the settle horizon"""
+    state = db.analytics_state.find_one({'_id': source}) or {}
+    query = dict(query or {})
+    query['_id'] = {'$lt': ObjectId.from_datetime(_now() - timedelta(seconds=ANALYTICS_SETTLE_SECONDS))}
+    if state.get('lastId') is not None:
+        query['_id']['$gt'] = state['lastId']
+    return list(db[source].find(query, projection).sort('_id', ASCENDING).limit(ANALYTICS_BATCH_SIZE))
+
+def _advance_watermark(db, source, docs):
+    if docs:
+        db.analytics_state.update_one(
+            {'_id': source},
+            {'$set': {'lastId': docs[-1]['_id'], 'updatedAt': _now()}},
+            upsert=True
+        )
+
+def _rollup_messages(db, rollup):
+    messages = _read_batch(
+        db, 'messages',
+        projection={'tenantId': 1, 'phone': 1, 'direction': 1, 'timestamp': 1, 'sentBy': 1}
+    )
+    if not messages:
+        return messages
+
+    # Each conversation remembers since when it has been waiting on an agent
+    # reply; conversations are keyed like users, by conversation_key()
+    keys = {
+        (key['tenantId'], key['phone']): key
+        for key in (conversation_key(m['phone'], m.get('tenantId')) for m in messages if m.get('phone'))
+    }
+    waiting = {
+        (c['_id']['tenantId'], c['_id']['phone']): c.get('awaitingSince')
+        for c in db.analytics_conversations.find({'_id': {'$in': list(keys.values())}})
+    }
+    changed = set()
+
+    for msg in messages:
+        timestamp = msg.get('timestamp')
+        if not isinstance(timestamp, datetime) or not msg.get('phone'):
+            continue
+        key = conversation_key(msg['phone'], msg.get('tenantId'))
+        conversation = key['tenantId'], key['phone']
+
+        if msg.get('direction') == 'inbound':
+            rollup.add(timestamp, 'inbound')
+            if waiting.get(conversation) is None:
+                waiting[conversation] = timestamp
+                changed.add(conversation)
+            continue
+
+        rollup.add(timestamp, 'outbound')
+        # Auto-replies carry no sentBy and don't count as an agent response
+        if not msg.get('sentBy'):
+            rollup.add(timestamp, 'outboundAuto')
+            continue
+
+        rollup.add(timestamp, 'outboundAgent')
+        awaiting_since = waiting.get(conversation)
+        if awaiting_since is not None:
+            latency_ms = int((_to_ist(timestamp) - _to_ist(awaiting_since)).total_seconds() * 1000)
+            if latency_ms >= 0:
+                rollup.add(timestamp, 'responseCount')
+                rollup.add(timestamp, 'responseTimeTotalMs', latency_ms)
+                rollup.add_max(timestamp, 'responseTimeMaxMs', latency_ms)
+            waiting[conversation] = None
+            changed.add(conversation)
+
+    if changed:
+        db.analytics_conversations.bulk_write([
+            UpdateOne({'_id': keys[conversation]}, {'$set': {'awaitingSince': waiting[conversation]}}, upsert=True)
+            for conversation in changed
+        ], ordered=False)
+
+    return messages
+
+def _rollup_new_users(db, rollup):
+    users = _read_batch(db, 'users', projection={'createdAt': 1})
+    for user in users:
+        if isinstance(user.get('createdAt'), datetime):
+            rollup.add(user['createdAt'], 'funnel.priority')
+    return users
+
+def _rollup_status_changes(db, rollup):
+    logs = _read_batch(
+        db, 'activity_logs',
+        query={'action': 'status_changed'},
+        projection={'status': 1, 'timestamp': 1}
+    )
+    for log in logs:
+        status = log.get('status')
+        if status in FUNNEL_STAGES and status != 'priority' and isinstance(log.get('timestamp'), datetime):
+            rollup.add(log['timestamp'], f'funnel.{status}')
+    return logs
+
+def _backfill_conversation_keys(db):
+    """Re-key conversations from before multi-tenancy (_id: phone) to the default tenant once"""
+    if db.migrations.find_one({'_id': 'analytics_conversation_keys'}):
+        return
+    for conversation in db.analytics_conversations.find({'_id': {'$type': 'string'}}):
+        db.analytics_conversations.update_one(
+            {'_id': conversation_key(conversation['_id'])},
+            {'$setOnInsert': {'awaitingSince': conversation.get('awaitingSince')}},
+            upsert=True
+        )
+        db.analytics_conversations.delete_one({'_id': conversation['_id']})
+    db.migrations.insert_one({'_id': 'analytics_conversation_keys', 'appliedAt': _now()})
+
+def run_analytics_rollup(db):
+    """Fold everything written since the last run into the rollup collections.
+
+    Returns the number of source documents processed.
+    """
+    _backfill_conversation_keys(db)
+    processed = 0
+    for source, step in (
+        ('messages', _rollup_messages),
+        ('users', _rollup_new_users),
+        ('activity_logs', _rollup_status_changes)
+    ):
+        # Drain the source in batches; buckets are written before the watermark
+        # moves so a crash at worst re-reads one batch
+        while True:
+            rollup = _Rollup()
+            docs = step(db, rollup)
+            rollup.write(db)
+            _advance_watermark(db, source, docs)
+            processed += len(docs)
+            if len(docs) < ANALYTICS_BATCH_SIZE:
+                break
+    return processed
+
+def get_analytics(db, granularity='hour', start=None, end=None):
+    """Read rollup buckets between `start` and `end` (inclusive)"""
+    collection = BUCKET_COLLECTIONS.get(granularity, BUCKET_COLLECTIONS['hour'])
+    if end is None:
+        end = _now()
+    if start is None:
+        start = end - (timedelta(days=30) if granularity == 'day' else timedelta(hours=48))
+
+    buckets = []
+    for doc in db[collection].find({'_id': {'$gte': bucket_start(start, granularity), '$lte': end}}).sort('_id', ASCENDING):
+        response_count = doc.get('responseCount', 0)
+        funnel = doc.get('funnel', {})
+        buckets.append({
+            'bucket': _to_ist(doc['_id']).isoformat(),
+            'inbound': doc.get('inbound', 0),
+            'outbound': doc.get('outbound', 0),
+            'outboundAgent': doc.get('outboundAgent', 0),
+            'outboundAuto': doc.get('outboundAuto', 0),
+            'responseCount': response_count,
+            'avgResponseMs': round(doc.get('responseTimeTotalMs', 0) / response_count) if response_count else None,
+            'maxResponseMs': doc.get('responseTimeMaxMs'),
+            'funnel': {stage: funnel.get(stage, 0) for stage in FUNNEL_STAGES}
+        })
+    return buckets
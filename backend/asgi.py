@@ -0,0 +1,1286 @@
+"""Native asyncio (ASGI) serving mode.
+
+An alternative to the eventlet app in app.py that needs no monkey patching:
+python-socketio's AsyncServer for Socket.IO, Motor for Mongo and httpx for the
+Graph and customers APIs, so it can run under uvicorn with several worker
+processes.
+
+    pip install -r requirements-asgi.txt
+    uvicorn asgi:app --port 5000
+
+Every route of app.py is served with the same request/response shapes and
+socket events, and requests are traced as in the eventlet app. Nothing imported
+here pulls in eventlet: blocking work (SMTP, ICS files, the synchronous Mongo
+helpers shared with app.py, thumbnails) runs in worker threads, and the export
+endpoints stream synchronous cursors from Starlette's thread pool.
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+from urllib.parse import parse_qs, quote
+
+import httpx
+import pytz
+import socketio
+from bson import ObjectId
+from bson.errors import InvalidId
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.server_api import ServerApi
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from logging_config import setup_logging
+from tracing import TracingCommandListener, TracingMiddleware, trace_socketio, use_context_vars
+from metrics import (
+    CUSTOMERS_API_ERRORS,
+    CUSTOMERS_API_LATENCY,
+    MongoMetricsListener,
+    instrument_socketio,
+    metrics_response,
+    record_cache,
+    socket_connected,
+    socket_disconnected,
+    timed
+)
+from http_cache import PrecompressedBody, body_etag, encode_response, not_modified_headers
+from serializers import (
+    CHAT_LAST_MESSAGE_PROJECTION,
+    CHAT_USER_PROJECTION,
+    MESSAGE_ROW_PROJECTION,
+    SocketJSON,
+    chat_row,
+    customer_row,
+    dumps,
+    loads,
+    message_row,
+    read_collection
+)
+from activity_log import (
+    ACTIVITY_LOG_ARCHIVE_INTERVAL,
+    ActivityLogWriter,
+    activity_log_projection,
+    apply_log_cursor,
+    archive_activity_logs,
+    archive_enabled,
+    build_activity_log_query,
+    encode_log_cursor,
+    ensure_activity_log_indexes,
+    ensure_activity_log_query_indexes,
+    format_activity_log,
+    format_archived_log,
+    log_status_change,
+    parse_activity_log_fields,
+    read_archived_logs
+)
+from analytics import ANALYTICS_ROLLUP_INTERVAL, BUCKET_COLLECTIONS, get_analytics, run_analytics_rollup
+from call_invites import SMTP_TIMEOUT, build_call_ics, send_call_invite_email
+from exports import (
+    ACTIVITY_LOG_EXPORT_FIELDS,
+    EXPORT_FORMATS,
+    MESSAGE_EXPORT_FIELDS,
+    MESSAGE_EXPORT_PROJECTION,
+    REFERRAL_EXPORT_FIELDS,
+    activity_log_export_row,
+    export_headers,
+    message_export_row,
+    referral_export_row,
+    stream_export
+)
+from group_invites import (
+    INVITE_API_DEADLINE,
+    INVITE_API_HEADERS,
+    INVITE_API_PARAMS,
+    INVITE_API_RETRIES,
+    INVITE_API_RETRY_STATUSES,
+    INVITE_API_TIMEOUT,
+    INVITE_API_URL,
+    duplicate_group_name,
+    invite_payload
+)
+from media import blob_store
+from read_receipts import (
+    WHATSAPP_READ_RECEIPTS,
+    ReadReceiptSender,
+    agent_unread_count,
+    backfill_inbound_seq,
+    backfill_read_state_tenants,
+    backfill_unread_counts,
+    ensure_read_indexes,
+    ensure_read_state_indexes,
+    mark_conversation_read
+)
+from message_archive import (
+    ARCHIVE_COLLECTION,
+    MESSAGES_VALIDATOR_PROJECTION,
+    MESSAGE_ARCHIVE_INTERVAL,
+    archive_messages,
+    conversation_cursor,
+    ensure_message_archive,
+    message_archive_enabled,
+    messages_etag,
+    page_plan
+)
+from outbound import (
+    OUTBOUND_RECOVERY_INTERVAL,
+    chat_update,
+    ensure_outbound_indexes,
+    outbound_document,
+    recover_outbound,
+    sent_activity_log,
+    status_event
+)
+from tenants import ALL_TENANTS_ROOM, conversation_key, conversation_tenant_id, tenant_room, tenant_rooms, tenants
+from webhook_security import SIGNATURE_HEADER, webhook_guard
+from referral_stats import (
+    REFERRAL_SORT_FIELDS,
+    REFERRAL_USER_PROJECTION,
+    apply_user_change,
+    build_referral_query,
+    ensure_referral_indexes,
+    ensure_referral_stats,
+    get_referral_totals,
+    mark_referrals_changed,
+    rebuild_referral_stats,
+    referrals_etag,
+    referrals_page
+)
+from reply_flows import delete_rule, ensure_reply_rules, flow_engine, save_rule, start_reply_rules_reloader
+from whatsapp_async import (
+    create_graph_client,
+    dispatch_outbound_message,
+    process_incoming_message,
+    process_status_update,
+    queue_outbound_message,
+    send_whatsapp_message,
+    spawn
+)
+from whatsapp_messages import backfill_tenant_ids, ensure_message_indexes, parse_message_data
+
+load_dotenv()
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+CUSTOMERS_API_URL = os.getenv(
+    'CUSTOMERS_API_URL',
+    'https://faff-hermes-backend-251644788910.asia-south1.run.app/api/v1/customers/'
+)
+VERIFY_TOKEN = os.getenv('VERIFY_TOKEN', 'your_verify_token')
+
+# Retry-After for 503s when blocking work overruns, as executors.SATURATED_RETRY_AFTER
+BUSY_RETRY_AFTER = 5
+
+# Trace state follows each asyncio task instead of each thread
+use_context_vars()
+
+# Socket.IO across several worker processes needs a message queue, e.g.
+# redis://localhost:6379/0, and sticky sessions for the polling transport
+SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+
+sio = socketio.AsyncServer(
+    async_mode='asgi',
+    client_manager=socketio.AsyncRedisManager(SOCKETIO_MESSAGE_QUEUE) if SOCKETIO_MESSAGE_QUEUE else None,
+    cors_allowed_origins='*',
+    ping_interval=10,
+    ping_timeout=30,
+    allow_upgrades=True,
+    logger=logger.isEnabledFor(logging.DEBUG),
+    engineio_logger=logger.isEnabledFor(logging.DEBUG),
+    json=SocketJSON
+)
+instrument_socketio(sio)
+trace_socketio(sio)
+
+# Set up in lifespan()
+state = {
+    'db': None,
+    'graph': None,
+    'customers_http': None,
+    'invite_http': None,
+    'activity_logger': None,
+    'read_receipt_sender': None
+}
+
+# Same in-memory cache as the eventlet app
+cache = {
+    'chats': None,
+    'chats_timestamp': None,
+    'chats_body': None,
+    'chats_etag': None,
+    'cache_duration': 30,
+    'customers': None,
+    'customers_timestamp': None,
+    'customers_body': None,
+    'customers_cache_duration': 300
+}
+
+def invalidate_chats():
+    cache['chats'] = None
+    cache['chats_timestamp'] = None
+
+def json_body(payload, status=200):
+    return Response(dumps(payload), status_code=status, media_type='application/json')
+
+def conditional_response(request, body, etag=None, precompressed=None):
+    """http_cache.conditional_response for Starlette requests"""
+    status, data, headers = encode_response(
+        body,
+        request.headers.get('if-none-match'),
+        request.headers.get('accept-encoding'),
+        etag=etag,
+        precompressed=precompressed
+    )
+    return Response(data, status_code=status, headers=headers, media_type=None if status == 304 else 'application/json')
+
+def not_modified(request, etag):
+    """http_cache.not_modified for Starlette requests"""
+    headers = not_modified_headers(etag, request.headers.get('if-none-match'))
+    return Response(status_code=304, headers=headers) if headers else None
+
+def db_unavailable():
+    return json_body({'error': 'Database not connected'}, 503)
+
+# Customers
+
+async def fetch_customers_from_api():
+    """Fetch customers from the external API and cache them"""
+    try:
+        with CUSTOMERS_API_LATENCY.time():
+            response = await state['customers_http'].get(
+                CUSTOMERS_API_URL,
+                params={'skip': 0, 'limit': 1000},
+                headers={'accept': 'application/json'}
+            )
+        if response.status_code == 200:
+            customers = response.json()
+            cache['customers'] = customers
+            cache['customers_body'] = PrecompressedBody(dumps([customer_row(c) for c in customers]))
+            cache['customers_timestamp'] = time.time()
+            logger.info("Fetched %d customers", len(customers))
+            return customers
+        CUSTOMERS_API_ERRORS.inc()
+        logger.warning("Failed to fetch customers: %s", response.status_code)
+    except Exception as e:
+        CUSTOMERS_API_ERRORS.inc()
+        logger.warning("Error fetching customers: %s", e)
+    return cache.get('customers') or []
+
+async def get_cached_customers():
+    if cache['customers'] and cache['customers_timestamp']:
+        if time.time() - cache['customers_timestamp'] < cache['customers_cache_duration']:
+            record_cache('customers', True)
+            return cache['customers']
+    record_cache('customers', False)
+    return await fetch_customers_from_api()
+
+async def every(interval, func, name):
+    """Run `func` (a coroutine function) every `interval` seconds"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await func()
+        except Exception as e:
+            logger.exception("Error in %s: %s", name, e)
+
+# Routes
+
+async def health(request):
+    return json_body({
+        'success': True,
+        'message': 'API is healthy',
+        'database': 'connected' if state['db'] is not None else 'disconnected'
+    })
+
+async def metrics(request):
+    body, content_type = metrics_response()
+    return Response(body, media_type=content_type)
+
+@timed('webhook')
+async def webhook(request):
+    if request.method == 'GET':
+        if request.query_params.get('hub.verify_token') == VERIFY_TOKEN:
+            return PlainTextResponse(request.query_params.get('hub.challenge', ''))
+        return PlainTextResponse('Invalid verification token', status_code=403)
+
+    # Signature check on the raw body before it is parsed, replay checks after
+    body = await request.body()
+    status = webhook_guard.check(body, request.headers.get(SIGNATURE_HEADER))
+    if status == 503:
+        return PlainTextResponse('Webhook signing not configured', status_code=503)
+    if status is not None:
+        return PlainTextResponse('Invalid signature', status_code=status)
+    try:
+        data = loads(body)
+    except ValueError:
+        return PlainTextResponse('Invalid JSON', status_code=400)
+    status, delivery_key = webhook_guard.screen(data)
+    if status == 400:
+        return PlainTextResponse('Invalid payload', status_code=400)
+    if status is not None:
+        return PlainTextResponse('Success')
+    logger.info("Webhook received", extra={'event': 'webhook.received'})
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Webhook payload: %s", json.dumps(data))
+
+    db = state['db']
+    if not await process_status_update(db, sio, data):
+        parsed_data = parse_message_data(data)
+        if parsed_data and await process_incoming_message(db, state['graph'], sio, parsed_data):
+            invalidate_chats()
+
+    webhook_guard.remember(delivery_key)
+    return PlainTextResponse('Success')
+
+async def requested_conversation(db, phone, requested=None):
+    """users filter for the conversation a request is about (app.requested_conversation)"""
+    tenant_id = await asyncio.to_thread(conversation_tenant_id, db.delegate, phone, requested)
+    return conversation_key(phone, tenant_id)
+
+async def _load_chats(db):
+    users = await read_collection(db.users).find({}, CHAT_USER_PROJECTION).sort('lastMessageAt', -1).to_list(None)
+    # Latest message per conversation, fetched concurrently
+    last_messages = await asyncio.gather(*(
+        read_collection(db.messages).find_one(
+            conversation_key(user['phone'], user.get('tenantId')),
+            CHAT_LAST_MESSAGE_PROJECTION,
+            sort=[('timestamp', -1)]
+        )
+        for user in users
+    ))
+    return [chat_row(user, last_message) for user, last_message in zip(users, last_messages)]
+
+@timed('get_chats')
+async def get_chats(request):
+    db = state['db']
+    if db is None:
+        return json_body({'error': 'Database not connected. Please configure MONGODB_URI.'}, 503)
+
+    current_time = time.time()
+    chats = None
+    if cache['chats'] and cache['chats_timestamp']:
+        if current_time - cache['chats_timestamp'] < cache['cache_duration']:
+            chats = cache['chats']
+    record_cache('chats', chats is not None)
+
+    if chats is None:
+        chats = await _load_chats(db)
+        cache['chats'] = chats
+        cache['chats_body'] = dumps(chats)
+        cache['chats_etag'] = body_etag(cache['chats_body'])
+        cache['chats_timestamp'] = current_time
+
+    agent_id = request.query_params.get('agentId')
+    tenant_id = request.query_params.get('tenant')
+    if not agent_id and not tenant_id:
+        return conditional_response(request, cache['chats_body'], etag=cache['chats_etag'])
+
+    if tenant_id:
+        chats = [chat for chat in chats if chat['tenantId'] == tenant_id]
+    if not agent_id:
+        return conditional_response(request, dumps(chats))
+
+    read_seqs = {
+        (row.get('tenantId'), row['phone']): row.get('readSeq', 0)
+        async for row in db.read_states.find({'agentId': agent_id}, {'tenantId': 1, 'phone': 1, 'readSeq': 1, '_id': 0})
+    }
+    return conditional_response(request, dumps([
+        dict(chat, unreadCount=agent_unread_count(chat, read_seqs))
+        for chat in chats
+    ]))
+
+@timed('get_messages')
+async def get_messages(request):
+    db = state['db']
+    phone = request.path_params['phone']
+    page = int(request.query_params.get('page', 1))
+    limit = int(request.query_params.get('limit', 100))
+    skip = (page - 1) * limit
+
+    conversation = await requested_conversation(db, phone, request.query_params.get('tenant'))
+    user = await db.users.find_one(conversation, MESSAGES_VALIDATOR_PROJECTION)
+    etag = messages_etag(user, skip, limit)
+    unchanged = not_modified(request, etag)
+    if unchanged:
+        return unchanged
+
+    # Same read-through to the archive as message_archive.message_page
+    hot_count = await db.messages.count_documents(conversation)
+    total_count = hot_count + (user or {}).get('archivedMessages', 0)
+    (hot_skip, hot_limit), (archive_skip, archive_limit) = page_plan(hot_count, skip, limit)
+    messages = []
+    if hot_limit:
+        messages += await (read_collection(db.messages).find(conversation, MESSAGE_ROW_PROJECTION)
+                           .sort('timestamp', -1).skip(hot_skip).limit(hot_limit).to_list(None))
+    if archive_limit and total_count > hot_count:
+        messages += await (read_collection(db[ARCHIVE_COLLECTION]).find(conversation, MESSAGE_ROW_PROJECTION)
+                           .sort('timestamp', -1).skip(archive_skip).limit(archive_limit).to_list(None))
+    messages.reverse()
+
+    return conditional_response(request, dumps({
+        'messages': [message_row(msg) for msg in messages],
+        'pagination': {
+            'page': page,
+            'limit': limit,
+            'total': total_count,
+            'totalPages': (total_count + limit - 1) // limit
+        }
+    }), etag=etag)
+
+async def get_media(request):
+    db = state['db']
+    if db is None:
+        return db_unavailable()
+
+    try:
+        query = {'_id': ObjectId(request.path_params['message_id'])}
+        message = await db.messages.find_one(query, {'media': 1})
+        if message is None:
+            message = await db[ARCHIVE_COLLECTION].find_one(query, {'media': 1})
+    except InvalidId:
+        return json_body({'error': 'Invalid message id'}, 400)
+
+    media = (message or {}).get('media')
+    if not media:
+        return json_body({'error': 'Media not found'}, 404)
+    if media.get('status') == 'pending':
+        return json_body({'status': 'pending'}, 202)
+
+    thumbnail = request.query_params.get('thumbnail') == '1'
+    key = media.get('thumbnailKey') if thumbnail else media.get('blobKey')
+    if media.get('status') != 'stored' or not key:
+        return json_body({'error': 'Media not available', 'status': media.get('status')}, 404)
+
+    headers = {'Cache-Control': 'private, max-age=86400'}
+    if media.get('filename') and not thumbnail:
+        headers['Content-Disposition'] = f"inline; filename*=UTF-8''{quote(media['filename'])}"
+    # Starlette iterates synchronous blob reads in its thread pool
+    return StreamingResponse(
+        blob_store.iter_chunks(key),
+        media_type='image/jpeg' if thumbnail else (media.get('mimeType') or 'application/octet-stream'),
+        headers=headers
+    )
+
+async def mark_messages_read(request):
+    db = state['db']
+    if db is None:
+        return db_unavailable()
+
+    phone = request.path_params['phone']
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+
+    data = data or {}
+    try:
+        tenant_id = await asyncio.to_thread(conversation_tenant_id, db.delegate, phone, data.get('tenantId'))
+        marked, response, event = await asyncio.to_thread(
+            mark_conversation_read, db.delegate, phone, data, state['read_receipt_sender'], tenant_id
+        )
+    except ValueError as e:
+        return json_body({'error': str(e)}, 400)
+
+    if marked:
+        invalidate_chats()
+    await sio.emit('messages_read', event, to=tenant_rooms(event['tenantId']))
+    return json_body(response)
+
+async def dispatch_outbound(message_id):
+    db = state['db']
+    try:
+        message = await dispatch_outbound_message(db, state['graph'], message_id)
+        if message is None:
+            return
+        if message['status'] == 'sent':
+            logger.info(
+                "Sent message to %s", message['phone'],
+                extra={'event': 'message.outbound', 'whatsappMessageId': message['whatsappMessageId'],
+                       'sentBy': message.get('sentBy')}
+            )
+            state['activity_logger'].log(sent_activity_log(message))
+            await db.chats.update_one({'phone': message['phone']}, chat_update(message))
+        else:
+            logger.warning("Sending message %s to %s failed: %s", message['_id'], message['phone'], message.get('sendError'))
+        await sio.emit('message_status_update', status_event(message), to=tenant_rooms(message.get('tenantId')))
+    except Exception as e:
+        logger.exception("Error dispatching message %s: %s", message_id, e)
+
+async def recover_outbound_messages():
+    pending, failed = await asyncio.to_thread(recover_outbound, state['db'].delegate)
+    for message_id in pending:
+        spawn(dispatch_outbound(message_id))
+    for message in failed:
+        logger.warning("Send of message %s was interrupted", message['_id'])
+        await sio.emit('message_status_update', status_event(message), to=tenant_rooms(message.get('tenantId')))
+
+async def send_message(request):
+    db = state['db']
+    if db is None:
+        return json_body({'success': False, 'error': 'Database not connected'}, 503)
+    data = await request.json()
+    conversation = await requested_conversation(db, data['phone'], data.get('tenantId'))
+    message, queued = await queue_outbound_message(db, outbound_document(
+        data['phone'],
+        data['message'],
+        data.get('tempId'),
+        data.get('userId', 'unknown'),
+        data.get('userName', 'Unknown User'),
+        data.get('userEmail', ''),
+        conversation['tenantId']
+    ))
+
+    if queued:
+        invalidate_chats()
+        spawn(dispatch_outbound(message['_id']))
+        await sio.emit('new_message', {
+            'phone': message['phone'],
+            'message': message['message'],
+            'direction': 'outbound',
+            'timestamp': message['timestamp'].isoformat(),
+            'status': message['status'],
+            'messageId': str(message['_id']),
+            'tempId': message['tempId'],
+            'tenantId': message['tenantId']
+        }, to=tenant_rooms(message['tenantId']))
+
+    return json_body({
+        'success': True,
+        'messageId': str(message['_id']),
+        'tempId': message['tempId'],
+        'status': message['status'],
+        'whatsappMessageId': message.get('whatsappMessageId')
+    }, 202 if queued else 200)
+
+async def update_status(request):
+    data = await request.json()
+    phone = data['phone']
+    status = data['status']
+
+    conversation = await requested_conversation(state['db'], phone, data.get('tenantId'))
+    await state['db'].users.update_one(conversation, {'$set': {'status': status}})
+    await asyncio.to_thread(mark_referrals_changed, state['db'].delegate)
+    log_status_change(state['activity_logger'], phone, status, data.get('updatedBy', 'system'))
+    invalidate_chats()
+    await sio.emit('status_updated', {'phone': phone, 'status': status, 'tenantId': conversation['tenantId']},
+                   to=tenant_rooms(conversation['tenantId']))
+    return json_body({'success': True})
+
+async def get_customers(request):
+    customers = await get_cached_customers()
+    body = cache['customers_body']
+    if body is None:
+        body = PrecompressedBody(dumps([customer_row(c) for c in customers or []]))
+    return conditional_response(request, body.body, precompressed=body)
+
+async def get_referrals(request):
+    db = state['db']
+    if db is None:
+        return db_unavailable()
+    try:
+        etag = await asyncio.to_thread(referrals_etag, db.delegate, request.query_params)
+        unchanged = not_modified(request, etag)
+        if unchanged:
+            return unchanged
+        payload = await asyncio.to_thread(referrals_page, db.delegate, request.query_params)
+    except Exception as e:
+        logger.exception("Error fetching referrals: %s", e)
+        return json_body({'error': str(e)}, 500)
+    return conditional_response(request, dumps(payload), etag=etag)
+
+async def rebuild_referrals_stats(request):
+    db = state['db']
+    if db is None:
+        return db_unavailable()
+    try:
+        if not await asyncio.to_thread(rebuild_referral_stats, db.delegate):
+            return json_body({'error': 'A rebuild is already running'}, 409)
+        totals = await asyncio.to_thread(get_referral_totals, db.delegate)
+    except Exception as e:
+        logger.exception("Error rebuilding referral stats: %s", e)
+        return json_body({'error': str(e)}, 500)
+    return json_body({'success': True, 'statistics': totals})
+
+async def update_payment_status(request):
+    data = await request.json()
+    phone = data.get('phone')
+    is_paid = data.get('isPaid', False)
+    if not phone:
+        return json_body({'error': 'Phone number is required'}, 400)
+
+    db = state['db']
+    conversation = await requested_conversation(db, phone, data.get('tenantId'))
+    update_data = {
+        'isPaid': is_paid,
+        'paymentUpdatedAt': datetime.now(pytz.timezone('Asia/Kolkata'))
+    }
+    if is_paid:
+        update_data['status'] = 'onboarded'
+    result = await db.users.update_one(conversation, {'$set': update_data})
+    if result.matched_count == 0:
+        return json_body({'error': 'User not found'}, 404)
+
+    if is_paid:
+        await asyncio.to_thread(mark_referrals_changed, db.delegate)
+        log_status_change(state['activity_logger'], phone, 'onboarded', 'payment')
+    invalidate_chats()
+
+    rooms = tenant_rooms(conversation['tenantId'])
+    await sio.emit('payment_status_updated', {
+        'phone': phone,
+        'isPaid': is_paid,
+        'status': 'onboarded' if is_paid else None,
+        'tenantId': conversation['tenantId']
+    }, to=rooms)
+    if is_paid:
+        await sio.emit('status_updated', {'phone': phone, 'status': 'onboarded', 'tenantId': conversation['tenantId']},
+                       to=rooms)
+    return json_body({
+        'success': True,
+        'message': f'Payment status updated for {phone}',
+        'phone': phone,
+        'isPaid': is_paid,
+        'status': 'onboarded' if is_paid else None
+    })
+
+async def update_subscription(request):
+    data = await request.json()
+    phone = data['phone']
+    subscription_status = data['subscriptionStatus']
+
+    db = state['db']
+    update_data = {
+        'subscriptionStatus': subscription_status,
+        'subscriptionUpdatedAt': datetime.now(pytz.timezone('Asia/Kolkata'))
+    }
+    if subscription_status == 'active' and data.get('isNewSubscription'):
+        update_data['subscriptionStartDate'] = datetime.now(pytz.timezone('Asia/Kolkata'))
+    previous = await db.users.find_one_and_update(
+        await requested_conversation(db, phone, data.get('tenantId')),
+        {'$set': update_data},
+        projection={'referredBy': 1, 'subscriptionStatus': 1}
+    )
+
+    # Keep the referral stats view in sync
+    if previous is not None:
+        await asyncio.to_thread(
+            apply_user_change, db.delegate, previous, dict(previous, subscriptionStatus=subscription_status),
+            previous['_id']
+        )
+        await asyncio.to_thread(mark_referrals_changed, db.delegate)
+
+    state['activity_logger'].log({
+        'action': 'subscription_updated',
+        'phone': phone,
+        'subscriptionStatus': subscription_status,
+        'timestamp': datetime.now(pytz.timezone('Asia/Kolkata')),
+        'updatedBy': data.get('updatedBy', 'system')
+    })
+    return json_body({'success': True})
+
+def _sorted_notes(user):
+    notes = (user or {}).get('notes', [])
+    notes.sort(key=lambda x: x.get('createdAt', datetime.min), reverse=True)
+    for note in notes:
+        if isinstance(note.get('createdAt'), datetime):
+            note['createdAt'] = note['createdAt'].isoformat()
+    return notes
+
+async def user_notes(request):
+    db = state['db']
+    phone = request.path_params['phone']
+    if request.method == 'GET':
+        try:
+            user = await db.users.find_one(
+                await requested_conversation(db, phone, request.query_params.get('tenant')), {'notes': 1}
+            )
+            return json_body({'success': True, 'notes': _sorted_notes(user)})
+        except Exception as e:
+            return json_body({'success': False, 'error': str(e)}, 500)
+
+    try:
+        data = await request.json()
+        note_text = data.get('note', '').strip()
+        if not note_text:
+            return json_body({'success': False, 'error': 'Note cannot be empty'}, 400)
+
+        new_note = {
+            '_id': str(ObjectId()),
+            'text': note_text,
+            'createdAt': datetime.now(pytz.timezone('Asia/Kolkata')),
+            'addedBy': data.get('addedBy', 'Admin')
+        }
+        conversation = await requested_conversation(db, phone, data.get('tenantId'))
+        result = await db.users.update_one(
+            conversation,
+            {
+                '$push': {'notes': new_note},
+                '$setOnInsert': {
+                    'phone': phone,
+                    'createdAt': datetime.now(pytz.timezone('Asia/Kolkata'))
+                }
+            },
+            upsert=True
+        )
+        # A note on an unknown phone creates a user, which counts towards referral totals
+        if result.upserted_id is not None:
+            await asyncio.to_thread(apply_user_change, db.delegate, None, {'phone': phone}, result.upserted_id)
+
+        notes = _sorted_notes(await db.users.find_one(conversation, {'notes': 1}))
+        await sio.emit('notes_updated', {'phone': phone, 'notes': notes, 'tenantId': conversation['tenantId']},
+                       to=tenant_rooms(conversation['tenantId']))
+        return json_body({'success': True, 'notes': notes})
+    except Exception as e:
+        logger.exception("Error adding note: %s", e)
+        return json_body({'success': False, 'error': str(e)}, 500)
+
+async def run_blocking(func, *args, timeout):
+    """Run blocking work in a worker thread, giving up on it after `timeout` seconds.
+
+    The ASGI counterpart of the eventlet app's bounded executors: raises
+    asyncio.TimeoutError, answered like ExecutorTimeout by busy().
+    """
+    return await asyncio.wait_for(asyncio.to_thread(func, *args), timeout)
+
+def busy():
+    """app.executor_timeout: the work overran its deadline, so back off"""
+    response = json_body({'success': False, 'error': 'Server busy - the request timed out, please try again shortly'}, 503)
+    response.headers['Retry-After'] = str(BUSY_RETRY_AFTER)
+    return response
+
+async def schedule_call(request):
+    data = await request.json()
+    phone = data['phone']
+    name = data['name']
+    scheduled_date = data['date']
+    email = data['email']
+    notes = data.get('notes', '')
+    db = state['db']
+
+    logger.info("Scheduling call for %s on %s", phone, scheduled_date)
+    try:
+        from dateutil import parser
+        call_date = parser.parse(scheduled_date)
+        formatted_date = call_date.strftime('%B %d, %Y at %I:%M %p')
+
+        # A busy or slow mail server only costs the email
+        ics = await run_blocking(build_call_ics, name, phone, call_date, notes, email, timeout=10)
+        try:
+            email_sent, email_error = await run_blocking(
+                send_call_invite_email, email, name, phone, formatted_date, notes, ics,
+                timeout=SMTP_TIMEOUT * 3
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Timed out emailing calendar invite for %s", phone)
+            email_sent, email_error = False, 'Timed out sending email'
+
+        whatsapp_message = f"""Hi {name}! 
+
+Your onboarding call has been scheduled for:
+📅 {formatted_date}
+
+We'll call you on this WhatsApp number. Please make sure you're available at the scheduled time.
+
+If you need to reschedule, please let us know.
+
+Looking forward to speaking with you!"""
+        conversation = await requested_conversation(db, phone, data.get('tenantId'))
+        whatsapp_response = await send_whatsapp_message(
+            state['graph'], phone, whatsapp_message, tenant_id=conversation['tenantId']
+        )
+        whatsapp_sent = 'messages' in whatsapp_response
+        if not whatsapp_sent:
+            logger.warning("Call confirmation to %s failed: %s", phone, whatsapp_response)
+
+        await db.users.update_one(conversation, {'$set': {
+            'status': 'call_scheduled',
+            'scheduledCallDate': call_date,
+            'scheduledCallNotes': notes
+        }})
+        await asyncio.to_thread(mark_referrals_changed, db.delegate)
+        await db.scheduled_calls.insert_one({
+            'phone': phone,
+            'name': name,
+            'scheduledDate': call_date,
+            'email': email,
+            'notes': notes,
+            'createdAt': datetime.now(pytz.timezone('Asia/Kolkata')),
+            'status': 'scheduled'
+        })
+        log_status_change(state['activity_logger'], phone, 'call_scheduled', data.get('updatedBy', 'system'))
+        await sio.emit('user_status_update', {
+            'phone': phone,
+            'status': 'call_scheduled',
+            'tenantId': conversation['tenantId']
+        }, to=tenant_rooms(conversation['tenantId']))
+
+        return json_body({
+            'success': True,
+            'message': 'Call scheduled successfully',
+            'whatsappSent': whatsapp_sent,
+            'emailSent': email_sent,
+            'emailError': email_error,
+            'scheduledDate': formatted_date
+        })
+    except asyncio.TimeoutError:
+        return busy()
+    except Exception as e:
+        logger.exception("Error scheduling call: %s", e)
+        return json_body({'success': False, 'error': str(e)}, 500)
+
+async def download_ics(request):
+    phone = request.path_params['phone']
+    try:
+        call = await state['db'].scheduled_calls.find_one(
+            {'phone': phone},
+            {'name': 1, 'scheduledDate': 1, 'notes': 1},
+            sort=[('createdAt', -1)]
+        )
+        if not call:
+            return json_body({'error': 'No scheduled call found'}, 404)
+        ics = await run_blocking(
+            build_call_ics, call['name'], phone, call['scheduledDate'], call.get('notes', ''), timeout=10
+        )
+        return Response(ics, media_type='text/calendar', headers={
+            'Content-Disposition': f'attachment; filename=call_with_{call["name"]}.ics'
+        })
+    except asyncio.TimeoutError:
+        return busy()
+    except Exception as e:
+        return json_body({'error': str(e)}, 500)
+
+async def _post_invite(payload):
+    """app.post_invite on httpx: status retries with backoff, within INVITE_API_DEADLINE"""
+    for attempt in range(INVITE_API_RETRIES + 1):
+        response = await state['invite_http'].post(
+            INVITE_API_URL, params=INVITE_API_PARAMS, json=payload, headers=INVITE_API_HEADERS
+        )
+        if response.status_code not in INVITE_API_RETRY_STATUSES or attempt == INVITE_API_RETRIES:
+            return response
+        await asyncio.sleep(2 ** attempt)
+
+async def send_invite(request):
+    data = await request.json()
+    phone = data.get('phone')
+    name = data.get('name')
+    if not phone or not name:
+        return json_body({'error': 'Phone and name are required'}, 400)
+    if duplicate_group_name(name, await get_cached_customers()):
+        return json_body({'error': f'Group name "{name}" already exists. Please choose a unique name.'}, 400)
+
+    payload = invite_payload(name, phone, data.get('referrerName', ''))
+    try:
+        logger.debug("Sending invite request to %s: %s", INVITE_API_URL, payload)
+        response = await asyncio.wait_for(_post_invite(payload), INVITE_API_DEADLINE)
+        logger.info("Invite API responded %s for %s", response.status_code, phone)
+    except (asyncio.TimeoutError, httpx.TimeoutException) as e:
+        logger.warning("Invite API timeout: %s", e)
+        return json_body({'error': 'Request timeout - please try again'}, 504)
+    except httpx.ConnectError as e:
+        logger.warning("Invite API connection error: %s", e)
+        return json_body({'error': 'Connection error - please check your network'}, 503)
+    except httpx.HTTPError as e:
+        logger.warning("Invite API request error: %s", e)
+        return json_body({'error': f'Request failed: {str(e)}'}, 500)
+    except Exception as e:
+        logger.exception("Unexpected error sending invite: %s", e)
+        return json_body({'error': f'Internal error: {str(e)}'}, 500)
+
+    if response.status_code != 200:
+        return json_body({
+            'success': False,
+            'error': f'Failed to send invite: {response.status_code}',
+            'details': response.text
+        }, response.status_code)
+
+    body = response.json() if response.text else {}
+    state['activity_logger'].log({
+        'action': 'invite_sent',
+        'phone': phone,
+        'name': name,
+        'timestamp': datetime.now(pytz.timezone('Asia/Kolkata')),
+        'response': body
+    })
+    conversation = await requested_conversation(state['db'], phone, data.get('tenantId'))
+    await sio.emit('invite_sent', {'phone': phone, 'status': 'success', 'tenantId': conversation['tenantId']},
+                   to=tenant_rooms(conversation['tenantId']))
+    return json_body({'success': True, 'message': f'Invite sent to {name}', 'response': body})
+
+# Reply rules, analytics and activity logs
+
+async def reply_rules(request):
+    db = state['db']
+    if db is None:
+        return db_unavailable()
+
+    if request.method == 'GET':
+        rules = await db.reply_rules.find().sort('_id', 1).to_list(None)
+        for rule in rules:
+            if rule.get('updatedAt'):
+                rule['updatedAt'] = rule['updatedAt'].isoformat()
+        return json_body(rules)
+
+    try:
+        rule = await asyncio.to_thread(save_rule, db.delegate, await request.json() or {})
+    except ValueError as e:
+        return json_body({'error': str(e)}, 400)
+    # Apply immediately on this instance; others pick it up on their next poll
+    await asyncio.to_thread(flow_engine.load, db.delegate)
+    return json_body({'success': True, 'id': rule['_id']})
+
+async def delete_reply_rule(request):
+    db = state['db']
+    if db is None:
+        return db_unavailable()
+
+    if not await asyncio.to_thread(delete_rule, db.delegate, request.path_params['rule_id']):
+        return json_body({'error': 'Rule not found'}, 404)
+    await asyncio.to_thread(flow_engine.load, db.delegate)
+    return json_body({'success': True})
+
+def _parse_date_arg(request, name):
+    """app._parse_date_arg for Starlette requests"""
+    value = request.query_params.get(name)
+    if not value:
+        return None
+
+    from dateutil import parser
+    try:
+        parsed = parser.parse(value)
+    except (ValueError, OverflowError):
+        raise ValueError(f'Invalid date for {name}: {value}')
+    if parsed.tzinfo is None:
+        parsed = pytz.timezone('Asia/Kolkata').localize(parsed)
+    return parsed
+
+async def analytics(request):
+    db = state['db']
+    if db is None:
+        return db_unavailable()
+
+    granularity = request.query_params.get('granularity', 'hour')
+    if granularity not in BUCKET_COLLECTIONS:
+        return json_body({'error': 'granularity must be hour or day'}, 400)
+    try:
+        start = _parse_date_arg(request, 'from')
+        end = _parse_date_arg(request, 'to')
+    except ValueError as e:
+        return json_body({'error': str(e)}, 400)
+
+    return json_body({
+        'success': True,
+        'granularity': granularity,
+        'buckets': await asyncio.to_thread(get_analytics, db.delegate, granularity, start, end)
+    })
+
+async def refresh_analytics(request):
+    db = state['db']
+    if db is None:
+        return db_unavailable()
+    processed = await asyncio.to_thread(run_analytics_rollup, db.delegate)
+    return json_body({'success': True, 'processed': processed})
+
+async def get_activity_logs(request):
+    db = state['db']
+    if db is None:
+        return db_unavailable()
+
+    args = request.query_params
+    user_id = args.get('userId')
+    phone = args.get('phone')
+    action = args.get('action')
+    cursor = args.get('cursor')
+    fields = parse_activity_log_fields(args.get('fields'))
+    try:
+        try:
+            limit = min(max(int(args.get('limit', 100)), 1), 1000)
+        except ValueError:
+            raise ValueError('limit must be an integer')
+        start = _parse_date_arg(request, 'from')
+        end = _parse_date_arg(request, 'to')
+        query = build_activity_log_query(user_id, phone, action, start, end)
+        if cursor:
+            query = apply_log_cursor(query, cursor)
+    except ValueError as e:
+        return json_body({'error': str(e)}, 400)
+
+    logs = await (db.activity_logs.find(query, activity_log_projection(fields))
+                  .sort([('timestamp', -1), ('_id', -1)])
+                  .limit(limit).to_list(None))
+    result = [format_activity_log(log, fields) for log in logs]
+
+    # Older entries may have been moved to the archive
+    if archive_enabled() and args.get('includeArchived', 'auto') != 'false' and len(result) < limit:
+        archived = await asyncio.to_thread(
+            read_archived_logs, build_activity_log_query(user_id, phone, action),
+            limit - len(result), start, end, cursor
+        )
+        logs.extend(archived)
+        result.extend(format_archived_log(entry, fields) for entry in archived)
+
+    response = json_body(result)
+    if len(logs) == limit:
+        response.headers['X-Next-Cursor'] = encode_log_cursor(logs[-1])
+    return response
+
+# Exports: synchronous cursors, which Starlette iterates in its thread pool
+
+def _export_format(request):
+    fmt = request.query_params.get('format', 'csv').lower()
+    return fmt if fmt in EXPORT_FORMATS else None
+
+def _parse_export_limit(request):
+    """app._parse_export_limit for Starlette requests"""
+    value = request.query_params.get('limit')
+    if not value:
+        return 0
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError('limit must be a non-negative integer')
+    if limit < 0:
+        raise ValueError('limit must be a non-negative integer')
+    return limit
+
+def _export_response(cursor, row_fn, fields, fmt, name):
+    return StreamingResponse(
+        stream_export(cursor, row_fn, fields, fmt),
+        media_type=EXPORT_FORMATS[fmt],
+        headers=export_headers(name, fmt)
+    )
+
+async def export_referrals(request):
+    db = state['db']
+    if db is None:
+        return db_unavailable()
+    fmt = _export_format(request)
+    if fmt is None:
+        return json_body({'error': 'format must be csv or ndjson'}, 400)
+
+    args = request.query_params
+    query = build_referral_query(
+        args.get('search', '').strip(),
+        args.get('referrer', '').strip(),
+        args.get('subscription', '')
+    )
+    sort_field = REFERRAL_SORT_FIELDS.get(args.get('sort', 'createdAt'), 'createdAt')
+    sort_order = 1 if args.get('order', 'desc') == 'asc' else -1
+    cursor = db.delegate.users.find(query, REFERRAL_USER_PROJECTION).sort([(sort_field, sort_order), ('_id', sort_order)])
+    return _export_response(cursor, referral_export_row, REFERRAL_EXPORT_FIELDS, fmt, 'referrals')
+
+async def export_activity_logs(request):
+    db = state['db']
+    if db is None:
+        return db_unavailable()
+    fmt = _export_format(request)
+    if fmt is None:
+        return json_body({'error': 'format must be csv or ndjson'}, 400)
+
+    args = request.query_params
+    try:
+        query = build_activity_log_query(
+            args.get('userId'),
+            args.get('phone'),
+            args.get('action'),
+            _parse_date_arg(request, 'from'),
+            _parse_date_arg(request, 'to')
+        )
+        limit = _parse_export_limit(request)
+    except ValueError as e:
+        return json_body({'error': str(e)}, 400)
+    cursor = db.delegate.activity_logs.find(query, activity_log_projection()).sort([('timestamp', -1), ('_id', -1)])
+    if limit:
+        cursor = cursor.limit(limit)
+    return _export_response(cursor, activity_log_export_row, ACTIVITY_LOG_EXPORT_FIELDS, fmt, 'activity-logs')
+
+async def export_messages(request):
+    db = state['db']
+    if db is None:
+        return db_unavailable()
+    fmt = _export_format(request)
+    if fmt is None:
+        return json_body({'error': 'format must be csv or ndjson'}, 400)
+
+    phone = request.path_params['phone']
+    conversation = await requested_conversation(db, phone, request.query_params.get('tenant'))
+    cursor = conversation_cursor(db.delegate, phone, MESSAGE_EXPORT_PROJECTION, conversation['tenantId'])
+    return _export_response(cursor, message_export_row, MESSAGE_EXPORT_FIELDS, fmt, f'messages-{phone}')
+
+# Socket.IO
+
+@sio.event
+async def connect(sid, environ):
+    socket_connected()
+    # ?tenant= limits message traffic to one business number
+    tenant_id = parse_qs(environ.get('QUERY_STRING', '')).get('tenant', [None])[0]
+    sio.enter_room(sid, tenant_room(tenant_id) if tenant_id else ALL_TENANTS_ROOM)
+    logger.debug("Client connected", extra={'tenantId': tenant_id})
+    await sio.emit('connected', {'data': 'Connected to WhatsApp CRM'}, to=sid)
+
+@sio.event
+async def disconnect(sid):
+    socket_disconnected()
+    logger.debug("Client disconnected")
+
+# Startup and shutdown
+
+def _prepare_database(db):
+    """The eventlet app's startup steps, on the synchronous driver"""
+    try:
+        ensure_referral_indexes(db)
+        ensure_referral_stats(db)
+        ensure_activity_log_indexes(db)
+        ensure_activity_log_query_indexes(db)
+        # Conversations get their tenantId before the read counters are keyed by it
+        ensure_message_indexes(db)
+        backfill_tenant_ids(db, tenants.default.id)
+        ensure_read_indexes(db)
+        backfill_unread_counts(db)
+        ensure_read_state_indexes(db)
+        backfill_read_state_tenants(db)
+        backfill_inbound_seq(db)
+        ensure_outbound_indexes(db)
+        if message_archive_enabled():
+            ensure_message_archive(db)
+    except Exception as e:
+        logger.exception("Failed to prepare indexes: %s", e)
+    try:
+        ensure_reply_rules(db)
+        flow_engine.load(db)
+    except Exception as e:
+        logger.exception("Failed to load reply rules: %s", e)
+
+def _connect_mongo():
+    mongodb_uri = os.getenv('MONGODB_URI') or os.getenv('MONGO_PUBLIC_URL') or 'mongodb://localhost:27017/whatsapp_crm'
+    if 'ssl=true' not in mongodb_uri and 'tls=true' not in mongodb_uri and 'mongodb.net' in mongodb_uri:
+        mongodb_uri = f"{mongodb_uri}{'&' if '?' in mongodb_uri else '?'}ssl=true"
+    return AsyncIOMotorClient(
+        mongodb_uri,
+        server_api=ServerApi('1'),
+        serverSelectionTimeoutMS=30000,
+        connectTimeoutMS=20000,
+        socketTimeoutMS=20000,
+        maxPoolSize=50,
+        minPoolSize=10,
+        retryWrites=True,
+        retryReads=True,
+        event_listeners=[MongoMetricsListener(), TracingCommandListener()]
+    )
+
+@contextlib.asynccontextmanager
+async def lifespan(application):
+    client = _connect_mongo()
+    try:
+        await client.admin.command('ping')
+        state['db'] = client.whatsapp_crm
+        logger.info("Successfully connected to MongoDB")
+    except Exception as e:
+        logger.error("Failed to connect to MongoDB: %s", e)
+
+    state['graph'] = create_graph_client()
+    state['customers_http'] = httpx.AsyncClient(timeout=10)
+    state['invite_http'] = httpx.AsyncClient(timeout=INVITE_API_TIMEOUT)
+    tasks = [asyncio.create_task(every(300, fetch_customers_from_api, 'periodic customer update'))]
+
+    db = state['db']
+    if db is not None:
+        sync_db = db.delegate
+        await asyncio.to_thread(_prepare_database, sync_db)
+        start_reply_rules_reloader(sync_db)
+        state['activity_logger'] = ActivityLogWriter(sync_db)
+        state['activity_logger'].start()
+        tasks.append(asyncio.create_task(every(
+            ANALYTICS_ROLLUP_INTERVAL,
+            lambda: asyncio.to_thread(run_analytics_rollup, sync_db),
+            'analytics rollup'
+        )))
+        if archive_enabled():
+            tasks.append(asyncio.create_task(every(
+                ACTIVITY_LOG_ARCHIVE_INTERVAL,
+                lambda: asyncio.to_thread(archive_activity_logs, sync_db),
+                'activity log archive'
+            )))
+        if message_archive_enabled():
+            tasks.append(asyncio.create_task(every(
+                MESSAGE_ARCHIVE_INTERVAL,
+                lambda: asyncio.to_thread(archive_messages, sync_db),
+                'message archive'
+            )))
+        # Agent messages left pending by a worker that died mid-send
+        try:
+            await recover_outbound_messages()
+        except Exception as e:
+            logger.exception("Error recovering outbound messages: %s", e)
+        tasks.append(asyncio.create_task(every(
+            OUTBOUND_RECOVERY_INTERVAL, recover_outbound_messages, 'outbound message recovery'
+        )))
+    if WHATSAPP_READ_RECEIPTS:
+        state['read_receipt_sender'] = ReadReceiptSender()
+        state['read_receipt_sender'].start()
+
+    await fetch_customers_from_api()
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        if state['activity_logger'] is not None:
+            await asyncio.to_thread(state['activity_logger'].close)
+        await state['graph'].aclose()
+        await state['customers_http'].aclose()
+        await state['invite_http'].aclose()
+        client.close()
+
+http_app = Starlette(
+    routes=[
+        Route('/api/health', health),
+        Route('/metrics', metrics),
+        Route('/api/webhook', webhook, methods=['GET', 'POST']),
+        Route('/api/chats', get_chats),
+        Route('/api/messages/{phone}', get_messages),
+        Route('/api/media/{message_id}', get_media),
+        Route('/api/messages/{phone}/read', mark_messages_read, methods=['POST']),
+        Route('/api/send-message', send_message, methods=['POST']),
+        Route('/api/schedule-call', schedule_call, methods=['POST']),
+        Route('/api/download-ics/{phone}', download_ics),
+        Route('/api/user-notes/{phone}', user_notes, methods=['GET', 'POST']),
+        Route('/api/update-status', update_status, methods=['POST']),
+        Route('/api/customers', get_customers),
+        Route('/api/send-invite', send_invite, methods=['POST']),
+        Route('/api/update-payment-status', update_payment_status, methods=['POST']),
+        Route('/api/update-subscription', update_subscription, methods=['POST']),
+        Route('/api/referrals', get_referrals),
+        Route('/api/referrals/rebuild-stats', rebuild_referrals_stats, methods=['POST']),
+        Route('/api/reply-rules', reply_rules, methods=['GET', 'POST']),
+        Route('/api/reply-rules/{rule_id}', delete_reply_rule, methods=['DELETE']),
+        Route('/api/analytics', analytics),
+        Route('/api/analytics/refresh', refresh_analytics, methods=['POST']),
+        Route('/api/activity-logs', get_activity_logs),
+        Route('/api/export/referrals', export_referrals),
+        Route('/api/export/activity-logs', export_activity_logs),
+        Route('/api/export/messages/{phone}', export_messages)
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+        Middleware(TracingMiddleware)
+    ],
+    lifespan=lifespan
+)
+
+app = socketio.ASGIApp(sio, other_asgi_app=http_app)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run('asgi:app', host='0.0.0.0', port=int(os.getenv('PORT', 5000)),
+                workers=int(os.getenv('WEB_CONCURRENCY', 1)), log_level='warning')
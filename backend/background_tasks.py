@@ -0,0 +1,239 @@
+import logging
+import os
+import signal
+import time
+import uuid
+from datetime import datetime, timedelta
+import eventlet
+import pytz
+from bson import json_util
+from pymongo import UpdateOne
+
+from tracing import carry_context
+
+logger = logging.getLogger(__name__)
+
+# Work that finishes after the HTTP response has gone out (persisting sent
+# messages, auto-replies, media downloads) runs through the task registry
+# instead of bare spawn_n calls, so shutdown can account for it.
+#
+# Every task has a kind, registered with a handler, and a BSON-serializable
+# payload. On SIGTERM the registry stops starting new tasks, waits up to
+# SHUTDOWN_DRAIN_TIMEOUT for the running ones, and writes whatever is left to
+# the task_outbox collection (or TASK_OUTBOX_SPILL_PATH when Mongo is
+# unreachable). The next process replays the outbox on startup. Handlers must
+# therefore be idempotent: a task may have been part-way through when spilled.
+#
+# Outbox documents:
+#   {'_id': <task id>, 'kind': str, 'payload': {...}, 'attempts': int,
+#    'spilledAt': datetime, 'claimedAt': datetime, 'claimedBy': str,
+#    'lastError': str, 'failed': bool}
+#
+# Replay claims documents one at a time, so instances starting together don't
+# both run a task; a claim older than TASK_CLAIM_LEASE can be taken over.
+
+# Cloud Run allows 10s between SIGTERM and SIGKILL
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv('SHUTDOWN_DRAIN_TIMEOUT', 8))
+TASK_OUTBOX_SPILL_PATH = os.getenv('TASK_OUTBOX_SPILL_PATH', 'task_outbox.spill.ndjson')
+# Replayed tasks that keep failing are parked with failed=True
+TASK_MAX_ATTEMPTS = int(os.getenv('TASK_MAX_ATTEMPTS', 5))
+TASK_CLAIM_LEASE = timedelta(seconds=int(os.getenv('TASK_CLAIM_LEASE', 300)))
+
+class _Task:
+    __slots__ = ('id', 'kind', 'payload', 'thread', 'replayed')
+
+    def __init__(self, task_id, kind, payload, replayed):
+        self.id = task_id
+        self.kind = kind
+        self.payload = payload
+        self.thread = None
+        self.replayed = replayed
+
+class TaskRegistry:
+    """Tracks background tasks so they can be drained, spilled and replayed"""
+
+    def __init__(self, spill_path=TASK_OUTBOX_SPILL_PATH):
+        self.spill_path = spill_path
+        self.instance_id = uuid.uuid4().hex
+        self.db = None
+        self.socketio = None
+        self._handlers = {}
+        self._tasks = {}
+        self._accepting = True
+
+    def handler(self, kind):
+        """Decorator registering `func(db, socketio, payload)` for a task kind"""
+        def decorator(func):
+            self._handlers[kind] = func
+            return func
+        return decorator
+
+    def start(self, db, socketio):
+        """Bind the app's database and Socket.IO server and replay the outbox"""
+        self.db = db
+        self.socketio = socketio
+        return self.replay()
+
+    def pending(self):
+        return len(self._tasks)
+
+    def spawn(self, kind, payload, task_id=None):
+        """Run a registered task in a green thread"""
+        if kind not in self._handlers:
+            raise ValueError(f'Unknown task kind: {kind}')
+        task = _Task(task_id or uuid.uuid4().hex, kind, payload, replayed=task_id is not None)
+        if not self._accepting:
+            # Shutting down: straight to the outbox for the next process
+            self._spill([task])
+            return task.id
+        self._tasks[task.id] = task
+        task.thread = eventlet.spawn(carry_context(self._run), task)
+        return task.id
+
+    def _run(self, task):
+        try:
+            self._handlers[task.kind](self.db, self.socketio, task.payload)
+        except Exception as e:
+            logger.exception("Background task %s (%s) failed: %s", task.id, task.kind, e)
+            if task.replayed:
+                self._record_failure(task, e)
+        else:
+            if task.replayed:
+                self.db.task_outbox.delete_one({'_id': task.id})
+        finally:
+            self._tasks.pop(task.id, None)
+
+    def _record_failure(self, task, error):
+        try:
+            outbox = self.db.task_outbox.find_one_and_update(
+                {'_id': task.id},
+                {
+                    '$inc': {'attempts': 1},
+                    '$set': {'lastError': str(error)},
+                    # Up for the next startup's replay
+                    '$unset': {'claimedAt': '', 'claimedBy': ''}
+                },
+                projection={'attempts': 1}
+            )
+            if outbox and outbox.get('attempts', 0) + 1 >= TASK_MAX_ATTEMPTS:
+                self.db.task_outbox.update_one({'_id': task.id}, {'$set': {'failed': True}})
+                logger.error("Parking task %s (%s) after %d attempts", task.id, task.kind, TASK_MAX_ATTEMPTS)
+        except Exception as e:
+            logger.warning("Could not record failure of task %s: %s", task.id, e)
+
+    def drain(self, timeout=SHUTDOWN_DRAIN_TIMEOUT):
+        """Stop accepting tasks, wait for running ones, spill the rest.
+
+        Returns the number of tasks spilled.
+        """
+        self._accepting = False
+        deadline = time.monotonic() + timeout
+        while self._tasks and time.monotonic() < deadline:
+            eventlet.sleep(0.05)
+
+        unfinished = list(self._tasks.values())
+        for task in unfinished:
+            task.thread.kill()
+        if unfinished:
+            self._spill(unfinished)
+        logger.info("Drained background tasks; %d left unfinished", len(unfinished))
+        return len(unfinished)
+
+    @staticmethod
+    def _outbox_upsert(doc):
+        # Replayed tasks are already in the outbox: keep their attempts, drop the claim
+        return UpdateOne(
+            {'_id': doc['_id']},
+            {
+                '$set': {'kind': doc['kind'], 'payload': doc['payload'], 'spilledAt': doc['spilledAt']},
+                '$setOnInsert': {'attempts': 0},
+                '$unset': {'claimedAt': '', 'claimedBy': ''}
+            },
+            upsert=True
+        )
+
+    def _spill(self, tasks):
+        now = datetime.now(pytz.timezone('Asia/Kolkata'))
+        docs = [
+            {'_id': task.id, 'kind': task.kind, 'payload': task.payload, 'spilledAt': now}
+            for task in tasks
+        ]
+        if self.db is not None:
+            try:
+                self.db.task_outbox.bulk_write([self._outbox_upsert(doc) for doc in docs], ordered=False)
+                logger.warning("Spilled %d background tasks to task_outbox", len(docs))
+                return
+            except Exception as e:
+                logger.error("Could not write task_outbox, spilling to %s: %s", self.spill_path, e)
+        with open(self.spill_path, 'a') as f:
+            for doc in docs:
+                f.write(json_util.dumps(doc) + '\n')
+        logger.warning("Spilled %d background tasks to %s", len(docs), self.spill_path)
+
+    def replay(self):
+        """Re-run tasks spilled by a previous process. Returns how many were started."""
+        if self.db is None:
+            return 0
+
+        if os.path.exists(self.spill_path):
+            with open(self.spill_path) as f:
+                docs = [json_util.loads(line) for line in f if line.strip()]
+            if docs:
+                self.db.task_outbox.bulk_write([self._outbox_upsert(doc) for doc in docs], ordered=False)
+            os.unlink(self.spill_path)
+
+        replayed = 0
+        while True:
+            now = datetime.now(pytz.timezone('Asia/Kolkata'))
+            doc = self.db.task_outbox.find_one_and_update(
+                {
+                    'failed': {'$ne': True},
+                    'claimedBy': {'$ne': self.instance_id},
+                    '$or': [{'claimedAt': {'$exists': False}}, {'claimedAt': {'$lt': now - TASK_CLAIM_LEASE}}]
+                },
+                {'$set': {'claimedAt': now, 'claimedBy': self.instance_id}}
+            )
+            if doc is None:
+                break
+            if doc['kind'] not in self._handlers:
+                logger.warning("Skipping outbox task %s of unknown kind %s", doc['_id'], doc['kind'])
+                continue
+            self.spawn(doc['kind'], doc['payload'], task_id=doc['_id'])
+            replayed += 1
+        if replayed:
+            logger.info("Replaying %d background tasks from task_outbox", replayed)
+        return replayed
+
+task_registry = TaskRegistry()
+
+def install_shutdown_handler(cleanups=(), registry=task_registry, timeout=SHUTDOWN_DRAIN_TIMEOUT):
+    """On SIGTERM: drain `registry`, run `cleanups`, then hand over to the previous handler.
+
+    The previous handler is gunicorn's graceful stop under gunicorn, or the
+    default (terminate) when run directly.
+    """
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def shutdown(signum):
+        logger.info("SIGTERM received, draining %d background tasks", registry.pending())
+        try:
+            registry.drain(timeout)
+        except Exception as e:
+            logger.exception("Error draining background tasks: %s", e)
+        for cleanup in cleanups:
+            try:
+                cleanup()
+            except Exception as e:
+                logger.exception("Error during shutdown: %s", e)
+
+        if callable(previous):
+            previous(signum, None)
+        else:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    def on_sigterm(signum, frame):
+        # Signal handlers can interrupt the hub itself; do the work in a green thread
+        eventlet.spawn_n(shutdown, signum)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
@@ -0,0 +1,128 @@
+"""Bytes transferred and decode time for the hot read paths.
+
+Seeds a scratch database with one long conversation (messages carrying
+buttons and media sub-documents) and users with large notes arrays, then
+compares for a /api/messages page and the /api/chats user scan:
+
+  full       whole documents decoded into dicts (the previous behaviour)
+  projected  the row projections from serializers.py
+  raw        projections decoded as RawBSONDocument (MONGO_RAW_BSON=true)
+
+Bytes are the BSON size of the returned documents; time covers the query,
+decoding and building the response rows.
+
+    python benchmarks/bench_projection.py --mongodb-uri mongodb://localhost:27017
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import bson
+from bson.raw_bson import RawBSONDocument
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from serializers import (
+    CHAT_USER_PROJECTION,
+    MESSAGE_ROW_PROJECTION,
+    RAW_CODEC_OPTIONS,
+    chat_row,
+    message_row
+)
+
+PHONE = '919900000001'
+
+def seed(db, messages, users, notes):
+    db.messages.drop()
+    db.users.drop()
+    rng = random.Random(1)
+    start = datetime(2024, 1, 1)
+    buttons = [{'type': 'reply', 'reply': {'id': f'b{i}', 'title': f'Button {i}'}} for i in range(3)]
+    db.messages.insert_many([
+        {
+            'phone': PHONE,
+            'message': 'lorem ipsum dolor sit amet ' * rng.randint(1, 10),
+            'direction': rng.choice(['inbound', 'outbound']),
+            'timestamp': start + timedelta(seconds=i * 30),
+            'messageType': 'interactive',
+            'status': 'read',
+            'isRead': True,
+            'whatsappMessageId': f'wamid.{i}',
+            'buttons': buttons,
+            'media': {'type': 'image', 'id': str(i), 'mimeType': 'image/jpeg', 'sha256': 'x' * 44,
+                      'status': 'stored', 'blobKey': f'2024/01/01/{i}.jpg', 'size': 123456},
+            'rawPayload': {'entry': [{'changes': [{'value': {'padding': 'y' * 400}}]}]}
+        }
+        for i in range(messages)
+    ])
+    db.messages.create_index([('phone', 1), ('timestamp', -1)])
+    db.users.insert_many([
+        {
+            'phone': f'9199{i:08d}',
+            'name': f'User {i}',
+            'status': 'priority',
+            'lastMessageAt': start + timedelta(minutes=i),
+            'unreadCount': 0,
+            'inboundSeq': 10,
+            'notes': [
+                {'_id': str(n), 'text': 'note text ' * 20, 'createdAt': start, 'addedBy': 'Admin'}
+                for n in range(notes)
+            ]
+        }
+        for i in range(users)
+    ])
+
+def run(label, fetch, build, repeat):
+    sizes = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        docs = fetch()
+        rows = [build(doc) for doc in docs]
+    elapsed = (time.perf_counter() - start) / repeat
+    for doc in docs:
+        sizes += len(doc.raw) if isinstance(doc, RawBSONDocument) else len(bson.encode(doc))
+    print(f"  {label:10s} {sizes / 1024:10.1f} KiB  {elapsed * 1000:8.2f} ms  ({len(rows)} rows)")
+
+def main():
+    parser = argparse.ArgumentParser(description='Projection / raw BSON benchmark')
+    parser.add_argument('--mongodb-uri', default='mongodb://localhost:27017')
+    parser.add_argument('--database', default='crm_bench_projection')
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--limit', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--notes', type=int, default=20, help='notes per user')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongodb_uri)
+    db = client[args.database]
+    seed(db, args.messages, args.users, args.notes)
+    raw_db = client.get_database(args.database, codec_options=RAW_CODEC_OPTIONS)
+
+    def messages(database, projection):
+        return lambda: list(
+            database.messages.find({'phone': PHONE}, projection).sort('timestamp', -1).limit(args.limit)
+        )
+
+    print(f"/api/messages page (limit={args.limit})")
+    run('full', messages(db, None), message_row, args.repeat)
+    run('projected', messages(db, MESSAGE_ROW_PROJECTION), message_row, args.repeat)
+    run('raw', messages(raw_db, MESSAGE_ROW_PROJECTION), message_row, args.repeat)
+
+    def users(database, projection):
+        return lambda: list(database.users.find({}, projection).sort('lastMessageAt', -1))
+
+    print(f"/api/chats user scan ({args.users} users, {args.notes} notes each)")
+    run('full', users(db, None), lambda user: chat_row(user, None), args.repeat)
+    run('projected', users(db, CHAT_USER_PROJECTION), lambda user: chat_row(user, None), args.repeat)
+    run('raw', users(raw_db, CHAT_USER_PROJECTION), lambda user: chat_row(user, None), args.repeat)
+
+    client.drop_database(args.database)
+
+if __name__ == '__main__':
+    main()
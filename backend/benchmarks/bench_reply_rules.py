@@ -0,0 +1,87 @@
+"""Keyword matching throughput of the reply flow engine.
+
+Compares the compiled Aho-Corasick automaton in reply_flows with the naive
+approach of testing every keyword with `in`, over a synthetic rule set.
+
+    python benchmarks/bench_reply_rules.py --rules 200 --keywords-per-rule 5
+"""
+
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reply_flows import FlowEngine
+
+def random_word(rng):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 9)))
+
+def build_rules(rng, count, keywords_per_rule):
+    return [
+        {
+            '_id': f'keyword:{i}',
+            'kind': 'keyword',
+            'keywords': [random_word(rng) for _ in range(keywords_per_rule)],
+            'priority': rng.randint(1, 100),
+            'template': f'Reply {i}'
+        }
+        for i in range(count)
+    ]
+
+def build_messages(rng, rules, count, hit_ratio):
+    keywords = [keyword for rule in rules for keyword in rule['keywords']]
+    messages = []
+    for _ in range(count):
+        words = [random_word(rng) for _ in range(rng.randint(5, 30))]
+        if rng.random() < hit_ratio:
+            words.insert(rng.randrange(len(words)), rng.choice(keywords))
+        messages.append(' '.join(words))
+    return messages
+
+def naive_match(rules, text):
+    text = text.lower()
+    best = None
+    for rule in rules:
+        if any(keyword in text for keyword in rule['keywords']):
+            if best is None or rule['priority'] < best['priority']:
+                best = rule
+    return best
+
+def measure(label, func, messages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for message in messages:
+            func(message)
+    elapsed = time.perf_counter() - start
+    total = len(messages) * repeat
+    print(f"{label:12s} {total / elapsed:12,.0f} messages/s  {elapsed / total * 1e6:8.2f} us/message")
+
+def main():
+    parser = argparse.ArgumentParser(description='Reply rule matching benchmark')
+    parser.add_argument('--rules', type=int, default=200)
+    parser.add_argument('--keywords-per-rule', type=int, default=5)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--hit-ratio', type=float, default=0.3)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rules = build_rules(rng, args.rules, args.keywords_per_rule)
+    messages = build_messages(rng, rules, args.messages, args.hit_ratio)
+
+    engine = FlowEngine()
+    start = time.perf_counter()
+    engine.compile(rules)
+    print(f"Compiled {args.rules} rules / {args.rules * args.keywords_per_rule} keywords "
+          f"in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    measure('automaton', engine.match_keyword, messages, args.repeat)
+    measure('naive', lambda text: naive_match(rules, text), messages, args.repeat)
+
+if __name__ == '__main__':
+    main()
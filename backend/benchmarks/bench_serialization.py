@@ -0,0 +1,86 @@
+"""Serialization cost of a /api/messages page.
+
+Builds `--limit` synthetic message documents shaped like PyMongo returns them
+and times turning them into a response body, comparing the previous per-row
+pytz conversion + isoformat + stdlib json path with serializers.message_row +
+serializers.dumps (orjson when installed).
+
+    python benchmarks/bench_serialization.py --limit 1000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import pytz
+from bson import ObjectId
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serializers
+from serializers import dumps, message_row
+
+def build_messages(count):
+    rng = random.Random(1)
+    start = datetime(2024, 1, 1)
+    messages = []
+    for i in range(count):
+        inbound = rng.random() < 0.5
+        messages.append({
+            '_id': ObjectId(),
+            'phone': '919900000001',
+            'message': ' '.join('lorem ipsum dolor sit amet'.split() * rng.randint(1, 6)),
+            'direction': 'inbound' if inbound else 'outbound',
+            'timestamp': start + timedelta(seconds=i * 37, microseconds=rng.randint(0, 999) * 1000),
+            'messageType': 'text',
+            'status': 'received' if inbound else rng.choice(['sent', 'delivered', 'read']),
+            'whatsappMessageId': None if inbound else f'wamid.{i}',
+            'buttons': None,
+            'buttonId': None
+        })
+    return messages
+
+def previous_body(messages):
+    result = []
+    for msg in messages:
+        result.append({
+            'id': str(msg['_id']),
+            'message': msg['message'],
+            'direction': msg['direction'],
+            'timestamp': msg['timestamp'].astimezone(pytz.timezone('Asia/Kolkata')).isoformat(),
+            'messageType': msg.get('messageType', 'text'),
+            'status': msg.get('status', 'sent'),
+            'whatsappMessageId': msg.get('whatsappMessageId'),
+            'buttons': msg.get('buttons'),
+            'buttonId': msg.get('buttonId')
+        })
+    return json.dumps({'messages': result}).encode()
+
+def current_body(messages):
+    return dumps({'messages': [message_row(msg) for msg in messages]})
+
+def measure(label, func, messages, repeat):
+    func(messages)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        body = func(messages)
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{label:10s} {elapsed * 1000:8.2f} ms/page  {len(body) / 1024:8.1f} KiB")
+
+def main():
+    parser = argparse.ArgumentParser(description='/api/messages serialization benchmark')
+    parser.add_argument('--limit', type=int, default=1000, help='messages per page')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    messages = build_messages(args.limit)
+    print(f"{args.limit} messages, encoder: {'orjson' if serializers.orjson else 'stdlib json'}")
+    measure('previous', previous_body, messages, args.repeat)
+    measure('current', current_body, messages, args.repeat)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""Local stand-in for the WhatsApp Cloud (Graph) API.
+
+Accepts POST /<version>/<phone_number_id>/messages like Meta does, with
+configurable latency, rate limiting (429), random errors, and asynchronous
+sent -> delivered -> read status webhooks posted back to the CRM, so the send
+and status pipelines can be soak-tested end to end without leaving the box.
+
+    python benchmarks/graph_simulator.py --port 5901 \\
+        --webhook-url http://127.0.0.1:5000/api/webhook \\
+        --latency-ms 120 --jitter-ms 40 --rate-limit 80 --error-rate 0.01
+
+then start the backend with GRAPH_API_BASE_URL=http://127.0.0.1:5901/v17.0.
+GET /stats returns counters for the run.
+"""
+
+import argparse
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+class SimulatorConfig:
+    def __init__(self, latency_ms=0, jitter_ms=0, rate_limit=0, throttle_rate=0.0, error_rate=0.0,
+                 webhook_url=None, sent_after_ms=50, delivered_after_ms=300, read_after_ms=2000,
+                 read_ratio=0.7, failed_ratio=0.0, phone_number_id='bench', app_secret=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        # Requests per second before answering 429 (0 = unlimited)
+        self.rate_limit = rate_limit
+        # Probability of a random 429 regardless of rate
+        self.throttle_rate = throttle_rate
+        # Probability of a 500
+        self.error_rate = error_rate
+        self.webhook_url = webhook_url
+        self.sent_after_ms = sent_after_ms
+        self.delivered_after_ms = delivered_after_ms
+        self.read_after_ms = read_after_ms
+        self.read_ratio = read_ratio
+        self.failed_ratio = failed_ratio
+        self.phone_number_id = phone_number_id
+        # Signs status webhooks like Meta does when set
+        self.app_secret = app_secret
+
+def signed_webhook(payload, app_secret=None):
+    """(body, headers) for posting `payload` to a webhook, with X-Hub-Signature-256 when `app_secret` is set"""
+    body = json.dumps(payload).encode()
+    headers = {'Content-Type': 'application/json'}
+    if app_secret:
+        digest = hmac.new(app_secret.encode(), body, hashlib.sha256).hexdigest()
+        headers['X-Hub-Signature-256'] = f'sha256={digest}'
+    return body, headers
+
+class _RateLimiter:
+    """Token bucket refilled at `rate` tokens per second"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        if not self.rate:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+class StatusCallbacks:
+    """Posts status webhooks at their due time from a single scheduler thread"""
+
+    def __init__(self, config, stats):
+        self.config = config
+        self.stats = stats
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._session = requests.Session()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def schedule_message(self, message_id, recipient):
+        config = self.config
+        if not config.webhook_url:
+            return
+        now = time.time()
+        self._schedule(now + config.sent_after_ms / 1000, message_id, recipient, 'sent')
+        if random.random() < config.failed_ratio:
+            self._schedule(now + config.delivered_after_ms / 1000, message_id, recipient, 'failed')
+            return
+        self._schedule(now + config.delivered_after_ms / 1000, message_id, recipient, 'delivered')
+        if random.random() < config.read_ratio:
+            self._schedule(now + config.read_after_ms / 1000, message_id, recipient, 'read')
+
+    def _schedule(self, due, message_id, recipient, status):
+        with self._condition:
+            heapq.heappush(self._heap, (due, next(self._counter), message_id, recipient, status))
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.time():
+                    timeout = self._heap[0][0] - time.time() if self._heap else None
+                    self._condition.wait(timeout)
+                _, _, message_id, recipient, status = heapq.heappop(self._heap)
+            self._post(message_id, recipient, status)
+
+    def _post(self, message_id, recipient, status):
+        payload = {
+            'object': 'whatsapp_business_account',
+            'entry': [{
+                'id': 'simulator',
+                'changes': [{
+                    'field': 'messages',
+                    'value': {
+                        'messaging_product': 'whatsapp',
+                        'metadata': {
+                            'display_phone_number': '910000000000',
+                            'phone_number_id': self.config.phone_number_id
+                        },
+                        'statuses': [{
+                            'id': message_id,
+                            'status': status,
+                            'timestamp': str(int(time.time())),
+                            'recipient_id': recipient
+                        }]
+                    }
+                }]
+            }]
+        }
+        try:
+            body, headers = signed_webhook(payload, self.config.app_secret)
+            response = self._session.post(self.config.webhook_url, data=body, headers=headers, timeout=10)
+            self.stats.incr('callbacks_ok' if response.ok else 'callbacks_failed')
+        except requests.RequestException:
+            self.stats.incr('callbacks_failed')
+
+class Stats:
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def incr(self, key):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+def make_handler(config, stats, callbacks):
+    limiter = _RateLimiter(config.rate_limit)
+
+    class GraphHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _error(self, status, code, message):
+            self._reply(status, {'error': {'message': message, 'type': 'OAuthException', 'code': code}})
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, stats.snapshot())
+            else:
+                self._reply(404, {'error': {'message': 'Unknown path'}})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                body = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                return self._error(400, 100, 'Invalid JSON')
+
+            if not self.path.rstrip('/').endswith('/messages'):
+                return self._reply(404, {'error': {'message': 'Unknown path'}})
+
+            delay = config.latency_ms + random.uniform(-config.jitter_ms, config.jitter_ms)
+            if delay > 0:
+                time.sleep(delay / 1000)
+
+            if not limiter.allow() or random.random() < config.throttle_rate:
+                stats.incr('throttled')
+                return self._error(429, 130429, 'Rate limit hit')
+            if random.random() < config.error_rate:
+                stats.incr('errors')
+                return self._error(500, 131000, 'Something went wrong')
+
+            # Read receipt for an inbound message
+            if body.get('status') == 'read':
+                stats.incr('read_receipts')
+                return self._reply(200, {'success': True})
+
+            recipient = body.get('to')
+            if not recipient:
+                return self._error(400, 100, "The parameter 'to' is required")
+
+            message_id = f"wamid.SIM{uuid.uuid4().hex.upper()}"
+            stats.incr('messages')
+            callbacks.schedule_message(message_id, recipient)
+            self._reply(200, {
+                'messaging_product': 'whatsapp',
+                'contacts': [{'input': recipient, 'wa_id': recipient}],
+                'messages': [{'id': message_id}]
+            })
+
+        def log_message(self, format, *args):
+            pass
+
+    return GraphHandler
+
+def start_simulator(config, port=0):
+    """Serve the simulator on a background thread. Returns (server, base_url, stats)."""
+    stats = Stats()
+    callbacks = StatusCallbacks(config, stats)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(config, stats, callbacks))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v17.0", stats
+
+def add_simulator_arguments(parser):
+    parser.add_argument('--latency-ms', type=float, default=0, help='added to every Graph call')
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--rate-limit', type=float, default=0, help='Graph calls per second before 429s')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='probability of a random 429')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a 500')
+    parser.add_argument('--read-ratio', type=float, default=0.7, help='share of sends that get read')
+    parser.add_argument('--failed-ratio', type=float, default=0.0, help='share of sends that fail delivery')
+    parser.add_argument('--delivered-after-ms', type=float, default=300)
+    parser.add_argument('--read-after-ms', type=float, default=2000)
+
+def config_from_args(args, webhook_url=None, app_secret=None):
+    return SimulatorConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        rate_limit=args.rate_limit,
+        throttle_rate=args.throttle_rate,
+        error_rate=args.error_rate,
+        webhook_url=webhook_url,
+        delivered_after_ms=args.delivered_after_ms,
+        read_after_ms=args.read_after_ms,
+        read_ratio=args.read_ratio,
+        failed_ratio=args.failed_ratio,
+        app_secret=app_secret
+    )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=5901)
+    parser.add_argument('--webhook-url', help='CRM webhook to post status updates to')
+    parser.add_argument('--app-secret', help="sign status webhooks with the CRM's WHATSAPP_APP_SECRET")
+    add_simulator_arguments(parser)
+    args = parser.parse_args()
+
+    server, base_url, _ = start_simulator(config_from_args(args, args.webhook_url, args.app_secret), args.port)
+    print(f"Graph API simulator at {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
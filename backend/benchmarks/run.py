@@ -0,0 +1,412 @@
+"""Reproducible load test for the CRM backend.
+
+Starts a throwaway mongod, the Graph API simulator, a stub customers API and
+the app itself, then for --duration seconds concurrently:
+
+  * replays synthetic inbound-message webhooks (POST /api/webhook)
+  * reads the chat list (GET /api/chats)
+  * reads conversation history (GET /api/messages/<phone>)
+  * sends agent messages (POST /api/send-message) through the Graph API
+    simulator, which posts delivered/read status webhooks back; the request
+    only queues the message, so the time until its sent/failed
+    `message_status_update` is reported separately as send_dispatch_lag, and
+    --resend-ratio of sends are posted again with the same tempId to check
+    they aren't queued twice
+  * keeps Socket.IO subscribers connected and measures the lag between
+    posting a webhook and receiving its `new_message` event
+
+and prints throughput and p50/p95/p99 latency per scenario. Results can be
+saved as a baseline (--save-baseline) and later runs are compared against it,
+exiting non-zero on regressions beyond --tolerance.
+
+    python benchmarks/run.py --duration 30 --save-baseline
+    python benchmarks/run.py --duration 30
+
+Pass --mongodb-uri to use an existing server instead of spawning mongod (the
+app always uses the `whatsapp_crm` database, so point it at a scratch server).
+
+--server asgi runs the same load against the ASGI app (asgi.py under uvicorn,
+--workers processes) and --server both runs eventlet then ASGI, each against a
+fresh mongod, and prints the ASGI results relative to eventlet. Socket events
+only reach subscribers on other workers through a message queue:
+
+    python benchmarks/run.py --duration 30 --server both --workers 4 \
+        --env SOCKETIO_MESSAGE_QUEUE=redis://localhost:6379/0
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+import socketio
+
+from graph_simulator import add_simulator_arguments, config_from_args, signed_webhook, start_simulator
+from stubs import start_stubs
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Webhooks are signed so the benchmark pays for signature verification like production
+BENCH_APP_SECRET = 'bench-app-secret'
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_until(check, timeout, what):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except Exception:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Timed out waiting for {what}")
+
+def start_mongod(binary, workdir):
+    port = free_port()
+    dbpath = os.path.join(workdir, 'db')
+    os.makedirs(dbpath)
+    process = subprocess.Popen(
+        [binary, '--dbpath', dbpath, '--port', str(port), '--bind_ip', '127.0.0.1', '--quiet'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+    def accepting():
+        with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+            return True
+    wait_until(accepting, 30, 'mongod')
+    return process, f"mongodb://127.0.0.1:{port}/whatsapp_crm"
+
+def app_command(server, port, workers):
+    if server == 'asgi':
+        return [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(port),
+                '--workers', str(workers), '--log-level', 'warning']
+    return [sys.executable, 'app.py']
+
+def start_app(port, mongodb_uri, graph_url, stub_url, extra_env, server='eventlet', workers=1):
+    env = dict(
+        os.environ,
+        PORT=str(port),
+        MONGODB_URI=mongodb_uri,
+        GRAPH_API_BASE_URL=graph_url,
+        CUSTOMERS_API_URL=f"{stub_url}/customers",
+        WHATSAPP_PHONE_ID='bench',
+        WHATSAPP_TOKEN='bench',
+        WHATSAPP_APP_SECRET=BENCH_APP_SECRET,
+        LOG_LEVEL='WARNING',
+        **extra_env
+    )
+    process = subprocess.Popen(app_command(server, port, workers), cwd=BACKEND_DIR, env=env)
+    base_url = f"http://127.0.0.1:{port}"
+    wait_until(lambda: requests.get(f"{base_url}/api/health", timeout=1).ok, 60, 'the app')
+    return process, base_url
+
+def webhook_payload(phone, text):
+    return {
+        'object': 'whatsapp_business_account',
+        'entry': [{
+            'id': 'bench',
+            'changes': [{
+                'field': 'messages',
+                'value': {
+                    'messaging_product': 'whatsapp',
+                    'metadata': {'display_phone_number': '910000000000', 'phone_number_id': 'bench'},
+                    'contacts': [{'profile': {'name': f'Bench {phone[-4:]}'}, 'wa_id': phone}],
+                    'messages': [{
+                        'from': phone,
+                        'id': f'wamid.BENCH{uuid.uuid4().hex}',
+                        'timestamp': str(int(time.time())),
+                        'type': 'text',
+                        'text': {'body': text}
+                    }]
+                }
+            }]
+        }]
+    }
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * len(values))) - 1))
+    return values[index]
+
+class Scenario:
+    """Latencies and errors collected by a group of worker threads"""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, ok=True):
+        with self._lock:
+            self.latencies.append(seconds)
+            if not ok:
+                self.errors += 1
+
+    def summary(self, duration):
+        return {
+            'requests': len(self.latencies),
+            'errors': self.errors,
+            'throughput': round(len(self.latencies) / duration, 2),
+            'p50_ms': _ms(percentile(self.latencies, 50)),
+            'p95_ms': _ms(percentile(self.latencies, 95)),
+            'p99_ms': _ms(percentile(self.latencies, 99))
+        }
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+def run_load(base_url, args):
+    phones = [f"9199{i:08d}" for i in range(args.phones)]
+    stop = threading.Event()
+    sent_at = {}
+    queued_at = {}
+    delivery = Scenario('socket_delivery_lag')
+    dispatch = Scenario('send_dispatch_lag')
+    resends = Scenario('send_resend')
+    scenarios = {
+        'webhook': Scenario('webhook'),
+        'chats': Scenario('chats'),
+        'messages': Scenario('messages'),
+        'send': Scenario('send')
+    }
+
+    # Socket.IO subscribers
+    clients = []
+    for _ in range(args.subscribers):
+        client = socketio.Client(reconnection=False)
+
+        @client.on('new_message')
+        def on_new_message(data):
+            token = (data.get('message') or '').rsplit(' ', 1)[-1]
+            started = sent_at.get(token)
+            if data.get('direction') == 'inbound' and started is not None:
+                delivery.record(time.perf_counter() - started)
+
+        @client.on('message_status_update')
+        def on_status(data):
+            if data.get('status') not in ('sent', 'failed'):
+                return
+            # Every subscriber sees the event; count it once
+            started = queued_at.pop(data.get('tempId'), None)
+            if started is not None:
+                dispatch.record(time.perf_counter() - started, data['status'] == 'sent')
+
+        # Without sticky sessions, polling requests can land on another worker
+        client.connect(base_url, wait_timeout=10, transports=['websocket'] if args.workers > 1 else None)
+        clients.append(client)
+
+    def webhook_worker():
+        http = requests.Session()
+        while not stop.is_set():
+            token = uuid.uuid4().hex[:12]
+            payload = webhook_payload(random.choice(phones), f"benchmark message {token}")
+            start = time.perf_counter()
+            sent_at[token] = start
+            try:
+                body, headers = signed_webhook(payload, BENCH_APP_SECRET)
+                ok = http.post(f"{base_url}/api/webhook", data=body, headers=headers, timeout=10).ok
+            except requests.RequestException:
+                ok = False
+            scenarios['webhook'].record(time.perf_counter() - start, ok)
+
+    def send_worker():
+        http = requests.Session()
+        while not stop.is_set():
+            temp_id = f"bench_{uuid.uuid4().hex}"
+            payload = {'phone': random.choice(phones), 'message': 'benchmark reply', 'userId': 'bench', 'tempId': temp_id}
+            start = time.perf_counter()
+            queued_at[temp_id] = start
+            try:
+                response = http.post(f"{base_url}/api/send-message", json=payload, timeout=10)
+                ok = response.ok and response.json().get('success', False)
+            except (requests.RequestException, ValueError):
+                ok = False
+            scenarios['send'].record(time.perf_counter() - start, ok)
+
+            if ok and random.random() < args.resend_ratio:
+                # A client retry: must come back 200 with the stored message, not queue a second send
+                start = time.perf_counter()
+                try:
+                    response = http.post(f"{base_url}/api/send-message", json=payload, timeout=10)
+                    ok = response.status_code == 200 and response.json().get('tempId') == temp_id
+                except (requests.RequestException, ValueError):
+                    ok = False
+                resends.record(time.perf_counter() - start, ok)
+
+    def read_worker(name, path_fn):
+        http = requests.Session()
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                ok = http.get(f"{base_url}{path_fn()}", timeout=10).ok
+            except requests.RequestException:
+                ok = False
+            scenarios[name].record(time.perf_counter() - start, ok)
+
+    workers = [threading.Thread(target=webhook_worker) for _ in range(args.webhook_workers)]
+    workers += [threading.Thread(target=send_worker) for _ in range(args.senders)]
+    workers += [
+        threading.Thread(target=read_worker, args=('chats', lambda: '/api/chats'))
+        for _ in range(args.chat_readers)
+    ]
+    workers += [
+        threading.Thread(target=read_worker, args=('messages', lambda: f"/api/messages/{random.choice(phones)}"))
+        for _ in range(args.message_readers)
+    ]
+
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    time.sleep(args.duration)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    # Let in-flight events arrive before disconnecting
+    time.sleep(1)
+    for client in clients:
+        client.disconnect()
+
+    results = {name: scenario.summary(elapsed) for name, scenario in scenarios.items()}
+    results['send_dispatch_lag'] = dispatch.summary(elapsed)
+    results['send_dispatch_lag']['undispatched'] = len(queued_at)
+    results['send_resend'] = resends.summary(elapsed)
+    lag = delivery.summary(elapsed)
+    expected = len(sent_at) * len(clients)
+    results['socket_delivery_lag'] = {
+        'events': lag['requests'],
+        'delivered_ratio': round(lag['requests'] / expected, 4) if expected else None,
+        'p50_ms': lag['p50_ms'],
+        'p95_ms': lag['p95_ms'],
+        'p99_ms': lag['p99_ms']
+    }
+    return results
+
+def compare(results, baseline, tolerance):
+    """Print deltas against the baseline and return the list of regressions"""
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        for key in ('throughput', 'p50_ms', 'p99_ms'):
+            old, new = previous.get(key), current.get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = change < -tolerance if key == 'throughput' else change > tolerance
+            print(f"  {name:22s} {key:10s} {old:>10} -> {new:>10} ({change:+.1%}){'  REGRESSION' if worse else ''}")
+            if worse:
+                regressions.append(f"{name}.{key}")
+    return regressions
+
+def run_server(args, server, extra_env):
+    """Start everything, run the load against one server mode and tear down"""
+    workdir = tempfile.mkdtemp(prefix='crm-bench-')
+    processes = []
+    try:
+        mongodb_uri = args.mongodb_uri
+        if not mongodb_uri:
+            mongod, mongodb_uri = start_mongod(args.mongod, workdir)
+            processes.append(mongod)
+        stub_server, stub_url = start_stubs()
+        app_port = free_port()
+        simulator, graph_url, graph_stats = start_simulator(
+            config_from_args(args, webhook_url=f"http://127.0.0.1:{app_port}/api/webhook",
+                             app_secret=BENCH_APP_SECRET)
+        )
+        app, base_url = start_app(app_port, mongodb_uri, graph_url, stub_url, extra_env, server, args.workers)
+        processes.append(app)
+
+        results = run_load(base_url, args)
+        results['graph_simulator'] = graph_stats.snapshot()
+        simulator.shutdown()
+        stub_server.shutdown()
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='CRM backend load test')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--phones', type=int, default=200, help='distinct conversations')
+    parser.add_argument('--webhook-workers', type=int, default=8)
+    parser.add_argument('--chat-readers', type=int, default=4)
+    parser.add_argument('--message-readers', type=int, default=8)
+    parser.add_argument('--senders', type=int, default=2, help='agents sending via /api/send-message')
+    parser.add_argument('--resend-ratio', type=float, default=0.1,
+                        help='share of sends posted again with the same tempId')
+    parser.add_argument('--subscribers', type=int, default=10, help='Socket.IO clients')
+    parser.add_argument('--mongod', default=shutil.which('mongod') or 'mongod', help='mongod binary')
+    parser.add_argument('--mongodb-uri', help='use this server instead of spawning mongod')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    parser.add_argument('--output', help='also write results to this JSON file')
+    parser.add_argument('--server', choices=['eventlet', 'asgi', 'both'], default='eventlet',
+                        help='app serving mode; both compares ASGI against eventlet')
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn worker processes for --server asgi')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='extra environment for the app, e.g. --env ANALYTICS_ROLLUP_INTERVAL=0')
+    add_simulator_arguments(parser)
+    args = parser.parse_args()
+
+    extra_env = dict(item.split('=', 1) for item in args.env)
+    if args.server == 'both':
+        results = run_server(args, 'eventlet', extra_env)
+        asgi_results = run_server(args, 'asgi', extra_env)
+        print(json.dumps({'eventlet': results, 'asgi': asgi_results}, indent=2))
+        print("ASGI compared with eventlet:")
+        compare(asgi_results, results, args.tolerance)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'eventlet': results, 'asgi': asgi_results}, f, indent=2)
+        return 0
+
+    results = run_server(args, args.server, extra_env)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.baseline}:")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,50 @@
+"""Stub customers API for benchmarks.
+
+Answers instantly from memory so measurements only reflect the CRM backend.
+The Graph API is served by graph_simulator.py. Run standalone with `python benchmarks/stubs.py --port 5900`.
+"""
+
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CUSTOMERS = [
+    {'id': i, 'name': f'Customer {i}', 'phone': f'9190000{i:05d}'}
+    for i in range(500)
+]
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith('/customers'):
+            self._reply(200, CUSTOMERS)
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stubs(port=0):
+    """Serve the stubs on a background thread. Returns (server, base_url)."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=5900)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), StubHandler)
+    print(f"Stubs listening on http://127.0.0.1:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,128 @@
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# Where downloaded media is kept.
+#
+# BLOB_STORE: local (default) or s3
+# BLOB_STORE_PATH: root directory for the local store
+# BLOB_STORE_BUCKET / BLOB_STORE_ENDPOINT_URL: bucket and endpoint for S3 or an
+#   S3-compatible server such as MinIO (credentials come from the usual AWS_* env)
+BLOB_STORE = os.getenv('BLOB_STORE', 'local').lower()
+BLOB_STORE_PATH = os.getenv('BLOB_STORE_PATH', 'media')
+BLOB_STORE_BUCKET = os.getenv('BLOB_STORE_BUCKET', 'whatsapp-crm-media')
+BLOB_STORE_ENDPOINT_URL = os.getenv('BLOB_STORE_ENDPOINT_URL')
+
+BLOB_CHUNK_SIZE = 64 * 1024
+
+class LocalBlobStore:
+    """Blobs as files under a root directory"""
+
+    def __init__(self, root=BLOB_STORE_PATH):
+        self.root = root
+
+    def _path(self, key):
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError(f'Invalid blob key: {key}')
+        return path
+
+    def put_stream(self, key, chunks, content_type=None):
+        """Write an iterable of byte chunks; returns the number of bytes stored"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = 0
+        # Write to a temporary file so readers never see a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return size
+
+    def open(self, key):
+        """Binary file object for reading the blob"""
+        return open(self._path(key), 'rb')
+
+    def iter_chunks(self, key, chunk_size=BLOB_CHUNK_SIZE):
+        with self.open(key) as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+class _ChunkReader:
+    """File-like read() over an iterator of chunks, for boto3's streaming upload"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+        self.size = 0
+
+    def read(self, size=-1):
+        parts = [self._buffer]
+        available = len(self._buffer)
+        while size < 0 or available < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            parts.append(chunk)
+            available += len(chunk)
+            self.size += len(chunk)
+        data = b''.join(parts)
+        if 0 <= size < len(data):
+            data, self._buffer = data[:size], data[size:]
+        else:
+            self._buffer = b''
+        return data
+
+class S3BlobStore:
+    """Blobs in an S3 bucket or S3-compatible server (needs boto3)"""
+
+    def __init__(self, bucket=BLOB_STORE_BUCKET, endpoint_url=BLOB_STORE_ENDPOINT_URL):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError('BLOB_STORE=s3 requires boto3 (pip install boto3)')
+        self.bucket = bucket
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+
+    def put_stream(self, key, chunks, content_type=None):
+        reader = _ChunkReader(chunks)
+        extra = {'ContentType': content_type} if content_type else None
+        # upload_fileobj reads in parts and uses multipart uploads for large blobs
+        self.client.upload_fileobj(reader, self.bucket, key, ExtraArgs=extra)
+        return reader.size
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+
+    def iter_chunks(self, key, chunk_size=BLOB_CHUNK_SIZE):
+        body = self.open(key)
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except self.client.exceptions.ClientError:
+            return False
+
+def create_blob_store():
+    if BLOB_STORE == 's3':
+        return S3BlobStore()
+    return LocalBlobStore()
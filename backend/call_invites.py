@@ -0,0 +1,88 @@
+import logging
+import os
+import smtplib
+import uuid
+from datetime import datetime, timedelta
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+import pytz
+from icalendar import Calendar, Event
+
+logger = logging.getLogger(__name__)
+
+# Calendar invites for scheduled onboarding calls. Both steps are slow enough
+# to hold up a request (SMTP round trips, icalendar serialization), so the app
+# runs them on its bounded executors.
+
+SMTP_SERVER = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
+SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
+SMTP_USER = os.getenv('SMTP_USER')
+SMTP_PASS = os.getenv('SMTP_PASS')
+# Per socket operation; a hung SMTP server can't hold an email worker forever
+SMTP_TIMEOUT = float(os.getenv('SMTP_TIMEOUT', 20))
+
+def build_call_ics(name, phone, call_date, notes='', email=None):
+    """ICS bytes for an onboarding call"""
+    cal = Calendar()
+    cal.add('prodid', '-//WhatsApp CRM//Onboarding Call//')
+    cal.add('version', '2.0')
+
+    event = Event()
+    event.add('summary', f'Onboarding Call with {name}')
+    event.add('dtstart', call_date)
+    event.add('dtend', call_date + timedelta(hours=1))
+    event.add('dtstamp', datetime.now(pytz.timezone('Asia/Kolkata')))
+    event.add('uid', str(uuid.uuid4()))
+    event.add('description', f'Onboarding call with {name}\\nPhone: {phone}\\n\\nNotes:\\n{notes}')
+    event.add('location', f'WhatsApp Call to {phone}')
+    if email:
+        event.add('attendee', f'mailto:{email}')
+
+    cal.add_component(event)
+    return cal.to_ical()
+
+def send_call_invite_email(email, name, phone, formatted_date, notes, ics):
+    """Email the invite with the ICS attached. Returns (sent, error)."""
+    logger.debug("Email config - server: %s, port: %s, user: %s, pass configured: %s",
+                 SMTP_SERVER, SMTP_PORT, SMTP_USER, bool(SMTP_PASS))
+
+    if not (SMTP_USER and SMTP_PASS):
+        logger.info("Email not configured - skipping email sending")
+        return False, "Email not configured in environment variables"
+
+    msg = MIMEMultipart()
+    msg['From'] = SMTP_USER
+    msg['To'] = email
+    msg['Subject'] = f'Calendar Invite: Onboarding Call with {name}'
+
+    body = f'''You have scheduled an onboarding call with {name}.
+
+Date & Time: {formatted_date}
+Phone: {phone}
+
+Notes:
+{notes if notes else 'No additional notes'}
+
+The calendar invite is attached to this email.'''
+
+    msg.attach(MIMEText(body, 'plain'))
+
+    attach = MIMEBase('text', 'calendar')
+    attach.set_payload(ics)
+    encoders.encode_base64(attach)
+    attach.add_header('Content-Disposition', f'attachment; filename="call_with_{name}.ics"')
+    msg.attach(attach)
+
+    try:
+        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT) as server:
+            server.starttls()
+            server.login(SMTP_USER, SMTP_PASS)
+            server.send_message(msg)
+    except Exception as e:
+        logger.warning("Error sending email: %s", e)
+        return False, str(e)
+
+    logger.info("Calendar invite emailed for %s", phone)
+    return True, None
@@ -28,4 +28,5 @@ echo "Don't forget to set your environment variables in Cloud Run console:"
 echo "- MONGODB_URI or MONGO_PUBLIC_URL"
 echo "- WHATSAPP_API_TOKEN"
 echo "- WHATSAPP_PHONE_NUMBER_ID"
+echo "- WHATSAPP_APP_SECRET (webhooks are refused without it)"
 echo "- SECRET_KEY"
\ No newline at end of file
@@ -0,0 +1,117 @@
+import logging
+import os
+import time
+import eventlet
+from eventlet import tpool
+from eventlet.semaphore import Semaphore
+
+from metrics import EXECUTOR_ACTIVE, EXECUTOR_QUEUE_DEPTH, EXECUTOR_REJECTED, EXECUTOR_WAIT
+from tracing import carry_context
+
+logger = logging.getLogger(__name__)
+
+# Bounded executors for slow or CPU-bound work on the eventlet app's request path.
+#
+# Each executor runs at most `workers` jobs at once and queues at most
+# `max_queue` more; beyond that submit() raises Saturated and the request is
+# answered 503 straight away instead of tying up the worker behind a slow
+# SMTP server or partner API. call() raises ExecutorTimeout, an ordinary
+# exception rather than eventlet's BaseException Timeout, when a job overruns
+# its deadline. Network-bound jobs run as green threads (their
+# sockets are already cooperative), CPU-bound ones in eventlet's OS thread
+# pool so they can't stall the hub.
+
+EMAIL_WORKERS = int(os.getenv('EMAIL_WORKERS', 2))
+EMAIL_QUEUE_SIZE = int(os.getenv('EMAIL_QUEUE_SIZE', 8))
+EXTERNAL_API_WORKERS = int(os.getenv('EXTERNAL_API_WORKERS', 4))
+EXTERNAL_API_QUEUE_SIZE = int(os.getenv('EXTERNAL_API_QUEUE_SIZE', 16))
+CPU_WORKERS = int(os.getenv('CPU_WORKERS', 4))
+CPU_QUEUE_SIZE = int(os.getenv('CPU_QUEUE_SIZE', 32))
+
+# Suggested client back-off when an executor sheds load
+SATURATED_RETRY_AFTER = 5
+
+class Saturated(Exception):
+    """An executor's workers and queue are all taken"""
+
+    def __init__(self, executor):
+        super().__init__(f'{executor} executor is saturated')
+        self.executor = executor
+
+class ExecutorTimeout(Exception):
+    """A job didn't finish within the caller's deadline"""
+
+    def __init__(self, executor, timeout):
+        super().__init__(f'{executor} executor job timed out after {timeout}s')
+        self.executor = executor
+        self.timeout = timeout
+
+class BoundedExecutor:
+    """Runs jobs with bounded concurrency and a bounded queue.
+
+    Only touched from green threads of the one hub, so the counters need no lock.
+    """
+
+    def __init__(self, name, workers, max_queue, threads=False):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.threads = threads
+        self._slots = Semaphore(workers)
+        self._pending = 0
+        self._active = 0
+
+    def _update_gauges(self):
+        EXECUTOR_ACTIVE.labels(self.name).set(self._active)
+        EXECUTOR_QUEUE_DEPTH.labels(self.name).set(self._pending - self._active)
+
+    def saturated(self):
+        return self._pending >= self.workers + self.max_queue
+
+    def submit(self, func, *args, **kwargs):
+        """Queue `func`; returns its GreenThread (wait() for the result)"""
+        if self.saturated():
+            EXECUTOR_REJECTED.labels(self.name).inc()
+            raise Saturated(self.name)
+        self._pending += 1
+        self._update_gauges()
+        enqueued = time.perf_counter()
+
+        def run():
+            try:
+                with self._slots:
+                    EXECUTOR_WAIT.labels(self.name).observe(time.perf_counter() - enqueued)
+                    self._active += 1
+                    self._update_gauges()
+                    try:
+                        if self.threads:
+                            return tpool.execute(func, *args, **kwargs)
+                        return func(*args, **kwargs)
+                    finally:
+                        self._active -= 1
+            finally:
+                self._pending -= 1
+                self._update_gauges()
+
+        return eventlet.spawn(carry_context(run))
+
+    def call(self, func, *args, timeout=None, **kwargs):
+        """Run `func` and wait for its result.
+
+        Raises Saturated without waiting when full, and ExecutorTimeout after
+        `timeout` seconds; a timed-out job keeps its slot until it finishes.
+        """
+        job = self.submit(func, *args, **kwargs)
+        timer = eventlet.Timeout(timeout)
+        try:
+            return job.wait()
+        except eventlet.Timeout as e:
+            if e is not timer:
+                raise
+            raise ExecutorTimeout(self.name, timeout) from None
+        finally:
+            timer.cancel()
+
+email_executor = BoundedExecutor('email', EMAIL_WORKERS, EMAIL_QUEUE_SIZE)
+external_api_executor = BoundedExecutor('external_api', EXTERNAL_API_WORKERS, EXTERNAL_API_QUEUE_SIZE)
+cpu_executor = BoundedExecutor('cpu', CPU_WORKERS, CPU_QUEUE_SIZE, threads=True)
@@ -0,0 +1,127 @@
+import csv
+import json
+import os
+from datetime import datetime
+
+from activity_log import format_activity_log
+
+# Documents fetched from Mongo per getMore while streaming an export
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+
+# Rows are buffered into chunks of roughly this many bytes before being yielded,
+# so the response isn't written one tiny chunk per row
+EXPORT_CHUNK_BYTES = int(os.getenv('EXPORT_CHUNK_BYTES', 64 * 1024))
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson'
+}
+
+REFERRAL_EXPORT_FIELDS = [
+    'id', 'name', 'phone', 'referredBy', 'status', 'subscriptionStatus',
+    'hasSubscription', 'createdAt', 'lastMessageAt'
+]
+
+ACTIVITY_LOG_EXPORT_FIELDS = [
+    'id', 'action', 'userId', 'userName', 'userEmail', 'phone', 'message',
+    'timestamp', 'status', 'details'
+]
+
+MESSAGE_EXPORT_FIELDS = [
+    'id', 'phone', 'timestamp', 'direction', 'message', 'messageType', 'status',
+    'whatsappMessageId', 'buttonId', 'sentBy', 'sentByName'
+]
+
+MESSAGE_EXPORT_PROJECTION = {
+    'phone': 1, 'timestamp': 1, 'direction': 1, 'message': 1, 'messageType': 1,
+    'status': 1, 'whatsappMessageId': 1, 'buttonId': 1, 'sentBy': 1, 'sentByName': 1
+}
+
+class _LineBuffer:
+    """File-like object that hands back whatever csv.writer writes"""
+    def write(self, value):
+        return value
+
+def _isoformat(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def referral_export_row(user):
+    return {
+        'id': str(user['_id']),
+        'name': user.get('name', 'Unknown'),
+        'phone': user.get('phone'),
+        'referredBy': user.get('referredBy'),
+        'status': user.get('status', 'new'),
+        'subscriptionStatus': user.get('subscriptionStatus', 'none'),
+        'hasSubscription': user.get('subscriptionStatus') == 'active',
+        'createdAt': _isoformat(user.get('createdAt')),
+        'lastMessageAt': _isoformat(user.get('lastMessageAt'))
+    }
+
+def message_export_row(msg):
+    return {
+        'id': str(msg['_id']),
+        'phone': msg.get('phone'),
+        'timestamp': _isoformat(msg.get('timestamp')),
+        'direction': msg.get('direction'),
+        'message': msg.get('message'),
+        'messageType': msg.get('messageType', 'text'),
+        'status': msg.get('status'),
+        'whatsappMessageId': msg.get('whatsappMessageId'),
+        'buttonId': msg.get('buttonId'),
+        'sentBy': msg.get('sentBy'),
+        'sentByName': msg.get('sentByName')
+    }
+
+activity_log_export_row = format_activity_log
+
+def _csv_lines(rows, fields):
+    writer = csv.writer(_LineBuffer())
+    yield writer.writerow(fields)
+    for row in rows:
+        values = []
+        for field in fields:
+            value = row.get(field)
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value, default=str)
+            values.append('' if value is None else value)
+        yield writer.writerow(values)
+
+def _ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row, default=str) + '\n'
+
+def stream_export(cursor, row_fn, fields, fmt):
+    """Yield an export of `cursor` in `fmt` without materializing the result.
+
+    The cursor is closed when the generator finishes or the client goes away.
+    """
+    cursor.batch_size(EXPORT_BATCH_SIZE)
+    rows = (row_fn(doc) for doc in cursor)
+    lines = _csv_lines(rows, fields) if fmt == 'csv' else _ndjson_lines(rows)
+
+    try:
+        chunk = []
+        chunk_size = 0
+        for line in lines:
+            chunk.append(line)
+            chunk_size += len(line)
+            if chunk_size >= EXPORT_CHUNK_BYTES:
+                yield ''.join(chunk)
+                chunk = []
+                chunk_size = 0
+        if chunk:
+            yield ''.join(chunk)
+    finally:
+        cursor.close()
+
+def export_headers(name, fmt):
+    """Response headers for a streamed export download"""
+    timestamp = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+    extension = 'csv' if fmt == 'csv' else 'ndjson'
+    return {
+        'Content-Disposition': f'attachment; filename={name}-{timestamp}.{extension}',
+        'Cache-Control': 'no-store',
+        # Stop proxies from buffering the whole stream
+        'X-Accel-Buffering': 'no'
+    }
@@ -0,0 +1,38 @@
+import os
+
+# Onboarding group invites, posted to the partner WhatsApp API. The eventlet
+# app sends them with requests on its external API executor, the ASGI app
+# with httpx; both build the request here.
+
+INVITE_API_URL = 'https://faff-api-251644788910.asia-south1.run.app/api/whatsapp/message'
+# Overall budget for an invite, retries included
+INVITE_API_DEADLINE = float(os.getenv('INVITE_API_DEADLINE', 60))
+INVITE_API_TIMEOUT = 30
+# Retried up to 3 times with backoff
+INVITE_API_RETRIES = 3
+INVITE_API_RETRY_STATUSES = (429, 500, 502, 503, 504)
+INVITE_API_PARAMS = {
+    'fallback': 'false',
+    'internal': 'false'
+}
+INVITE_API_HEADERS = {
+    'accept': 'application/json',
+    'Content-Type': 'application/json',
+    'User-Agent': 'Mozilla/5.0 (compatible; Python-Requests)'
+}
+
+def invite_payload(name, phone, referrer_name=''):
+    """Partner API body: "OnboardingTest, {name}, {phone}, Ask[, {referrer}]" to the onboarding group"""
+    if referrer_name:
+        message_body = f"OnboardingTest, {name}, {phone}, Ask, {referrer_name}"
+    else:
+        message_body = f"OnboardingTest, {name}, {phone}, Ask"
+    return {
+        "to": "120363333602342373@g.us",  # Will be modified to correct format if needed
+        "body": message_body,
+        "task_number": "0"
+    }
+
+def duplicate_group_name(name, customers):
+    """True when a customer group already has `name` (case-insensitive)"""
+    return name.lower() in [c.get('name', '').lower() for c in customers]
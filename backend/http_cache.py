@@ -0,0 +1,126 @@
+import gzip
+import hashlib
+import os
+
+from flask import Response, request
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Compression and conditional GET for the large list endpoints.
+#
+# Bodies of at least COMPRESS_MIN_BYTES are sent br (when the brotli module is
+# installed) or gzip encoded, per Accept-Encoding. Every response carries a
+# strong ETag; encoded variants get the encoding appended, as they are
+# different bytes, and a matching If-None-Match on any variant returns 304.
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', 5))
+
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+def body_etag(body):
+    """Strong validator derived from the body bytes"""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+def compress(body, encoding, precomputed=False):
+    """Encode `body`; precomputed bodies get the slower, denser settings"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=11 if precomputed else BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=9 if precomputed else GZIP_LEVEL)
+
+def negotiate_encoding(accept_encoding):
+    """Preferred encoding the client accepts, from an Accept-Encoding value"""
+    accepted = parse_accept_header(accept_encoding)
+    for encoding in ENCODINGS:
+        if accepted[encoding]:
+            return encoding
+    return None
+
+class PrecompressedBody:
+    """A response body encoded once up front, for data that changes rarely"""
+
+    def __init__(self, body):
+        self.body = body
+        self.etag = body_etag(body)
+        self.encoded = {}
+        if len(body) >= COMPRESS_MIN_BYTES:
+            self.encoded = {encoding: compress(body, encoding, precomputed=True) for encoding in ENCODINGS}
+
+def _matching_etag(etag, if_none_match):
+    """The variant of `etag` named in an If-None-Match value, if any"""
+    if not if_none_match:
+        return None
+    tags = parse_etags(if_none_match)
+    for tag in (etag,) + tuple(f"{etag}-{encoding}" for encoding in ENCODINGS):
+        if tags.contains(tag):
+            return tag
+    return None
+
+def not_modified_headers(etag, if_none_match):
+    """304 headers when If-None-Match names a variant of `etag`, otherwise None.
+
+    For validators known before the body is built: check first and skip the
+    queries on a match.
+    """
+    matched = _matching_etag(etag, if_none_match) if etag else None
+    if matched:
+        return {'Vary': 'Accept-Encoding', 'ETag': quote_etag(matched)}
+    return None
+
+def encode_response(body, if_none_match, accept_encoding, etag=None, precompressed=None):
+    """Status, body bytes and headers for a conditional, compressed response.
+
+    Framework independent; the Flask app uses conditional_response() and the
+    ASGI app wraps this directly. `etag` defaults to a hash of the body; pass
+    one derived from a cache version to skip hashing. `precompressed` is a
+    PrecompressedBody for `body`.
+    """
+    if precompressed is not None:
+        etag = precompressed.etag
+    elif etag is None:
+        etag = body_etag(body)
+
+    headers = not_modified_headers(etag, if_none_match)
+    if headers:
+        return 304, b'', headers
+    headers = {'Vary': 'Accept-Encoding'}
+
+    encoding = negotiate_encoding(accept_encoding)
+    data = body
+    if encoding:
+        if precompressed is not None:
+            data = precompressed.encoded.get(encoding, body)
+        elif len(body) >= COMPRESS_MIN_BYTES:
+            data = compress(body, encoding)
+    if data is body:
+        encoding = None
+
+    headers['ETag'] = quote_etag(f"{etag}-{encoding}" if encoding else etag)
+    # Let browsers keep the copy but always revalidate
+    headers['Cache-Control'] = 'no-cache'
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return 200, data, headers
+
+def conditional_response(body, etag=None, mimetype='application/json', precompressed=None):
+    """Serve `body` with an ETag, a 304 when the client's copy is current,
+    and Content-Encoding when negotiated"""
+    status, data, headers = encode_response(
+        body,
+        request.headers.get('If-None-Match'),
+        request.headers.get('Accept-Encoding'),
+        etag=etag,
+        precompressed=precompressed
+    )
+    if status == 304:
+        return Response(status=304, headers=headers)
+    return Response(data, status=status, headers=headers, mimetype=mimetype)
+
+def not_modified(etag):
+    """A 304 response when the client's copy matches `etag`, otherwise None"""
+    headers = not_modified_headers(etag, request.headers.get('If-None-Match'))
+    return Response(status=304, headers=headers) if headers else None
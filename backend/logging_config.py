@@ -0,0 +1,135 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+# LOG_LEVEL: DEBUG, INFO, WARNING, ERROR (anything else falls back to INFO)
+# LOG_FORMAT: json (default) or text for local development
+# LOG_SAMPLE_RATES: comma separated event=rate pairs, e.g.
+#   "webhook.received=0.1,message.status=0.05"
+# Records logged with extra={'event': ...} are kept with that probability.
+# Warnings and errors are never sampled out.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', '')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+
+_traceback_formatter = logging.Formatter()
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the record's `extra` fields merged in"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        # Queued records carry their traceback as text (see _DroppingQueueHandler.prepare)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class SamplingFilter(logging.Filter):
+    """Drops a fraction of high-volume events by their `event` name"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, 'event', None))
+        return rate is None or random.random() < rate
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the caller: records are dropped when the queue is full"""
+
+    def prepare(self, record):
+        """Make the record safe to hand to another thread, leaving the formatting to the listener.
+
+        The stdlib version formats the whole record here and folds the
+        traceback into msg. Only the message arguments are merged and the
+        traceback rendered to exc_text, as neither may outlive the call.
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _traceback_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+def parse_sample_rates(value):
+    rates = {}
+    for pair in value.split(','):
+        if '=' not in pair:
+            continue
+        event, rate = pair.split('=', 1)
+        try:
+            rates[event.strip()] = float(rate)
+        except ValueError:
+            continue
+    return rates
+
+_listener = None
+
+def setup_logging():
+    """Route all logging through a queue to a single stdout writer thread.
+
+    Request handlers only pay for building the record, merging its message
+    arguments and rendering any traceback; formatting and the blocking stdout
+    write happen on the listener thread.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    output = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'text':
+        output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    else:
+        output.setFormatter(JsonFormatter())
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = _DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(parse_sample_rates(LOG_SAMPLE_RATES)))
+
+    level = logging.getLevelName(LOG_LEVEL)
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level if isinstance(level, int) else logging.INFO)
+
+    # Socket.IO/Engine.IO and werkzeug are chatty at INFO
+    for name in ('engineio.server', 'socketio.server', 'werkzeug'):
+        logging.getLogger(name).setLevel(max(logging.WARNING, root.level))
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+    _listener.start()
+    atexit.register(_listener.stop)
+    if not isinstance(level, int):
+        logging.getLogger(__name__).warning("Unknown LOG_LEVEL %r, logging at INFO", LOG_LEVEL)
+    return _listener
@@ -0,0 +1,195 @@
+import io
+import logging
+import os
+import shutil
+import tempfile
+from datetime import datetime
+import pytz
+
+from blob_store import BLOB_CHUNK_SIZE, create_blob_store
+from message_archive import mark_conversation_changed
+from tenants import emit_to_tenant, tenants
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Inbound media (images, documents, audio, video, stickers) is downloaded from
+# the Graph media endpoint in the background and streamed into the blob store.
+# Message documents carry a `media` sub-document:
+#
+#   {'type': 'image', 'id': <graph media id>, 'mimeType': ..., 'caption': ...,
+#    'filename': ..., 'status': 'pending'|'stored'|'failed', 'blobKey': ...,
+#    'size': int, 'thumbnailKey': ...}
+#
+# The API only hands out /api/media/<message id> URLs; content is never inlined.
+#
+# Nothing here depends on the serving mode: the eventlet app queues downloads
+# through its task registry (whatsapp_handler.py) and the ASGI app runs them
+# in worker threads (whatsapp_async.py). Each passes the way to run CPU-bound
+# thumbnailing off its event loop.
+
+MEDIA_TYPES = ('image', 'document', 'audio', 'video', 'sticker')
+
+# Thumbnails are made for images up to this size
+MEDIA_THUMBNAIL_SIZE = int(os.getenv('MEDIA_THUMBNAIL_SIZE', 320))
+MEDIA_THUMBNAIL_MAX_BYTES = int(os.getenv('MEDIA_THUMBNAIL_MAX_BYTES', 10 * 1024 * 1024))
+# ...and up to this many pixels, so a small file can't decode into a huge bitmap
+MEDIA_THUMBNAIL_MAX_PIXELS = int(os.getenv('MEDIA_THUMBNAIL_MAX_PIXELS', 50_000_000))
+# Concurrent downloads
+MEDIA_DOWNLOAD_CONCURRENCY = int(os.getenv('MEDIA_DOWNLOAD_CONCURRENCY', 8))
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+blob_store = create_blob_store()
+
+_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/webp': '.webp',
+    'audio/ogg': '.ogg',
+    'audio/mpeg': '.mp3',
+    'video/mp4': '.mp4',
+    'application/pdf': '.pdf'
+}
+
+def parse_media(message_type, message_data):
+    """Media sub-document for a webhook message, or None for non-media types"""
+    if message_type not in MEDIA_TYPES:
+        return None
+    media = message_data.get(message_type, {})
+    return {
+        'type': message_type,
+        'id': media.get('id'),
+        'mimeType': media.get('mime_type'),
+        'sha256': media.get('sha256'),
+        'caption': media.get('caption'),
+        'filename': media.get('filename'),
+        'status': 'pending'
+    }
+
+def describe_media(media):
+    """Text stored as the message body for a media message"""
+    if media.get('caption'):
+        return media['caption']
+    if media.get('filename'):
+        return f"[{media['type']}] {media['filename']}"
+    return f"[{media['type']}]"
+
+def media_urls(message_id, media):
+    """Lazy URLs for a message's media, as returned by /api/messages"""
+    if not media:
+        return None
+    return {
+        'type': media.get('type'),
+        'mimeType': media.get('mimeType'),
+        'caption': media.get('caption'),
+        'filename': media.get('filename'),
+        'size': media.get('size'),
+        'status': media.get('status'),
+        'url': f"/api/media/{message_id}",
+        'thumbnailUrl': f"/api/media/{message_id}?thumbnail=1" if media.get('thumbnailKey') else None
+    }
+
+def _blob_key(message_id, mime_type, suffix=''):
+    day = datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%Y/%m/%d')
+    return f"{day}/{message_id}{suffix}{_EXTENSIONS.get(mime_type, '')}"
+
+def _make_thumbnail(source):
+    """JPEG thumbnail bytes from a seekable image file; CPU bound"""
+    with Image.open(source) as image:
+        # Only the header has been read so far
+        if image.width * image.height > MEDIA_THUMBNAIL_MAX_PIXELS:
+            raise ValueError(f'image is {image.width}x{image.height} pixels')
+        # JPEGs decode straight at a reduced scale
+        image.draft('RGB', (MEDIA_THUMBNAIL_SIZE, MEDIA_THUMBNAIL_SIZE))
+        image.thumbnail((MEDIA_THUMBNAIL_SIZE, MEDIA_THUMBNAIL_SIZE))
+        output = io.BytesIO()
+        image.convert('RGB').save(output, 'JPEG', quality=80)
+        return output.getvalue()
+
+def call_directly(func, *args):
+    """run_cpu for callers already in a worker thread"""
+    return func(*args)
+
+def _open_seekable(key):
+    """The blob as a seekable file for Pillow; S3 bodies are spooled to a temporary file"""
+    source = blob_store.open(key)
+    if getattr(source, 'seekable', lambda: False)():
+        return source
+    spooled = tempfile.SpooledTemporaryFile(max_size=BLOB_CHUNK_SIZE * 16)
+    try:
+        shutil.copyfileobj(source, spooled, BLOB_CHUNK_SIZE)
+    except BaseException:
+        spooled.close()
+        raise
+    finally:
+        source.close()
+    spooled.seek(0)
+    return spooled
+
+def _store_thumbnail(db, message_id, key, size, run_cpu=call_directly):
+    if Image is None or size > MEDIA_THUMBNAIL_MAX_BYTES:
+        return
+    with _open_seekable(key) as source:
+        thumbnail = run_cpu(_make_thumbnail, source)
+    thumbnail_key = _blob_key(message_id, 'image/jpeg', '.thumb')
+    blob_store.put_stream(thumbnail_key, [thumbnail], 'image/jpeg')
+    db.messages.update_one({'_id': message_id}, {'$set': {'media.thumbnailKey': thumbnail_key}})
+
+def download_media(db, socketio, message_id, phone, media, tenant_id=None, run_cpu=call_directly):
+    """Fetch a message's media from Graph and stream it into the blob store.
+
+    Blocking. `run_cpu(func, *args)` makes the thumbnail, e.g. eventlet's
+    tpool.execute on the hub; the default calls it in the current thread.
+    """
+    # Imported here: whatsapp_messages imports this module
+    from whatsapp_messages import GRAPH_API_BASE_URL
+    # Media ids and URLs are only readable with the receiving number's token
+    session = tenants.get(tenant_id).session
+    
+    try:
+        with span('graph.media_lookup'):
+            info = session.get(f"{GRAPH_API_BASE_URL}/{media['id']}", timeout=10).json()
+        if 'url' not in info:
+            raise RuntimeError(info.get('error', info))
+
+        mime_type = info.get('mime_type') or media.get('mimeType')
+        key = _blob_key(message_id, mime_type)
+        with span('graph.media_download'):
+            with session.get(info['url'], stream=True, timeout=30) as response:
+                response.raise_for_status()
+                size = blob_store.put_stream(key, response.iter_content(BLOB_CHUNK_SIZE), mime_type)
+
+        db.messages.update_one({'_id': message_id}, {'$set': {
+            'media.status': 'stored',
+            'media.blobKey': key,
+            'media.mimeType': mime_type,
+            'media.size': size
+        }})
+        logger.info("Stored %s media for message %s (%d bytes)", media['type'], message_id, size,
+                    extra={'event': 'media.stored'})
+
+        if media['type'] == 'image':
+            try:
+                _store_thumbnail(db, message_id, key, size, run_cpu)
+            except Exception as e:
+                logger.warning("Could not create thumbnail for %s: %s", message_id, e)
+    except Exception as e:
+        logger.warning("Failed to download media for message %s: %s", message_id, e)
+        db.messages.update_one({'_id': message_id}, {'$set': {'media.status': 'failed', 'media.error': str(e)}})
+        status = 'failed'
+    else:
+        status = 'stored'
+    mark_conversation_changed(db, phone, tenant_id)
+
+    if socketio:
+        message = db.messages.find_one({'_id': message_id}, {'media': 1})
+        emit_to_tenant(socketio, 'media_ready', {
+            'phone': phone,
+            'messageId': str(message_id),
+            'status': status,
+            'media': media_urls(str(message_id), (message or {}).get('media'))
+        }, tenants.get(tenant_id).id)
@@ -0,0 +1,196 @@
+import logging
+import os
+from datetime import datetime, timedelta
+import pytz
+from pymongo import ASCENDING, DESCENDING, ReplaceOne, UpdateOne
+from pymongo.errors import CollectionInvalid, OperationFailure
+from http_cache import body_etag
+from tenants import conversation_key
+
+logger = logging.getLogger(__name__)
+
+# Tiered message storage. Messages older than MESSAGE_ARCHIVE_AFTER_DAYS are
+# moved from `messages` to `messages_archive`, a collection created with
+# zstd block compression, so the hot collection and its indexes stay small
+# enough to live in RAM. Conversation history reads page through the hot
+# messages first and continue into the archive (see message_page()).
+#
+# Per conversation, the users document keeps:
+#   {'archivedMessages': int,        # how many of its messages are archived
+#    'archivedLastMessage': str}     # newest archived text, for the chat list
+#
+# Conversation pages are validated without reading them (messages_etag()):
+# every write that changes what a page shows bumps the users document's
+# inboundSeq (new inbound messages) or messagesVersion (everything else:
+# outbound and auto-reply messages, delivery statuses, downloaded media).
+#
+# Messages are copied (upserted by _id) before they're deleted, so a crash
+# can leave a message in both tiers briefly but never in neither; the next run
+# finishes the move. Messages still in the send outbox are never archived.
+
+# 0 disables tiering
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.getenv('MESSAGE_ARCHIVE_AFTER_DAYS', 0))
+MESSAGE_ARCHIVE_INTERVAL = int(os.getenv('MESSAGE_ARCHIVE_INTERVAL', 3600))
+MESSAGE_ARCHIVE_BATCH_SIZE = int(os.getenv('MESSAGE_ARCHIVE_BATCH_SIZE', 1000))
+MESSAGE_ARCHIVE_COMPRESSOR = os.getenv('MESSAGE_ARCHIVE_COMPRESSOR', 'zstd')
+
+ARCHIVE_COLLECTION = 'messages_archive'
+
+def message_archive_enabled():
+    return MESSAGE_ARCHIVE_AFTER_DAYS > 0
+
+def ensure_message_archive(db):
+    """Create the compressed archive collection and the indexes tiering reads"""
+    if ARCHIVE_COLLECTION not in db.list_collection_names():
+        try:
+            db.create_collection(ARCHIVE_COLLECTION, storageEngine={
+                'wiredTiger': {'configString': f'block_compressor={MESSAGE_ARCHIVE_COMPRESSOR}'}
+            })
+        except CollectionInvalid:
+            pass
+        except OperationFailure as e:
+            # e.g. a server built without zstd; the default (snappy) still works
+            logger.warning("Could not create %s with %s compression: %s",
+                           ARCHIVE_COLLECTION, MESSAGE_ARCHIVE_COMPRESSOR, e)
+            db.create_collection(ARCHIVE_COLLECTION)
+
+    archive = db[ARCHIVE_COLLECTION]
+    archive.create_index([('tenantId', ASCENDING), ('phone', ASCENDING), ('timestamp', DESCENDING)])
+    # The tiering scan
+    db.messages.create_index([('timestamp', ASCENDING)])
+
+def archive_messages(db, batch_size=MESSAGE_ARCHIVE_BATCH_SIZE):
+    """Move messages older than MESSAGE_ARCHIVE_AFTER_DAYS to the archive. Returns how many moved."""
+    if not message_archive_enabled():
+        return 0
+
+    cutoff = datetime.now(pytz.timezone('Asia/Kolkata')) - timedelta(days=MESSAGE_ARCHIVE_AFTER_DAYS)
+    archive = db[ARCHIVE_COLLECTION]
+    archived = 0
+
+    while True:
+        messages = list(db.messages.find({'timestamp': {'$lt': cutoff}, 'queuedAt': {'$exists': False}})
+                        .sort('timestamp', ASCENDING)
+                        .limit(batch_size))
+        if not messages:
+            break
+
+        archive.bulk_write([ReplaceOne({'_id': msg['_id']}, msg, upsert=True) for msg in messages], ordered=False)
+
+        by_conversation = {}
+        for msg in messages:
+            by_conversation.setdefault((msg.get('tenantId'), msg['phone']), []).append(msg)
+
+        counters = []
+        for (tenant_id, phone), phone_messages in by_conversation.items():
+            deleted = db.messages.delete_many({'_id': {'$in': [msg['_id'] for msg in phone_messages]}}).deleted_count
+            if deleted:
+                counters.append(UpdateOne(conversation_key(phone, tenant_id), {
+                    '$inc': {'archivedMessages': deleted},
+                    # Batches are oldest first, so the last one wins
+                    '$set': {'archivedLastMessage': phone_messages[-1].get('message', '')}
+                }))
+            archived += deleted
+        if counters:
+            db.users.bulk_write(counters, ordered=False)
+
+    if archived:
+        logger.info("Archived %d messages to %s", archived, ARCHIVE_COLLECTION)
+    return archived
+
+def page_plan(hot_count, skip, limit):
+    """Split a newest-first page across the tiers.
+
+    Everything archived is older than everything hot, so the page is the
+    hot messages at `skip` followed by archived ones. Returns
+    ((hot_skip, hot_limit), (archive_skip, archive_limit)); a zero limit
+    means that tier isn't read.
+    """
+    hot_limit = max(0, min(limit, hot_count - skip))
+    archive_skip = max(0, skip - hot_count)
+    return (skip, hot_limit), (archive_skip, limit - hot_limit)
+
+# The users fields a conversation page's validator is derived from
+MESSAGES_VALIDATOR_PROJECTION = {'lastMessageAt': 1, 'inboundSeq': 1, 'messagesVersion': 1, 'archivedMessages': 1}
+
+def conversation_changed_update():
+    """users update recording that a conversation's messages changed"""
+    return {'$inc': {'messagesVersion': 1}}
+
+def mark_conversation_changed(db, phone, tenant_id=None):
+    db.users.update_one(conversation_key(phone, tenant_id), conversation_changed_update())
+
+def messages_etag(user, skip, limit):
+    """ETag of a message_page from its users document (MESSAGES_VALIDATOR_PROJECTION).
+
+    None without a users document: nothing tracks changes to such a
+    conversation, so its pages have to be hashed.
+    """
+    if user is None:
+        return None
+    last_message_at = user.get('lastMessageAt')
+    return body_etag('|'.join(str(part) for part in (
+        user['_id'],
+        last_message_at.isoformat() if last_message_at else '',
+        user.get('inboundSeq', 0),
+        user.get('messagesVersion', 0),
+        user.get('archivedMessages', 0),
+        skip,
+        limit
+    )).encode())
+
+def message_page(db, phone, skip, limit, projection, collection=lambda c: c, user=None, tenant_id=None):
+    """A newest-first page of a conversation across both tiers. Returns (messages, total).
+
+    `collection` wraps each collection before reading, e.g. read_collection.
+    `user` is the conversation's users document if already read.
+    """
+    conversation = conversation_key(phone, tenant_id)
+    hot_count = db.messages.count_documents(conversation)
+    if user is None:
+        user = db.users.find_one(conversation, {'archivedMessages': 1})
+    total = hot_count + (user or {}).get('archivedMessages', 0)
+
+    (hot_skip, hot_limit), (archive_skip, archive_limit) = page_plan(hot_count, skip, limit)
+    messages = []
+    if hot_limit:
+        messages += list(collection(db.messages).find(conversation, projection)
+                         .sort('timestamp', DESCENDING).skip(hot_skip).limit(hot_limit))
+    if archive_limit and total > hot_count:
+        messages += list(collection(db[ARCHIVE_COLLECTION]).find(conversation, projection)
+                         .sort('timestamp', DESCENDING).skip(archive_skip).limit(archive_limit))
+    return messages, total
+
+def find_message(db, query, projection=None):
+    """find_one on the hot messages, falling back to the archive"""
+    message = db.messages.find_one(query, projection)
+    if message is None:
+        message = db[ARCHIVE_COLLECTION].find_one(query, projection)
+    return message
+
+class ChainedCursor:
+    """Cursors read one after the other, with the cursor methods exports use"""
+
+    def __init__(self, *cursors):
+        self.cursors = cursors
+
+    def batch_size(self, size):
+        for cursor in self.cursors:
+            cursor.batch_size(size)
+        return self
+
+    def __iter__(self):
+        for cursor in self.cursors:
+            yield from cursor
+
+    def close(self):
+        for cursor in self.cursors:
+            cursor.close()
+
+def conversation_cursor(db, phone, projection, tenant_id=None):
+    """A whole conversation oldest first: the archived messages, then the hot ones"""
+    conversation = conversation_key(phone, tenant_id)
+    return ChainedCursor(
+        db[ARCHIVE_COLLECTION].find(conversation, projection).sort('timestamp', ASCENDING),
+        db.messages.find(conversation, projection).sort('timestamp', ASCENDING)
+    )
@@ -0,0 +1,210 @@
+import asyncio
+import functools
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from pymongo import monitoring
+
+# Prometheus metrics for the hot paths, served at /metrics
+
+HANDLER_LATENCY = Histogram(
+    'crm_handler_duration_seconds',
+    'Time spent in request handlers and message processing',
+    ['handler']
+)
+
+GRAPH_API_LATENCY = Histogram(
+    'crm_graph_api_duration_seconds',
+    'WhatsApp Graph API call latency',
+    ['operation']
+)
+
+GRAPH_API_ERRORS = Counter(
+    'crm_graph_api_errors_total',
+    'WhatsApp Graph API calls that failed',
+    ['operation', 'reason']
+)
+
+WEBHOOK_REJECTED = Counter(
+    'crm_webhook_rejected_total',
+    'Webhook deliveries answered without being processed',
+    ['reason']
+)
+
+CUSTOMERS_API_LATENCY = Histogram(
+    'crm_customers_api_duration_seconds',
+    'External customers API fetch latency'
+)
+
+CUSTOMERS_API_ERRORS = Counter(
+    'crm_customers_api_errors_total',
+    'External customers API fetches that failed'
+)
+
+MONGO_COMMAND_LATENCY = Histogram(
+    'crm_mongo_command_duration_seconds',
+    'MongoDB command latency by collection and command',
+    ['collection', 'command'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+)
+
+MONGO_COMMAND_FAILURES = Counter(
+    'crm_mongo_command_failures_total',
+    'MongoDB commands that failed',
+    ['collection', 'command']
+)
+
+CACHE_REQUESTS = Counter(
+    'crm_cache_requests_total',
+    'In-memory cache lookups',
+    ['cache', 'result']
+)
+
+SOCKETIO_EMITS = Counter(
+    'crm_socketio_emits_total',
+    'Socket.IO events emitted',
+    ['event']
+)
+
+SOCKETIO_DELIVERIES = Counter(
+    'crm_socketio_deliveries_total',
+    'Socket.IO events multiplied by the clients they were sent to',
+    ['event']
+)
+
+SOCKETIO_CLIENTS = Gauge(
+    'crm_socketio_connected_clients',
+    'Currently connected Socket.IO clients'
+)
+
+EXECUTOR_QUEUE_DEPTH = Gauge(
+    'crm_executor_queue_depth',
+    'Jobs waiting for a worker in a bounded executor',
+    ['executor']
+)
+
+EXECUTOR_ACTIVE = Gauge(
+    'crm_executor_active_jobs',
+    'Jobs currently running in a bounded executor',
+    ['executor']
+)
+
+EXECUTOR_REJECTED = Counter(
+    'crm_executor_rejected_total',
+    'Jobs shed because a bounded executor was saturated',
+    ['executor']
+)
+
+EXECUTOR_WAIT = Histogram(
+    'crm_executor_wait_seconds',
+    'Time jobs spent queued before a worker picked them up',
+    ['executor'],
+    buckets=(.001, .005, .01, .05, .1, .5, 1, 2.5, 5, 10, 30)
+)
+
+# Commands that aren't worth a time series of their own
+_IGNORED_COMMANDS = {'hello', 'isMaster', 'ismaster', 'ping', 'endSessions', 'saslStart', 'saslContinue'}
+
+def timed(handler):
+    """Record the wrapped function's duration under crm_handler_duration_seconds"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    HANDLER_LATENCY.labels(handler).observe(time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                HANDLER_LATENCY.labels(handler).observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def record_cache(cache_name, hit):
+    CACHE_REQUESTS.labels(cache_name, 'hit' if hit else 'miss').inc()
+
+class MongoMetricsListener(monitoring.CommandListener):
+    """Times every Mongo command by collection and command name"""
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        if event.command_name in _IGNORED_COMMANDS:
+            return
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = event.command.get('collection', '')
+        self._collections[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else ''
+        )
+
+    def succeeded(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), None)
+        if collection is None:
+            return
+        MONGO_COMMAND_LATENCY.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), None)
+        if collection is None:
+            return
+        MONGO_COMMAND_LATENCY.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.labels(collection, event.command_name).inc()
+
+_connected_clients = 0
+
+def socket_connected():
+    global _connected_clients
+    _connected_clients += 1
+    SOCKETIO_CLIENTS.set(_connected_clients)
+
+def socket_disconnected():
+    global _connected_clients
+    _connected_clients = max(0, _connected_clients - 1)
+    SOCKETIO_CLIENTS.set(_connected_clients)
+
+def _room_clients(manager, namespace, rooms):
+    """Distinct clients in `rooms` (a room, a sid or a list of them)"""
+    if not isinstance(rooms, (list, tuple, set)):
+        rooms = [rooms]
+    clients = set()
+    for room in rooms:
+        clients.update(sid for sid, _ in manager.get_participants(namespace, room))
+    return len(clients)
+
+def instrument_socketio(socketio):
+    """Count emits and their fan-out to connected clients.
+
+    Works on a Flask-SocketIO SocketIO or a python-socketio (Async)Server.
+    """
+    emit = socketio.emit
+
+    @functools.wraps(emit)
+    def counted_emit(event, *args, **kwargs):
+        SOCKETIO_EMITS.labels(event).inc()
+        rooms = kwargs.get('to') or kwargs.get('room')
+        # Broadcasts (no `to`/`room`) reach every connected client
+        if not rooms:
+            SOCKETIO_DELIVERIES.labels(event).inc(_connected_clients)
+        else:
+            manager = getattr(socketio, 'server', socketio).manager
+            SOCKETIO_DELIVERIES.labels(event).inc(
+                _room_clients(manager, kwargs.get('namespace') or '/', rooms)
+            )
+        return emit(event, *args, **kwargs)
+
+    socketio.emit = counted_emit
+    return socketio
+
+def metrics_response():
+    """Body and content type for the /metrics endpoint"""
+    return generate_latest(), CONTENT_TYPE_LATEST
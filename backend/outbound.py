@@ -0,0 +1,233 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+import pytz
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from message_archive import mark_conversation_changed
+
+logger = logging.getLogger(__name__)
+
+# Outbox for agent messages. /api/send-message stores the message as
+# 'pending' (keyed by the frontend's tempId) and answers straight away; a
+# dispatcher then claims it, calls the Graph API and records the outcome:
+#
+#   pending -> sending -> sent | failed
+#
+# The messages collection is the outbox, so a message the CRM shows is never
+# lost between the send and the write. Posting the same tempId again doesn't
+# send twice: it returns the stored message, or re-queues it if it failed.
+#
+# Outbox bookkeeping on message documents:
+#   {'tempId': str, 'queuedAt': datetime, 'sendingAt': datetime,
+#    'sendAttempts': int, 'sendError': str, 'sentAt': datetime}
+#
+# queuedAt is only set while a message is pending or sending, so the recovery
+# sweep reads a small sparse index. A message stuck in 'sending' past
+# OUTBOUND_SEND_LEASE may or may not have reached WhatsApp; it is marked
+# failed for the agent to retry rather than sent again blindly.
+
+OUTBOUND_REDISPATCH_AFTER = timedelta(seconds=int(os.getenv('OUTBOUND_REDISPATCH_AFTER', 30)))
+OUTBOUND_SEND_LEASE = timedelta(seconds=int(os.getenv('OUTBOUND_SEND_LEASE', 120)))
+OUTBOUND_RECOVERY_INTERVAL = int(os.getenv('OUTBOUND_RECOVERY_INTERVAL', 30))
+
+INTERRUPTED_SEND_ERROR = 'Send interrupted; delivery unknown'
+
+def _now():
+    return datetime.now(pytz.timezone('Asia/Kolkata'))
+
+def ensure_outbound_indexes(db):
+    """Unique tempIds for idempotent retries, and the recovery sweep's index"""
+    try:
+        db.messages.create_index(
+            [('tempId', ASCENDING)], unique=True,
+            partialFilterExpression={'tempId': {'$type': 'string'}}
+        )
+    except OperationFailure as e:
+        logger.warning("Could not create unique index on messages.tempId: %s", e)
+    db.messages.create_index([('queuedAt', ASCENDING)], sparse=True)
+
+def outbound_document(phone, message, temp_id, user_id, user_name, user_email, tenant_id=None):
+    """A pending outbound message; without a tempId the send can't be retried safely"""
+    timestamp = _now()
+    return {
+        'phone': phone,
+        'message': message,
+        'direction': 'outbound',
+        'timestamp': timestamp,
+        'messageType': 'text',
+        'isRead': True,
+        'status': 'pending',
+        'tempId': temp_id or f'srv_{uuid.uuid4().hex}',
+        'queuedAt': timestamp,
+        'sendAttempts': 0,
+        'whatsappMessageId': None,
+        'sentBy': user_id,
+        'sentByName': user_name,
+        'sentByEmail': user_email,
+        'tenantId': tenant_id
+    }
+
+def requeue_filter(temp_id):
+    return {'tempId': temp_id, 'status': 'failed'}
+
+def requeue_update():
+    return {'$set': {'status': 'pending', 'queuedAt': _now()}, '$unset': {'sendError': ''}}
+
+def claim_filter(message_id):
+    return {'_id': message_id, 'status': 'pending'}
+
+def claim_update():
+    return {'$set': {'status': 'sending', 'sendingAt': _now()}, '$inc': {'sendAttempts': 1}}
+
+def result_update(api_response):
+    """Outbox update for a Graph API send response"""
+    if 'messages' in api_response and api_response['messages']:
+        return {
+            '$set': {
+                'status': 'sent',
+                'whatsappMessageId': api_response['messages'][0].get('id'),
+                'sentAt': _now()
+            },
+            '$unset': {'queuedAt': '', 'sendingAt': '', 'sendError': ''}
+        }
+    error = api_response.get('error', 'Failed to send message') if isinstance(api_response, dict) else str(api_response)
+    if isinstance(error, dict):
+        error = error.get('message', str(error))
+    return {
+        '$set': {'status': 'failed', 'sendError': str(error)},
+        '$unset': {'queuedAt': '', 'sendingAt': ''}
+    }
+
+def status_event(message):
+    """message_status_update payload for an outbox transition"""
+    event = {
+        'messageId': str(message['_id']),
+        'tempId': message.get('tempId'),
+        'whatsappMessageId': message.get('whatsappMessageId'),
+        'phone': message['phone'],
+        'status': message['status'],
+        'timestamp': _now().isoformat(),
+        'tenantId': message.get('tenantId')
+    }
+    if message.get('sendError'):
+        event['error'] = message['sendError']
+    return event
+
+def sent_activity_log(message):
+    return {
+        'action': 'message_sent',
+        'userId': message.get('sentBy'),
+        'userName': message.get('sentByName'),
+        'userEmail': message.get('sentByEmail'),
+        'phone': message['phone'],
+        'message': message['message'],
+        'timestamp': message['timestamp'],
+        'whatsappMessageId': message.get('whatsappMessageId'),
+        'status': 'success'
+    }
+
+def chat_update(message):
+    return {
+        '$set': {
+            'lastMessage': message['message'],
+            'lastMessageTime': message['timestamp'],
+            'lastMessageBy': message.get('sentByName')
+        }
+    }
+
+def queue_outbound_message(db, doc):
+    """Store a pending message. Returns (message, queued).
+
+    `queued` is False when the tempId was already stored and isn't waiting
+    for a send; the stored message is returned as it is.
+    """
+    try:
+        db.messages.insert_one(doc)
+        mark_conversation_changed(db, doc['phone'], doc.get('tenantId'))
+        return doc, True
+    except DuplicateKeyError:
+        pass
+    requeued = db.messages.find_one_and_update(
+        requeue_filter(doc['tempId']), requeue_update(), return_document=ReturnDocument.AFTER
+    )
+    if requeued is not None:
+        mark_conversation_changed(db, requeued['phone'], requeued.get('tenantId'))
+        return requeued, True
+    return db.messages.find_one({'tempId': doc['tempId']}), False
+
+def dispatch_outbound_message(db, message_id, send):
+    """Claim a pending message, send it with `send(phone, message, tenant_id=...)` and record the result.
+
+    Returns the updated message, or None when it wasn't pending (another
+    dispatcher has it, or it was already sent).
+    """
+    message = db.messages.find_one_and_update(
+        claim_filter(message_id), claim_update(),
+        projection={'phone': 1, 'message': 1, 'tenantId': 1}
+    )
+    if message is None:
+        return None
+    api_response = send(message['phone'], message['message'], tenant_id=message.get('tenantId'))
+    result = db.messages.find_one_and_update(
+        {'_id': message_id, 'status': 'sending'}, result_update(api_response),
+        return_document=ReturnDocument.AFTER
+    )
+    mark_conversation_changed(db, message['phone'], message.get('tenantId'))
+    return result
+
+def recovery_filters():
+    """(redispatch, interrupted) filters for the recovery sweep"""
+    now = _now()
+    return (
+        {'queuedAt': {'$lt': now - OUTBOUND_REDISPATCH_AFTER}, 'status': 'pending'},
+        {'queuedAt': {'$exists': True}, 'status': 'sending', 'sendingAt': {'$lt': now - OUTBOUND_SEND_LEASE}}
+    )
+
+def interrupted_update():
+    return {
+        '$set': {'status': 'failed', 'sendError': INTERRUPTED_SEND_ERROR},
+        '$unset': {'queuedAt': '', 'sendingAt': ''}
+    }
+
+def recover_outbound(db):
+    """Pending messages nobody dispatched (e.g. the process died) and stuck sends.
+
+    Returns (ids to dispatch again, messages marked failed).
+    """
+    redispatch, interrupted = recovery_filters()
+    pending = [doc['_id'] for doc in db.messages.find(redispatch, {'_id': 1})]
+    failed = []
+    for doc in db.messages.find(interrupted, {'_id': 1}):
+        message = db.messages.find_one_and_update(
+            dict(interrupted, _id=doc['_id']), interrupted_update(),
+            return_document=ReturnDocument.AFTER
+        )
+        if message is not None:
+            mark_conversation_changed(db, message['phone'], message.get('tenantId'))
+            failed.append(message)
+    return pending, failed
+
+def start_outbound_recovery(db, redispatch, on_failed, interval=OUTBOUND_RECOVERY_INTERVAL):
+    """Periodically hand orphaned pending messages to `redispatch(message_id)`
+    and report interrupted sends to `on_failed(message)`"""
+    def run():
+        while True:
+            try:
+                pending, failed = recover_outbound(db)
+                for message_id in pending:
+                    redispatch(message_id)
+                for message in failed:
+                    logger.warning("Send of message %s was interrupted", message['_id'])
+                    on_failed(message)
+            except Exception as e:
+                logger.exception("Error recovering outbound messages: %s", e)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
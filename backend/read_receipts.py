@@ -0,0 +1,315 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+import pytz
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+
+from message_archive import ARCHIVE_COLLECTION, find_message
+from tenants import conversation_key
+from whatsapp_messages import send_read_receipt
+
+logger = logging.getLogger(__name__)
+
+# Send read receipts back to WhatsApp when agents read a conversation
+WHATSAPP_READ_RECEIPTS = os.getenv('WHATSAPP_READ_RECEIPTS', 'false').lower() == 'true'
+# Receipts are coalesced per conversation and sent every this many seconds
+READ_RECEIPT_FLUSH_INTERVAL = float(os.getenv('READ_RECEIPT_FLUSH_INTERVAL', 2))
+
+def ensure_read_indexes(db):
+    """Partial index covering only unread inbound messages.
+
+    Marking a conversation read touches just the unread documents instead of
+    scanning its whole history.
+    """
+    if 'unread_inbound_by_phone' in db.messages.index_information():
+        db.messages.drop_index('unread_inbound_by_phone')
+    db.messages.create_index(
+        [('tenantId', ASCENDING), ('phone', ASCENDING), ('timestamp', ASCENDING)],
+        name='unread_inbound_by_conversation',
+        partialFilterExpression={'isRead': False}
+    )
+    # Conversation history, newest first
+    db.messages.create_index([('phone', ASCENDING), ('timestamp', DESCENDING)])
+
+def backfill_unread_counts(db):
+    """Initialise users.unreadCount from the messages collection once"""
+    if db.migrations.find_one({'_id': 'unread_counters'}):
+        return
+
+    counts = {
+        (row['_id'].get('tenantId'), row['_id']['phone']): row['count']
+        for row in db.messages.aggregate([
+            {'$match': {'isRead': False, 'direction': 'inbound'}},
+            {'$group': {'_id': {'tenantId': '$tenantId', 'phone': '$phone'}, 'count': {'$sum': 1}}}
+        ])
+    }
+    db.users.update_many({}, {'$set': {'unreadCount': 0}})
+    if counts:
+        db.users.bulk_write([
+            UpdateOne(conversation_key(phone, tenant_id), {'$set': {'unreadCount': count}})
+            for (tenant_id, phone), count in counts.items()
+        ], ordered=False)
+
+    db.migrations.insert_one({'_id': 'unread_counters', 'appliedAt': datetime.now(pytz.timezone('Asia/Kolkata'))})
+    logger.info("Backfilled unread counters for %d conversations", len(counts))
+
+def resolve_watermark(db, phone, up_to=None, message_id=None, tenant_id=None):
+    """Return the timestamp up to which a conversation should be marked read.
+
+    `message_id` (a Mongo _id) wins over `up_to`; with neither, everything
+    received so far is marked read.
+    """
+    if message_id:
+        return _find_read_target(db, phone, message_id, {'timestamp': 1}, tenant_id)['timestamp']
+    if up_to is not None:
+        return up_to
+    return datetime.now(pytz.timezone('Asia/Kolkata'))
+
+def _find_read_target(db, phone, message_id, projection, tenant_id=None):
+    """The conversation's message a read request points at, hot or archived.
+
+    Raises ValueError for a malformed or unknown id.
+    """
+    if not ObjectId.is_valid(message_id):
+        raise ValueError('Invalid messageId')
+    message = find_message(db, dict(conversation_key(phone, tenant_id), _id=ObjectId(message_id)), projection)
+    if message is None:
+        raise ValueError('Message not found')
+    return message
+
+def mark_read(db, phone, watermark, tenant_id=None):
+    """Mark inbound messages up to `watermark` read and update the counter.
+
+    Returns (marked, unread_count).
+    """
+    conversation = conversation_key(phone, tenant_id)
+    query = dict(
+        conversation,
+        isRead=False,
+        direction='inbound',
+        timestamp={'$lte': watermark}
+    )
+    result = db.messages.update_many(
+        query,
+        {'$set': {'isRead': True, 'readAt': datetime.now(pytz.timezone('Asia/Kolkata'))}}
+    )
+    marked = result.modified_count
+
+    if marked:
+        user = db.users.find_one_and_update(
+            conversation,
+            [{'$set': {'unreadCount': {'$max': [0, {'$subtract': [{'$ifNull': ['$unreadCount', 0]}, marked]}]}}}],
+            projection={'unreadCount': 1},
+            return_document=ReturnDocument.AFTER
+        )
+    else:
+        user = db.users.find_one(conversation, {'unreadCount': 1})
+
+    return marked, (user or {}).get('unreadCount', 0)
+
+def mark_conversation_read(db, phone, data, receipt_sender=None, tenant_id=None):
+    """Apply a /api/messages/<phone>/read request body to `tenant_id`'s conversation.
+
+    Advances the shared watermark and, with `agentId`, that agent's, and
+    queues a read receipt when anything was newly read. Returns (marked,
+    response, event): the count of messages marked read, the JSON response and
+    the messages_read socket payload. Raises ValueError for a bad watermark.
+
+    The shared state (messages.isRead, users.unreadCount) still moves when an
+    agent reads: it means "someone on the team has read this". It drives the
+    WhatsApp read receipt, which the customer sees once for the whole team,
+    and the chat list of clients that don't pass an agentId. Per-agent
+    counts never read it, so one agent reading doesn't clear another's.
+    """
+    up_to = None
+    if data.get('upTo'):
+        if not isinstance(data['upTo'], str):
+            raise ValueError('upTo must be an ISO 8601 timestamp')
+        from dateutil import parser
+        up_to = parser.isoparse(data['upTo'])
+    watermark = resolve_watermark(db, phone, up_to, data.get('messageId'), tenant_id)
+    
+    # Per-agent watermark, resolved before anything is written
+    agent_id = data.get('agentId')
+    read_seq = resolve_read_seq(db, phone, data.get('messageId'), tenant_id) if agent_id else None
+    
+    marked, unread_count = mark_read(db, phone, watermark, tenant_id)
+    agent_unread = mark_agent_read(db, agent_id, phone, read_seq, tenant_id) if agent_id else None
+    
+    if marked and receipt_sender is not None:
+        whatsapp_message_id = latest_inbound_message_id(db, phone, watermark, tenant_id)
+        if whatsapp_message_id:
+            receipt_sender.queue(phone, whatsapp_message_id, tenant_id)
+    
+    # Agents with their own watermark only react when readBy is them
+    event = {
+        'phone': phone,
+        'tenantId': conversation_key(phone, tenant_id)['tenantId'],
+        'watermark': watermark.isoformat(),
+        'unreadCount': unread_count,
+        'readBy': agent_id,
+        'agentUnreadCount': agent_unread
+    }
+    response = {
+        'success': True,
+        'marked': marked,
+        'unreadCount': unread_count if agent_unread is None else agent_unread,
+        'sharedUnreadCount': unread_count,
+        'watermark': watermark.isoformat()
+    }
+    return marked, response, event
+
+class ReadReceiptSender:
+    """Coalesces WhatsApp read receipts and sends them in batches.
+
+    Marking the newest message of a conversation read also marks everything
+    before it, so only the latest message id per conversation is kept between flushes.
+    """
+
+    def __init__(self, flush_interval=READ_RECEIPT_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def queue(self, phone, whatsapp_message_id, tenant_id=None):
+        with self._lock:
+            self._pending[(tenant_id, phone)] = whatsapp_message_id
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        for (tenant_id, phone), message_id in batch.items():
+            # Receipts go out from the number that received the message
+            response = send_read_receipt(message_id, tenant_id)
+            if not response.get('success'):
+                logger.warning("Failed to send read receipt for %s: %s", phone, response)
+        return len(batch)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception("Error sending read receipts: %s", e)
+
+def latest_inbound_message_id(db, phone, watermark, tenant_id=None):
+    """WhatsApp id of the conversation's newest inbound message at or before the watermark"""
+    message = db.messages.find_one(
+        dict(conversation_key(phone, tenant_id), direction='inbound', timestamp={'$lte': watermark}),
+        {'messageId': 1},
+        sort=[('timestamp', -1)]
+    )
+    return (message or {}).get('messageId')
+
+# Per-agent read state: one small document per (agent, conversation) holding the
+# inbound sequence number the agent has read up to. Unread counts for an agent
+# are users.inboundSeq - readSeq, so the chat list never counts messages.
+
+def ensure_read_state_indexes(db):
+    # Read states used to be per (agent, phone)
+    if 'agentId_1_phone_1' in db.read_states.index_information():
+        db.read_states.drop_index('agentId_1_phone_1')
+    db.read_states.create_index([('agentId', ASCENDING), ('tenantId', ASCENDING), ('phone', ASCENDING)], unique=True)
+
+def backfill_read_state_tenants(db):
+    """Give read states from before per-tenant conversations their conversation's tenantId once.
+
+    Runs after backfill_tenant_ids, when each phone still has one users document.
+    """
+    if db.migrations.find_one({'_id': 'read_state_tenants'}):
+        return
+
+    phones = db.read_states.distinct('phone', {'tenantId': {'$exists': False}})
+    operations = [
+        UpdateOne({'phone': user['phone'], 'tenantId': {'$exists': False}}, {'$set': {'tenantId': user.get('tenantId')}})
+        for user in db.users.find({'phone': {'$in': phones}}, {'phone': 1, 'tenantId': 1})
+    ]
+    if operations:
+        db.read_states.bulk_write(operations, ordered=False)
+
+    db.migrations.insert_one({'_id': 'read_state_tenants', 'appliedAt': datetime.now(pytz.timezone('Asia/Kolkata'))})
+    logger.info("Assigned read states of %d conversations to their tenants", len(operations))
+
+def backfill_inbound_seq(db):
+    """Number existing inbound messages and initialise users.inboundSeq once"""
+    if db.migrations.find_one({'_id': 'inbound_seq'}):
+        return
+
+    counts = {}
+    operations = []
+    cursor = db.messages.find(
+        {'direction': 'inbound', 'seq': {'$exists': False}},
+        {'tenantId': 1, 'phone': 1}
+    ).sort([('tenantId', ASCENDING), ('phone', ASCENDING), ('timestamp', ASCENDING)]).batch_size(1000)
+    for message in cursor:
+        key = (message.get('tenantId'), message['phone'])
+        counts[key] = counts.get(key, 0) + 1
+        operations.append(UpdateOne({'_id': message['_id']}, {'$set': {'seq': counts[key]}}))
+        if len(operations) >= 1000:
+            db.messages.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        db.messages.bulk_write(operations, ordered=False)
+
+    if counts:
+        db.users.bulk_write([
+            UpdateOne(conversation_key(phone, tenant_id), {'$set': {'inboundSeq': count}})
+            for (tenant_id, phone), count in counts.items()
+        ], ordered=False)
+
+    db.migrations.insert_one({'_id': 'inbound_seq', 'appliedAt': datetime.now(pytz.timezone('Asia/Kolkata'))})
+    logger.info("Backfilled inbound sequence numbers for %d conversations", len(counts))
+
+def resolve_read_seq(db, phone, message_id=None, tenant_id=None):
+    """Sequence number an agent has read up to: the given message's, or the latest"""
+    conversation = conversation_key(phone, tenant_id)
+    if message_id:
+        message = _find_read_target(db, phone, message_id, {'seq': 1, 'direction': 1, 'timestamp': 1}, tenant_id)
+        if message.get('seq') is not None:
+            return message['seq']
+        # Outbound messages have no seq: everything received before them counts as read
+        received = dict(conversation, direction='inbound', timestamp={'$lte': message['timestamp']})
+        return db.messages.count_documents(received) + db[ARCHIVE_COLLECTION].count_documents(received)
+
+    user = db.users.find_one(conversation, {'inboundSeq': 1})
+    return (user or {}).get('inboundSeq', 0)
+
+def mark_agent_read(db, agent_id, phone, read_seq, tenant_id=None):
+    """Advance an agent's watermark for a conversation. Returns the agent's unread count."""
+    conversation = conversation_key(phone, tenant_id)
+    state = db.read_states.find_one_and_update(
+        dict(conversation, agentId=agent_id),
+        {
+            '$max': {'readSeq': read_seq},
+            '$set': {'readAt': datetime.now(pytz.timezone('Asia/Kolkata'))}
+        },
+        projection={'readSeq': 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    user = db.users.find_one(conversation, {'inboundSeq': 1})
+    return max(0, (user or {}).get('inboundSeq', 0) - state.get('readSeq', 0))
+
+def get_agent_read_seqs(db, agent_id):
+    """All of an agent's watermarks as {(tenantId, phone): readSeq}, in one query"""
+    return {
+        (state.get('tenantId'), state['phone']): state.get('readSeq', 0)
+        for state in db.read_states.find({'agentId': agent_id}, {'tenantId': 1, 'phone': 1, 'readSeq': 1, '_id': 0})
+    }
+
+def agent_unread_count(chat, read_seqs):
+    """Unread count of a chat row for an agent.
+
+    In a conversation the agent has never opened, every inbound message is
+    unread for them, whoever else has read it.
+    """
+    return max(0, chat.get('inboundSeq', 0) - read_seqs.get((chat.get('tenantId'), chat['phone']), 0))
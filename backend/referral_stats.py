@@ -0,0 +1,484 @@
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+import pytz
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
+
+from http_cache import body_etag
+from serializers import read_collection, referral_row
+
+logger = logging.getLogger(__name__)
+
+# Referral statistics are materialized into the referral_stats collection so that
+# /api/referrals never has to aggregate over the whole users collection.
+#
+# Document shapes:
+#   {'_id': <referrer>, 'kind': 'referrer', 'totalReferred': int, 'subscribedCount': int,
+#    'generation': ObjectId}
+#   {'_id': '__totals__', 'kind': 'totals', 'totalUsers': int, 'referredUsers': int, 'subscribedUsers': int,
+#    'updatedAt': datetime, 'version': int, 'activeChanges': int,
+#    'rebuilding': ObjectId, 'rebuildExpiresAt': datetime, 'pendingUsers': [user _id]}
+#
+# A rebuild takes the lock on the totals document (rebuilding, with a lease)
+# and counts from a snapshot of every user's referral fields. Incremental
+# updates claim the totals document in the same write that checks the lock:
+# - with no rebuild running they increment the stats, and activeChanges
+#   marks them in flight until their referrer documents are written too. A
+#   rebuild lets those finish before it takes its snapshot.
+# - while a rebuild runs they only add the user to pendingUsers. Once the
+#   counts are written, the rebuild moves each pending user from the state
+#   its snapshot counted to the user's current state, and releases the lock
+#   only when no user is pending.
+# Each change is therefore counted exactly once, whether or not the snapshot
+# saw the users write that caused it. Every referrer document a rebuild
+# writes carries its generation, and referrer documents from older
+# generations are deleted afterwards. Clocks are never compared.
+#
+# The totals document's updatedAt and version are stamped by every change to
+# the stats, by rebuilds and by mark_referrals_changed(); /api/referrals
+# validators are derived from them (see referrals_etag()). The version tells
+# apart changes within the same millisecond.
+
+TOTALS_ID = '__totals__'
+
+# Each user's referral fields as the running rebuild counted them
+SNAPSHOT_COLLECTION = 'referral_stats_snapshot'
+
+# How long a rebuild may hold the lock before another process can take it over
+REFERRAL_REBUILD_LEASE = timedelta(seconds=int(os.getenv('REFERRAL_REBUILD_LEASE', 300)))
+
+# How long a rebuild waits for in-flight incremental updates before it takes
+# their marks for leftovers of a crashed process
+REFERRAL_CHANGE_TIMEOUT = 30
+
+# How long a /api/referrals validator stays valid without a stats change
+REFERRALS_ETAG_WINDOW = int(os.getenv('REFERRALS_ETAG_WINDOW', 30))
+
+# Fields users can be sorted by on /api/referrals
+REFERRAL_SORT_FIELDS = {
+    'createdAt': 'createdAt',
+    'lastMessageAt': 'lastMessageAt',
+    'name': 'name',
+    'phone': 'phone',
+    'referredBy': 'referredBy',
+    'status': 'status',
+    'subscriptionStatus': 'subscriptionStatus'
+}
+
+# Only the user fields the referral rows actually need
+REFERRAL_USER_PROJECTION = {
+    'name': 1,
+    'phone': 1,
+    'referredBy': 1,
+    'createdAt': 1,
+    'lastMessageAt': 1,
+    'status': 1,
+    'subscriptionStatus': 1
+}
+
+def ensure_referral_indexes(db):
+    """Create indexes used by the referral queries and the stats collection"""
+    db.referral_stats.create_index([('kind', ASCENDING), ('totalReferred', DESCENDING)])
+    db.users.create_index([('referredBy', ASCENDING), ('createdAt', DESCENDING)])
+    db.users.create_index([('subscriptionStatus', ASCENDING), ('createdAt', DESCENDING)])
+    db.users.create_index([('createdAt', DESCENDING)])
+
+def build_referral_query(search='', referrer='', subscription=''):
+    """Build the users query shared by /api/referrals and its export"""
+    clauses = []
+
+    if search:
+        clauses.append({
+            '$or': [
+                {'name': {'$regex': search, '$options': 'i'}},
+                {'phone': {'$regex': search, '$options': 'i'}},
+                {'referredBy': {'$regex': search, '$options': 'i'}}
+            ]
+        })
+
+    if referrer:
+        clauses.append({'referredBy': referrer})
+
+    # 'all', 'subscribed', 'not_subscribed'
+    if subscription == 'subscribed':
+        clauses.append({'subscriptionStatus': 'active'})
+    elif subscription == 'not_subscribed':
+        clauses.append({'subscriptionStatus': {'$ne': 'active'}})
+
+    if not clauses:
+        return {}
+    if len(clauses) == 1:
+        return clauses[0]
+    return {'$and': clauses}
+
+def _user_state(user):
+    """Reduce a user document to the fields that drive referral stats"""
+    if user is None:
+        return None
+    return {
+        'referredBy': user.get('referredBy'),
+        'active': user.get('subscriptionStatus') == 'active'
+    }
+
+def _now():
+    return datetime.now(pytz.timezone('Asia/Kolkata'))
+
+def _lock_free(now):
+    """Filter for a totals document no live rebuild holds"""
+    return {'$or': [{'rebuilding': None}, {'rebuildExpiresAt': {'$lt': now}}]}
+
+def _acquire_rebuild_lock(db, generation):
+    """Take the rebuild lock, or take over an expired one. Returns False if another rebuild holds it."""
+    now = _now()
+    try:
+        db.referral_stats.update_one(
+            dict(_lock_free(now), _id=TOTALS_ID),
+            {
+                '$set': {'rebuilding': generation, 'rebuildExpiresAt': now + REFERRAL_REBUILD_LEASE, 'pendingUsers': []},
+                '$setOnInsert': {'kind': 'totals'}
+            },
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+def _release_rebuild_lock(db, generation):
+    db.referral_stats.update_one(
+        {'_id': TOTALS_ID, 'rebuilding': generation},
+        {'$unset': {'rebuilding': '', 'rebuildExpiresAt': '', 'pendingUsers': ''}}
+    )
+
+def wait_for_rebuild(db, poll_interval=0.05):
+    """Block while a rebuild holds the lock (at most until its lease expires)"""
+    while db.referral_stats.find_one(
+        {'_id': TOTALS_ID, 'rebuilding': {'$ne': None}, 'rebuildExpiresAt': {'$gt': _now()}}, {'_id': 1}
+    ):
+        time.sleep(poll_interval)
+
+def _wait_for_changes(db, poll_interval=0.05):
+    """Block until incremental updates that started before the rebuild lock have finished"""
+    deadline = time.monotonic() + REFERRAL_CHANGE_TIMEOUT
+    while True:
+        totals = db.referral_stats.find_one({'_id': TOTALS_ID}, {'activeChanges': 1}) or {}
+        if totals.get('activeChanges', 0) <= 0:
+            return
+        if time.monotonic() > deadline:
+            logger.warning("Referral stats changes still marked in flight, taking them as abandoned")
+            db.referral_stats.update_one({'_id': TOTALS_ID}, {'$set': {'activeChanges': 0}})
+            return
+        time.sleep(poll_interval)
+
+def _increments(before, after):
+    """$inc documents for the totals and each referrer, for a user going from `before` to `after`"""
+    totals_inc = {'totalUsers': 0, 'referredUsers': 0, 'subscribedUsers': 0}
+    referrer_inc = {}
+    for state, sign in ((before, -1), (after, 1)):
+        if state is None:
+            continue
+        totals_inc['totalUsers'] += sign
+        if state['active']:
+            totals_inc['subscribedUsers'] += sign
+        if state['referredBy']:
+            totals_inc['referredUsers'] += sign
+            inc = referrer_inc.setdefault(state['referredBy'], {'totalReferred': 0, 'subscribedCount': 0})
+            inc['totalReferred'] += sign
+            if state['active']:
+                inc['subscribedCount'] += sign
+
+    referrer_inc = {referrer: {k: v for k, v in inc.items() if v} for referrer, inc in referrer_inc.items()}
+    return {k: v for k, v in totals_inc.items() if v}, {k: v for k, v in referrer_inc.items() if v}
+
+def _increment_referrers(db, referrer_inc, now):
+    for referrer, inc in referrer_inc.items():
+        db.referral_stats.update_one(
+            {'_id': referrer},
+            {'$inc': inc, '$set': {'kind': 'referrer', 'updatedAt': now}},
+            upsert=True
+        )
+
+def apply_user_change(db, before, after, user_id=None):
+    """Incrementally update referral_stats for a user going from `before` to `after`.
+
+    Either side may be None (user created or removed). Only the referredBy and
+    subscriptionStatus fields of the documents are looked at. Call it after
+    the users write, with the user's _id: while a rebuild runs the change is
+    left to it to reconcile. Without a user_id it waits for the rebuild.
+    """
+    before = _user_state(before)
+    after = _user_state(after)
+    if before == after:
+        return
+    totals_inc, referrer_inc = _increments(before, after)
+
+    while True:
+        # Stamped even when only referrers change, for referrals_etag()
+        now = _now()
+        try:
+            db.referral_stats.update_one(
+                dict(_lock_free(now), _id=TOTALS_ID),
+                {
+                    '$inc': dict(totals_inc, version=1, activeChanges=1 if referrer_inc else 0),
+                    '$set': {'kind': 'totals', 'updatedAt': now}
+                },
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # A rebuild is running
+            if user_id is None:
+                wait_for_rebuild(db)
+                continue
+            pending = db.referral_stats.update_one(
+                {'_id': TOTALS_ID, 'rebuilding': {'$ne': None}, 'rebuildExpiresAt': {'$gte': now}},
+                {'$addToSet': {'pendingUsers': user_id}}
+            )
+            if pending.matched_count:
+                return
+            # It finished in the meantime
+            continue
+        break
+
+    if referrer_inc:
+        try:
+            _increment_referrers(db, referrer_inc, now)
+        finally:
+            db.referral_stats.update_one({'_id': TOTALS_ID}, {'$inc': {'activeChanges': -1}})
+
+def _reconcile_pending_users(db, generation):
+    """Move users changed during the rebuild from their snapshot state to their current one, then release the lock"""
+    while True:
+        totals = db.referral_stats.find_one({'_id': TOTALS_ID, 'rebuilding': generation}, {'pendingUsers': 1})
+        if totals is None:
+            # The lease expired and another rebuild took over
+            return
+        pending = totals.get('pendingUsers', [])
+        if not pending:
+            released = db.referral_stats.update_one(
+                {'_id': TOTALS_ID, 'rebuilding': generation, 'pendingUsers': {'$size': 0}},
+                {'$unset': {'rebuilding': '', 'rebuildExpiresAt': '', 'pendingUsers': ''}}
+            )
+            if released.modified_count:
+                return
+            continue
+
+        # Taken off first, so a change landing meanwhile queues the user again
+        db.referral_stats.update_one({'_id': TOTALS_ID, 'rebuilding': generation}, {'$pullAll': {'pendingUsers': pending}})
+        for user_id in pending:
+            counted = db[SNAPSHOT_COLLECTION].find_one({'_id': user_id})
+            current = db.users.find_one({'_id': user_id}, {'referredBy': 1, 'subscriptionStatus': 1})
+            before, after = _user_state(counted), _user_state(current)
+            if before != after:
+                totals_inc, referrer_inc = _increments(before, after)
+                now = _now()
+                db.referral_stats.update_one(
+                    {'_id': TOTALS_ID},
+                    {'$inc': dict(totals_inc, version=1), '$set': {'updatedAt': now}}
+                )
+                _increment_referrers(db, referrer_inc, now)
+            if current is None:
+                db[SNAPSHOT_COLLECTION].delete_one({'_id': user_id})
+            else:
+                db[SNAPSHOT_COLLECTION].replace_one({'_id': user_id}, current, upsert=True)
+
+def rebuild_referral_stats(db):
+    """Recompute referral_stats from scratch with $merge.
+
+    Returns False without rebuilding when another rebuild is running.
+    """
+    generation = ObjectId()
+    if not _acquire_rebuild_lock(db, generation):
+        logger.info("Referral stats rebuild already running, skipping")
+        return False
+
+    try:
+        _wait_for_changes(db)
+        db.users.aggregate([
+            {'$project': {'referredBy': 1, 'subscriptionStatus': 1}},
+            {'$out': SNAPSHOT_COLLECTION}
+        ])
+
+        db[SNAPSHOT_COLLECTION].aggregate([
+            {'$match': {'referredBy': {'$nin': [None, '']}}},
+            {'$group': {
+                '_id': '$referredBy',
+                'totalReferred': {'$sum': 1},
+                'subscribedCount': {
+                    '$sum': {'$cond': [{'$eq': ['$subscriptionStatus', 'active']}, 1, 0]}
+                }
+            }},
+            {'$addFields': {'kind': 'referrer', 'generation': generation, 'updatedAt': _now()}},
+            {'$merge': {'into': 'referral_stats', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+        ])
+
+        # Only the counts are replaced: the lock, activeChanges and version
+        # stay, and the version moves on so cached pages are revalidated
+        db[SNAPSHOT_COLLECTION].aggregate([
+            {'$group': {
+                '_id': None,
+                'totalUsers': {'$sum': 1},
+                'referredUsers': {
+                    '$sum': {'$cond': [{'$in': [{'$ifNull': ['$referredBy', '']}, ['']]}, 0, 1]}
+                },
+                'subscribedUsers': {
+                    '$sum': {'$cond': [{'$eq': ['$subscriptionStatus', 'active']}, 1, 0]}
+                }
+            }},
+            {'$project': {
+                '_id': {'$literal': TOTALS_ID},
+                'totalUsers': 1,
+                'referredUsers': 1,
+                'subscribedUsers': 1,
+                'updatedAt': {'$literal': _now()}
+            }},
+            {'$merge': {
+                'into': 'referral_stats',
+                'whenMatched': [{'$set': {
+                    'kind': 'totals',
+                    'totalUsers': '$$new.totalUsers',
+                    'referredUsers': '$$new.referredUsers',
+                    'subscribedUsers': '$$new.subscribedUsers',
+                    'updatedAt': '$$new.updatedAt',
+                    'version': {'$add': [{'$ifNull': ['$version', 0]}, 1]}
+                }}],
+                'whenNotMatched': 'insert'
+            }}
+        ])
+        # No users at all: nothing to group, so the counts are reset here
+        if db[SNAPSHOT_COLLECTION].estimated_document_count() == 0:
+            db.referral_stats.update_one(
+                {'_id': TOTALS_ID},
+                {'$set': {'totalUsers': 0, 'referredUsers': 0, 'subscribedUsers': 0, 'updatedAt': _now()},
+                 '$inc': {'version': 1}}
+            )
+
+        # Referrers that no longer have any referred users were not touched by the merge
+        result = db.referral_stats.delete_many({'kind': 'referrer', 'generation': {'$ne': generation}})
+        _reconcile_pending_users(db, generation)
+    finally:
+        _release_rebuild_lock(db, generation)
+        db[SNAPSHOT_COLLECTION].drop()
+    logger.info("Rebuilt referral stats, removed %d stale referrers", result.deleted_count)
+    return True
+
+def mark_referrals_changed(db):
+    """Stamp the totals document after a change to users the referral rows show"""
+    db.referral_stats.update_one(
+        {'_id': TOTALS_ID},
+        {'$inc': {'version': 1}, '$set': {'kind': 'totals', 'updatedAt': _now()}},
+        upsert=True
+    )
+
+def referrals_etag(db, args):
+    """Validator for referrals_page(db, args), read before building the page.
+
+    Stats changes and dashboard edits stamp the totals document. Rows also
+    show lastMessageAt, which every inbound message moves; rather than stamp a
+    shared document per message, validators expire every
+    REFERRALS_ETAG_WINDOW seconds, like the chat list cache.
+    """
+    totals = db.referral_stats.find_one({'_id': TOTALS_ID}, {'updatedAt': 1, 'version': 1}) or {}
+    updated_at = totals.get('updatedAt')
+    return body_etag('|'.join((
+        updated_at.isoformat() if updated_at else '',
+        str(totals.get('version', 0)),
+        str(int(time.time() // REFERRALS_ETAG_WINDOW)),
+        '&'.join(f'{key}={value}' for key, value in sorted(args.items()))
+    )).encode())
+
+def get_referral_totals(db):
+    """Return overall referral totals from the materialized view"""
+    totals = db.referral_stats.find_one({'_id': TOTALS_ID}) or {}
+    return {
+        'totalUsers': totals.get('totalUsers', 0),
+        'referredUsers': totals.get('referredUsers', 0),
+        'subscribedUsers': totals.get('subscribedUsers', 0)
+    }
+
+def get_top_referrers(db, limit=10):
+    """Return the referrers with the most referred users"""
+    cursor = db.referral_stats.find(
+        {'kind': 'referrer', 'totalReferred': {'$gt': 0}},
+        {'totalReferred': 1, 'subscribedCount': 1}
+    ).sort('totalReferred', -1).limit(limit)
+
+    return [
+        {
+            '_id': stat['_id'],
+            'count': stat.get('totalReferred', 0),
+            'subscribedCount': stat.get('subscribedCount', 0)
+        }
+        for stat in cursor
+    ]
+
+def get_referrer_stats(db, keys):
+    """Look up stats for the given referrer names/phones in one query"""
+    keys = [k for k in set(keys) if k]
+    if not keys:
+        return {}
+    cursor = db.referral_stats.find(
+        {'_id': {'$in': keys}, 'kind': 'referrer'},
+        {'totalReferred': 1, 'subscribedCount': 1}
+    )
+    return {
+        stat['_id']: {
+            '_id': stat['_id'],
+            'totalReferred': stat.get('totalReferred', 0),
+            'subscribedCount': stat.get('subscribedCount', 0)
+        }
+        for stat in cursor
+    }
+
+def ensure_referral_stats(db):
+    """Build the materialized view on first start"""
+    if db.referral_stats.find_one({'_id': TOTALS_ID}) is None:
+        rebuild_referral_stats(db)
+
+def referrals_page(db, args):
+    """The /api/referrals payload for request arguments `args` (a mapping)"""
+    search = args.get('search', '').strip()
+    referrer_filter = args.get('referrer', '').strip()
+    subscription_filter = args.get('subscription', '')  # 'all', 'subscribed', 'not_subscribed'
+    page = max(int(args.get('page', 1)), 1)
+    limit = min(max(int(args.get('limit', 50)), 1), 500)
+    sort_field = REFERRAL_SORT_FIELDS.get(args.get('sort', 'createdAt'), 'createdAt')
+    sort_order = 1 if args.get('order', 'desc') == 'asc' else -1
+    skip = (page - 1) * limit
+    
+    query = build_referral_query(search, referrer_filter, subscription_filter)
+    
+    total_count = db.users.count_documents(query)
+    users = list(read_collection(db.users).find(query, REFERRAL_USER_PROJECTION)
+                 .sort([(sort_field, sort_order), ('_id', sort_order)])
+                 .skip(skip)
+                 .limit(limit))
+    
+    # Referrer stats for this page only, from the materialized view
+    stats_lookup = get_referrer_stats(
+        db, [u.get('name') for u in users] + [u.get('phone') for u in users]
+    )
+    
+    # Overall statistics come from the materialized view
+    totals = get_referral_totals(db)
+    referred_users = totals['referredUsers']
+    subscribed_users = totals['subscribedUsers']
+    
+    return {
+        'success': True,
+        'referrals': [referral_row(user, stats_lookup) for user in users],
+        'pagination': {
+            'page': page,
+            'limit': limit,
+            'total': total_count,
+            'totalPages': (total_count + limit - 1) // limit
+        },
+        'statistics': {
+            'totalUsers': totals['totalUsers'],
+            'referredUsers': referred_users,
+            'subscribedUsers': subscribed_users,
+            'conversionRate': round((subscribed_users / referred_users * 100) if referred_users > 0 else 0, 2),
+            'topReferrers': get_top_referrers(db)
+        }
+    }
@@ -0,0 +1,292 @@
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from string import Template
+import pytz
+from pymongo import ASCENDING
+
+logger = logging.getLogger(__name__)
+
+# Auto-replies and button flows are data, stored in the reply_rules collection:
+#
+#   {'_id': 'welcome', 'kind': 'welcome', 'template': '...', 'buttons': [{'id': ..., 'title': ...}]}
+#   {'_id': 'button:pricing', 'kind': 'button', 'buttonId': 'pricing', 'template': '...', 'buttons': [...]}
+#   {'_id': 'keyword:refund', 'kind': 'keyword', 'keywords': ['refund', 'money back'],
+#    'wholeWord': True, 'priority': 10, 'template': 'Hi $name, ...'}
+#
+# All rules may carry 'enabled': False. Templates use $name/$phone placeholders.
+#
+# New users always get the welcome rule. For existing users a button reply is
+# looked up by button id; otherwise the message text is matched against every
+# keyword rule at once with an Aho-Corasick automaton, and the matching rule
+# with the lowest priority wins.
+#
+# Rules are compiled into lookup tables when loaded and reloaded by a
+# background thread whenever the collection changes. save_rule/delete_rule bump
+# a version counter in reply_rules_state, so every change made through them is
+# seen even when it leaves the rule count and newest updatedAt as they were.
+
+REPLY_RULES_REFRESH_INTERVAL = float(os.getenv('REPLY_RULES_REFRESH_INTERVAL', 10))
+
+RULE_KINDS = ('welcome', 'button', 'keyword')
+
+DEFAULT_RULES = [
+    {
+        '_id': 'welcome',
+        'kind': 'welcome',
+        'template': "Hey there! I'm faff!\nWe're an affordable personal assistant service for people who value their time. You can hire us and delegate your personal chores over WhatsApp.\n\nHow would you like to proceed?\nChoose an option below",
+        'buttons': [
+            {'id': 'know_more', 'title': 'Know more'},
+            {'id': 'onboard_direct', 'title': 'Onboard me directly'}
+        ]
+    },
+    {
+        '_id': 'button:know_more',
+        'kind': 'button',
+        'buttonId': 'know_more',
+        'template': "We offer a wide range of services:\n\n📱 Digital Tasks\n• Online research & bookings\n• Email management\n• Social media handling\n\n🏠 Personal Errands\n• Shopping assistance\n• Bill payments\n• Appointment scheduling\n\n💼 Professional Support\n• Document preparation\n• Travel planning\n• Event coordination\n\nAll for just ₹999/month! Ready to get started?",
+        'buttons': [
+            {'id': 'start_trial', 'title': 'Start Free Trial'},
+            {'id': 'pricing', 'title': 'View Pricing'}
+        ]
+    },
+    {
+        '_id': 'button:onboard_direct',
+        'kind': 'button',
+        'buttonId': 'onboard_direct',
+        'template': "Great! Let's get you started.\n\nPlease share your email address to create your account and start your free trial."
+    },
+    {
+        '_id': 'button:start_trial',
+        'kind': 'button',
+        'buttonId': 'start_trial',
+        'template': "Excellent choice! 🎉\n\nYour 7-day free trial has been activated.\n\nTo get started:\n1. Save this number\n2. Send us your first task\n3. We'll handle it within 2 hours\n\nWhat would you like help with today?"
+    },
+    {
+        '_id': 'button:pricing',
+        'kind': 'button',
+        'buttonId': 'pricing',
+        'template': "Our Pricing Plans:\n\n📌 Basic Plan - ₹999/month\n• 10 tasks per month\n• 2-hour response time\n• WhatsApp support\n\n⭐ Premium Plan - ₹2499/month\n• Unlimited tasks\n• 30-min response time\n• Priority support\n• Dedicated assistant\n\n💎 Business Plan - ₹4999/month\n• Everything in Premium\n• Team collaboration\n• API access\n• Custom integrations\n\nWhich plan interests you?",
+        'buttons': [
+            {'id': 'start_trial', 'title': 'Start Free Trial'},
+            {'id': 'contact_sales', 'title': 'Contact Sales'}
+        ]
+    }
+]
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton: finds every keyword in a text in a single pass"""
+
+    def __init__(self, keywords):
+        # keywords: iterable of (keyword, value); keywords are matched lowercased
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+
+        for keyword, value in keywords:
+            keyword = keyword.lower()
+            if not keyword:
+                continue
+            state = 0
+            for char in keyword:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                state = next_state
+            self._output[state].append((len(keyword), value))
+
+        # Breadth-first fill of the failure links
+        queue = list(self._goto[0].values())
+        while queue:
+            state = queue.pop(0)
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def search(self, text):
+        """Yield (start, end, value) for every keyword occurrence in `text`"""
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for index, char in enumerate(text.lower()):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, value in output[state]:
+                yield index - length + 1, index + 1, value
+
+class CompiledRule:
+    __slots__ = ('id', 'kind', 'priority', 'whole_word', 'template', 'buttons')
+
+    def __init__(self, rule, order):
+        self.id = rule['_id']
+        self.kind = rule['kind']
+        self.priority = (rule.get('priority', 100), order)
+        self.whole_word = rule.get('wholeWord', True)
+        self.template = Template(rule.get('template', ''))
+        self.buttons = [
+            {'type': 'reply', 'reply': {'id': button['id'], 'title': button['title']}}
+            for button in rule.get('buttons') or []
+        ] or None
+
+    def render(self, context):
+        return self.template.safe_substitute(context), self.buttons
+
+def _is_word_boundary(text, start, end):
+    before = text[start - 1] if start > 0 else ' '
+    after = text[end] if end < len(text) else ' '
+    return not before.isalnum() and not after.isalnum()
+
+RuleTables = namedtuple('RuleTables', ('welcome', 'buttons', 'automaton', 'fingerprint'))
+
+class FlowEngine:
+    """Reply rules compiled into lookup tables; rebuilt by `load`"""
+
+    def __init__(self):
+        self.tables = RuleTables(None, {}, None, None)
+
+    @property
+    def fingerprint(self):
+        return self.tables.fingerprint
+
+    def compile(self, rules, fingerprint=None):
+        welcome = None
+        buttons = {}
+        keywords = []
+        for order, rule in enumerate(rules):
+            if not rule.get('enabled', True) or rule.get('kind') not in RULE_KINDS:
+                continue
+            compiled = CompiledRule(rule, order)
+            if compiled.kind == 'welcome':
+                welcome = compiled
+            elif compiled.kind == 'button' and rule.get('buttonId'):
+                buttons[rule['buttonId']] = compiled
+            elif compiled.kind == 'keyword':
+                keywords.extend((keyword, compiled) for keyword in rule.get('keywords') or [])
+
+        # Tables are fully built and swapped in with one assignment, so
+        # concurrent readers never see a half-built or mixed set
+        self.tables = RuleTables(welcome, buttons, KeywordAutomaton(keywords) if keywords else None, fingerprint)
+
+    def load(self, db):
+        # Taken first: a change made while loading shows up as a new fingerprint
+        fingerprint = rules_fingerprint(db)
+        rules = list(db.reply_rules.find().sort('_id', ASCENDING))
+        self.compile(rules, fingerprint)
+        logger.info("Loaded %d reply rules", len(rules))
+
+    def match_keyword(self, text, tables=None):
+        automaton = (tables or self.tables).automaton
+        if automaton is None or not text:
+            return None
+        # Offsets refer to the lowercased text (lower() can change its length)
+        lowered = text.lower()
+        best = None
+        for start, end, rule in automaton.search(lowered):
+            if rule.whole_word and not _is_word_boundary(lowered, start, end):
+                continue
+            if best is None or rule.priority < best.priority:
+                best = rule
+        return best
+
+    def reply_for(self, message_text, button_id=None, is_new_user=False, context=None):
+        """Return (reply_text, buttons) for an inbound message, or (None, None)"""
+        tables = self.tables
+        if is_new_user:
+            rule = tables.welcome
+        elif button_id:
+            rule = tables.buttons.get(button_id)
+        else:
+            rule = self.match_keyword(message_text, tables)
+        if rule is None:
+            return None, None
+        return rule.render(context or {})
+
+flow_engine = FlowEngine()
+# Built-in flows until the collection has been loaded
+flow_engine.compile(DEFAULT_RULES)
+
+def rules_fingerprint(db):
+    """Cheap change detector: the rules version plus rule count and newest updatedAt.
+
+    The count and updatedAt catch most edits made directly in the database.
+    """
+    state = db.reply_rules_state.find_one({'_id': 'version'}) or {}
+    latest = db.reply_rules.find_one({}, {'updatedAt': 1}, sort=[('updatedAt', -1)])
+    return state.get('version', 0), db.reply_rules.count_documents({}), (latest or {}).get('updatedAt')
+
+def _bump_rules_version(db):
+    db.reply_rules_state.update_one({'_id': 'version'}, {'$inc': {'version': 1}}, upsert=True)
+
+def ensure_reply_rules(db):
+    """Index the rules and seed the built-in flows on first start"""
+    db.reply_rules.create_index([('updatedAt', ASCENDING)])
+    if db.reply_rules.count_documents({}, limit=1) == 0:
+        now = datetime.now(pytz.timezone('Asia/Kolkata'))
+        db.reply_rules.insert_many([dict(rule, updatedAt=now) for rule in DEFAULT_RULES])
+        logger.info("Seeded %d default reply rules", len(DEFAULT_RULES))
+
+def validate_rule(rule):
+    """Raise ValueError if a rule document submitted through the API is malformed"""
+    if not isinstance(rule.get('_id'), str) or not rule['_id']:
+        raise ValueError('_id is required')
+    if rule.get('kind') not in RULE_KINDS:
+        raise ValueError(f"kind must be one of {', '.join(RULE_KINDS)}")
+    if not isinstance(rule.get('template'), str) or not rule['template']:
+        raise ValueError('template is required')
+    if rule['kind'] == 'button' and not rule.get('buttonId'):
+        raise ValueError('buttonId is required for button rules')
+    if rule['kind'] == 'keyword':
+        keywords = rule.get('keywords')
+        if not keywords or not all(isinstance(k, str) and k.strip() for k in keywords):
+            raise ValueError('keywords must be a non-empty list of strings')
+    for button in rule.get('buttons') or []:
+        if not button.get('id') or not button.get('title'):
+            raise ValueError('buttons need an id and a title')
+
+def save_rule(db, rule):
+    validate_rule(rule)
+    rule = dict(rule, updatedAt=datetime.now(pytz.timezone('Asia/Kolkata')))
+    db.reply_rules.replace_one({'_id': rule['_id']}, rule, upsert=True)
+    _bump_rules_version(db)
+    return rule
+
+def delete_rule(db, rule_id):
+    """Remove a rule; False if there was none"""
+    if db.reply_rules.delete_one({'_id': rule_id}).deleted_count == 0:
+        return False
+    _bump_rules_version(db)
+    return True
+
+def extract_referral(message_text):
+    """Referrer named in a 'referred by ...' first message, if any"""
+    lower = message_text.lower()
+    index = lower.find('referred by')
+    if index < 0:
+        return None
+    return message_text[index + len('referred by'):].strip().rstrip('.') or None
+
+def start_reply_rules_reloader(db, engine=flow_engine, interval=REPLY_RULES_REFRESH_INTERVAL):
+    """Reload the engine in the background whenever reply_rules changes"""
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                if rules_fingerprint(db) != engine.fingerprint:
+                    engine.load(db)
+            except Exception as e:
+                logger.exception("Error reloading reply rules: %s", e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,155 @@
+import json
+import os
+from collections.abc import Mapping
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from flask import Response
+
+from media import media_urls
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Response and Socket.IO payload serialization.
+#
+# Rows are built as plain dicts that may hold datetime and ObjectId values;
+# orjson encodes those natively (ObjectId through `_default`), so handlers
+# don't call isoformat()/str() per field. Without orjson installed the stdlib
+# encoder is used with the same output.
+
+# India has no DST, so a fixed offset is exact and much cheaper than pytz
+IST = timezone(timedelta(hours=5, minutes=30))
+
+# Decode hot-path reads into RawBSONDocument: top-level fields are decoded on
+# first access and embedded documents stay raw bytes until touched
+MONGO_RAW_BSON = os.getenv('MONGO_RAW_BSON', 'false').lower() == 'true'
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+# Only the fields each row builder reads
+MESSAGE_ROW_PROJECTION = {
+    'message': 1, 'direction': 1, 'timestamp': 1, 'messageType': 1, 'status': 1,
+    'whatsappMessageId': 1, 'buttons': 1, 'buttonId': 1, 'media': 1, 'location': 1
+}
+CHAT_USER_PROJECTION = {
+    'phone': 1, 'name': 1, 'status': 1, 'referredBy': 1, 'isPaid': 1,
+    'lastMessageAt': 1, 'unreadCount': 1, 'inboundSeq': 1, 'archivedLastMessage': 1, 'tenantId': 1
+}
+CHAT_LAST_MESSAGE_PROJECTION = {'message': 1, '_id': 0}
+
+def read_collection(collection):
+    """`collection`, decoding to RawBSONDocument when MONGO_RAW_BSON is set"""
+    if MONGO_RAW_BSON:
+        return collection.with_options(codec_options=RAW_CODEC_OPTIONS)
+    return collection
+
+def to_ist(value):
+    """Aware IST datetime; naive values (as PyMongo returns them) are UTC"""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(IST)
+
+def _default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        # Only reached by the stdlib fallback; orjson handles datetimes itself
+        return value.isoformat()
+    if isinstance(value, Mapping):
+        # Embedded RawBSONDocuments
+        return dict(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+def dumps(payload):
+    """Serialize to UTF-8 JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default)
+    return json.dumps(payload, default=_default, ensure_ascii=False, separators=(',', ':')).encode()
+
+def loads(data):
+    """Parse JSON bytes or str"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_response(payload, status=200, headers=None):
+    """Drop-in for jsonify() using the fast encoder"""
+    return Response(dumps(payload), status=status, headers=headers, mimetype='application/json')
+
+class SocketJSON:
+    """json-module replacement for Socket.IO packet encoding"""
+
+    @staticmethod
+    def dumps(payload, *args, **kwargs):
+        return dumps(payload).decode()
+
+    @staticmethod
+    def loads(data, *args, **kwargs):
+        return loads(data)
+
+def message_row(msg):
+    """A messages document as returned by /api/messages"""
+    message_id = str(msg['_id'])
+    return {
+        'id': message_id,
+        'message': msg['message'],
+        'direction': msg['direction'],
+        'timestamp': to_ist(msg['timestamp']),
+        'messageType': msg.get('messageType', 'text'),
+        'status': msg.get('status', 'sent'),  # Include message status
+        'whatsappMessageId': msg.get('whatsappMessageId'),  # Include WhatsApp message ID for status tracking
+        'buttons': msg.get('buttons'),  # Include button data if present
+        'buttonId': msg.get('buttonId'),  # Include button ID for button replies
+        'media': media_urls(message_id, msg.get('media')),  # URLs only, never content
+        'location': msg.get('location')
+    }
+
+def chat_row(user, last_message):
+    """A users document and its latest message as a /api/chats row"""
+    return {
+        'id': str(user['_id']),
+        'phone': user['phone'],
+        'name': user['name'],
+        'status': user['status'],
+        'referredBy': user.get('referredBy'),
+        'isPaid': user.get('isPaid', False),
+        # Conversations whose messages are all archived
+        'lastMessage': last_message['message'] if last_message else user.get('archivedLastMessage', ''),
+        'lastMessageTime': user['lastMessageAt'],
+        'unreadCount': user.get('unreadCount', 0),
+        'inboundSeq': user.get('inboundSeq', 0),
+        'tenantId': user.get('tenantId')
+    }
+
+def referral_row(user, stats_lookup):
+    """A users document as a /api/referrals row"""
+    return {
+        '_id': user['_id'],
+        'name': user.get('name', 'Unknown'),
+        'phone': user.get('phone'),
+        'referredBy': user.get('referredBy'),
+        'createdAt': user.get('createdAt'),
+        'lastMessageAt': user.get('lastMessageAt'),
+        'status': user.get('status', 'new'),
+        'subscriptionStatus': user.get('subscriptionStatus', 'none'),
+        'hasSubscription': user.get('subscriptionStatus') == 'active',
+        'referralStats': stats_lookup.get(user.get('name')) or stats_lookup.get(user.get('phone')) or {
+            'totalReferred': 0,
+            'subscribedCount': 0
+        }
+    }
+
+def customer_row(customer):
+    """A customers API record as a /api/customers row (referrer dropdown)"""
+    return {
+        'id': customer.get('id'),
+        'name': customer.get('name'),
+        'phone': customer.get('phone_number'),
+        'whatsapp_group_id': customer.get('whatsapp_group_id')
+    }
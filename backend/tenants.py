@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+import threading
+import time
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Several WhatsApp business numbers served by one deployment. A tenant is a
+# Graph phone_number_id with its own access token, HTTP session (connection
+# pool) and send rate limiter, so a burst on one number can't use up another
+# number's connections or Graph throughput.
+#
+# WHATSAPP_TENANTS is a JSON list:
+#   [{"phoneNumberId": "1234", "token": "EAAG...", "name": "Sales", "sendRate": 40}, ...]
+# Without it, WHATSAPP_PHONE_ID / WHATSAPP_TOKEN is the only tenant and every
+# webhook is routed to it, as before. An entry may also carry "appSecret" when
+# its number belongs to a different Meta app (see webhook_security.py).
+#
+# messages and users carry `tenantId` (the phone_number_id), and a
+# conversation is keyed by (tenantId, phone): a customer who writes to two of
+# the numbers has two conversations, each with its own history, counters and
+# read state, and replies go out from the conversation's number. Requests that
+# name a phone but no tenant get the conversation the customer wrote to last.
+# Indexes lead with tenantId, and {tenantId: 1, phone: 1} is the shard key to
+# use for both collections when sharding.
+#
+# Socket.IO clients connecting with ?tenant=<phoneNumberId> join that tenant's
+# room and only get its message traffic; other clients join the all-tenants
+# room and get everything.
+
+WHATSAPP_TOKEN = os.getenv('WHATSAPP_TOKEN')
+WHATSAPP_PHONE_ID = os.getenv('WHATSAPP_PHONE_ID')
+# Graph's default throughput for a business number is 80 messages per second
+WHATSAPP_SEND_RATE = float(os.getenv('WHATSAPP_SEND_RATE', 80))
+
+ALL_TENANTS_ROOM = 'tenant:*'
+
+def tenant_room(tenant_id):
+    return f'tenant:{tenant_id}'
+
+def tenant_rooms(tenant_id):
+    """Rooms an event about `tenant_id`'s traffic goes to"""
+    return [tenant_room(tenant_id), ALL_TENANTS_ROOM]
+
+def emit_to_tenant(socketio, event, data, tenant_id):
+    socketio.emit(event, data, to=tenant_rooms(tenant_id))
+
+def create_graph_session(token):
+    """Graph API session with connection pooling and keep-alive"""
+    session = requests.Session()
+
+    # Idempotent requests only; sends (POST) are never retried
+    retry_strategy = Retry(
+        total=2,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+    )
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=retry_strategy
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    session.headers.update({
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'application/json',
+        'Connection': 'keep-alive'
+    })
+    return session
+
+class RateLimiter:
+    """Token bucket. reserve() books the next send slot and returns how long to wait for it."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Negative balances are slots booked by senders still waiting
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+class Tenant:
+    """One WhatsApp business number"""
+
+    def __init__(self, phone_number_id, token, name=None, send_rate=WHATSAPP_SEND_RATE):
+        self.id = phone_number_id
+        self.token = token
+        self.name = name or phone_number_id
+        self.limiter = RateLimiter(send_rate)
+        self._session = None
+
+    @property
+    def session(self):
+        # Created on first use; the ASGI app talks to Graph through httpx instead
+        if self._session is None:
+            self._session = create_graph_session(self.token)
+        return self._session
+
+    def auth_headers(self):
+        return {'Authorization': f'Bearer {self.token}'}
+
+    def throttle(self):
+        """Block (the green thread) until this number may send again"""
+        wait = self.limiter.reserve()
+        if wait:
+            time.sleep(wait)
+
+class TenantRegistry:
+    def __init__(self, tenants, default_id):
+        self._tenants = {tenant.id: tenant for tenant in tenants}
+        self.default = self._tenants[default_id]
+
+    @classmethod
+    def from_env(cls):
+        config = os.getenv('WHATSAPP_TENANTS')
+        if not config:
+            return cls([Tenant(WHATSAPP_PHONE_ID, WHATSAPP_TOKEN)], WHATSAPP_PHONE_ID)
+        tenants = [
+            Tenant(str(entry['phoneNumberId']), entry['token'], entry.get('name'),
+                   float(entry.get('sendRate', WHATSAPP_SEND_RATE)))
+            for entry in json.loads(config)
+        ]
+        # Records from before multi-tenancy belong to WHATSAPP_PHONE_ID if it's configured
+        ids = [tenant.id for tenant in tenants]
+        return cls(tenants, WHATSAPP_PHONE_ID if WHATSAPP_PHONE_ID in ids else ids[0])
+
+    @property
+    def multi_tenant(self):
+        return len(self._tenants) > 1
+
+    def __iter__(self):
+        return iter(self._tenants.values())
+
+    def get(self, tenant_id=None):
+        """The tenant for a stored tenantId; records without one belong to the default"""
+        if tenant_id is None:
+            return self.default
+        tenant = self._tenants.get(tenant_id)
+        if tenant is None:
+            logger.warning("Unknown tenant %s, using %s", tenant_id, self.default.id)
+            return self.default
+        return tenant
+
+    def resolve(self, phone_number_id):
+        """The tenant a webhook for `phone_number_id` is routed to, or None if it isn't ours"""
+        if not self.multi_tenant:
+            return self.default
+        return self._tenants.get(phone_number_id)
+
+tenants = TenantRegistry.from_env()
+
+def webhook_tenant_id(value):
+    """phone_number_id a webhook change was delivered for"""
+    return (value.get('metadata') or {}).get('phone_number_id')
+
+def conversation_key(phone, tenant_id=None):
+    """Filter selecting one conversation's users document or messages.
+
+    Records without a tenantId belong to the default tenant.
+    """
+    return {'tenantId': tenants.default.id if tenant_id is None else tenant_id, 'phone': phone}
+
+def conversation_tenant_id(db, phone, requested=None):
+    """The number of the conversation with `phone` a request is about: the one
+    asked for, else the one the customer last wrote to"""
+    if requested:
+        return tenants.get(requested).id
+    if not tenants.multi_tenant:
+        return tenants.default.id
+    user = db.users.find_one({'phone': phone}, {'tenantId': 1}, sort=[('lastMessageAt', -1)])
+    return tenants.get((user or {}).get('tenantId')).id
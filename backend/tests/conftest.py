@@ -0,0 +1,52 @@
+import functools
+
+import mongomock
+import pytest
+from mongomock.collection import BulkOperationBuilder, Collection
+
+_aggregate = Collection.aggregate
+
+def _with_new(expression, new):
+    """Substitute the $$new fields of a whenMatched pipeline with literals"""
+    if isinstance(expression, str) and expression.startswith('$$new.'):
+        return {'$literal': new.get(expression[len('$$new.'):])}
+    if isinstance(expression, dict):
+        return {key: _with_new(value, new) for key, value in expression.items()}
+    if isinstance(expression, list):
+        return [_with_new(value, new) for value in expression]
+    return expression
+
+def _aggregate_with_merge(self, pipeline, *args, **kwargs):
+    """mongomock has no $merge; run the rest of the pipeline and replace-or-insert its output.
+
+    whenMatched may be 'replace' or a pipeline run on the matched document.
+    """
+    if not pipeline or '$merge' not in pipeline[-1]:
+        return _aggregate(self, pipeline, *args, **kwargs)
+    merge = pipeline[-1]['$merge']
+    when_matched = merge.get('whenMatched', 'merge')
+    assert (when_matched == 'replace' or isinstance(when_matched, list)) and merge.get('whenNotMatched', 'insert') == 'insert'
+    target = self.database[merge['into']]
+    for doc in _aggregate(self, pipeline[:-1], *args, **kwargs):
+        existing = target.find_one({'_id': doc['_id']})
+        if existing is not None and isinstance(when_matched, list):
+            scratch = self.database['__merge__']
+            scratch.delete_many({})
+            scratch.insert_one(existing)
+            doc = next(_aggregate(scratch, _with_new(when_matched, doc)))
+        target.replace_one({'_id': doc['_id']}, doc, upsert=True)
+    return iter(())
+
+def _without_sort(method):
+    # Newer pymongo passes sort= to bulk update/replace operations, which mongomock doesn't take
+    @functools.wraps(method)
+    def wrapper(self, *args, sort=None, **kwargs):
+        return method(self, *args, **kwargs)
+    return wrapper
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(Collection, 'aggregate', _aggregate_with_merge)
+    monkeypatch.setattr(BulkOperationBuilder, 'add_update', _without_sort(BulkOperationBuilder.add_update))
+    monkeypatch.setattr(BulkOperationBuilder, 'add_replace', _without_sort(BulkOperationBuilder.add_replace))
+    return mongomock.MongoClient(tz_aware=True).whatsapp_crm
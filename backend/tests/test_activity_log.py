@@ -0,0 +1,187 @@
+import base64
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+from bson import ObjectId
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+import activity_log
+from activity_log import ActivityLogWriter, encode_log_cursor, read_archived_logs
+
+IST = pytz.timezone('Asia/Kolkata')
+
+def _entry(action='message_sent', **fields):
+    return dict({'action': action, 'timestamp': datetime.now(IST)}, **fields)
+
+@pytest.fixture
+def writer(db, tmp_path):
+    return ActivityLogWriter(db, spill_path=str(tmp_path / 'spill' / 'activity_logs.spill.ndjson'))
+
+class _FailingLogs:
+    """activity_logs stand-in whose inserts fail with the given error"""
+
+    def __init__(self, collection, error):
+        self.collection = collection
+        self.error = error
+
+    def find(self, *args, **kwargs):
+        return self.collection.find(*args, **kwargs)
+
+    def insert_many(self, docs, ordered=True):
+        error, self.error = self.error, None
+        if error is None:
+            return self.collection.insert_many(docs, ordered=ordered)
+        if isinstance(error, BulkWriteError):
+            # The entries the error doesn't mention were written
+            failed = {err['index'] for err in error.details['writeErrors']}
+            written = [doc for i, doc in enumerate(docs) if i not in failed]
+            if written:
+                self.collection.insert_many(written)
+        raise error
+
+class _DB:
+    def __init__(self, activity_logs):
+        self.activity_logs = activity_logs
+
+def test_flush_writes_buffered_entries(db, writer):
+    for i in range(3):
+        writer.log(_entry(phone=str(i)))
+    assert writer.pending() == 3
+
+    assert writer.flush() == 3
+    assert writer.pending() == 0
+    assert db.activity_logs.count_documents({}) == 3
+
+def test_unreachable_mongo_requeues_the_batch(db, writer):
+    writer.db = _DB(_FailingLogs(db.activity_logs, AutoReconnect('down')))
+    writer.log(_entry())
+
+    assert writer.flush() == 0
+    assert writer.pending() == 1
+    assert writer.flush() == 1
+    assert db.activity_logs.count_documents({}) == 1
+
+def test_retried_entries_already_written_are_not_duplicated(db, writer):
+    entry = _entry()
+    writer.log(entry)
+    writer.flush()
+
+    # Re-queued as if the first write's acknowledgement was lost
+    writer.log(entry)
+    assert writer.flush() == 0
+    assert db.activity_logs.count_documents({}) == 1
+
+def test_rejected_entries_are_spilled_not_dropped(db, writer):
+    error = BulkWriteError({'writeErrors': [{'index': 1, 'code': 2, 'errmsg': 'rejected'}]})
+    writer.db = _DB(_FailingLogs(db.activity_logs, error))
+    writer.log(_entry(phone='ok'))
+    writer.log(_entry(phone='rejected'))
+
+    assert writer.flush() == 1
+    with open(writer.spill_path) as f:
+        [spilled] = [json.loads(line) for line in f]
+    assert spilled['phone'] == 'rejected'
+
+    # The next start replays it with a fresh _id
+    writer.db = db
+    assert writer.replay_spill() == 1
+    assert not os.path.exists(writer.spill_path)
+    assert writer.flush() == 1
+    assert {log['phone'] for log in db.activity_logs.find()} == {'ok', 'rejected'}
+
+def test_duplicate_key_errors_are_dropped(db, writer):
+    error = BulkWriteError({'writeErrors': [{'index': 0, 'code': 11000, 'errmsg': 'duplicate'}]})
+    writer.db = _DB(_FailingLogs(db.activity_logs, error))
+    writer.log(_entry())
+
+    assert writer.flush() == 1
+    assert not os.path.exists(writer.spill_path)
+
+def test_close_spills_what_cannot_be_written(db, writer):
+    writer.db = _DB(_FailingLogs(db.activity_logs, AutoReconnect('down')))
+    writer.log(_entry(phone='1', timestamp=IST.localize(datetime(2024, 5, 1, 10))))
+
+    writer.close()
+
+    writer.db = db
+    assert writer.replay_spill() == 1
+    writer.flush()
+    logged = db.activity_logs.find_one()
+    assert logged['phone'] == '1'
+    assert logged['timestamp'] == datetime(2024, 5, 1, 4, 30, tzinfo=pytz.utc)
+
+@pytest.fixture
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(activity_log, 'ACTIVITY_LOG_ARCHIVE_DIR', str(tmp_path))
+    return tmp_path
+
+def _archive(archive_dir, day, hours, action='message_sent'):
+    """Write one archived entry per IST hour of `day`, oldest first"""
+    with gzip.open(archive_dir / f'activity-logs-{day}.ndjson.gz', 'at') as f:
+        for hour in hours:
+            timestamp = IST.localize(datetime.strptime(day, '%Y-%m-%d') + timedelta(hours=hour))
+            f.write(json.dumps({'id': str(ObjectId()), 'action': action, 'timestamp': timestamp.isoformat()}) + '\n')
+
+def test_archived_logs_newest_first_across_days(archive_dir):
+    _archive(archive_dir, '2024-05-01', [9, 10])
+    _archive(archive_dir, '2024-05-02', [9])
+
+    logs = read_archived_logs({}, 10)
+
+    assert [_archive_hour(log) for log in logs] == [('2024-05-02', 9), ('2024-05-01', 10), ('2024-05-01', 9)]
+
+def test_archived_logs_only_open_days_in_range(archive_dir, monkeypatch):
+    for day in ('2024-05-01', '2024-05-02', '2024-05-03'):
+        _archive(archive_dir, day, [9, 12])
+    opened = []
+    real_open = gzip.open
+    monkeypatch.setattr(activity_log.gzip, 'open', lambda path, mode: opened.append(os.path.basename(path)) or real_open(path, mode))
+
+    logs = read_archived_logs({}, 10, start=IST.localize(datetime(2024, 5, 2, 10)), end=IST.localize(datetime(2024, 5, 2, 23)))
+
+    assert [_archive_hour(log) for log in logs] == [('2024-05-02', 12)]
+    assert opened == ['activity-logs-2024-05-02.ndjson.gz']
+
+def test_archived_logs_stop_at_limit_and_page_with_cursor(archive_dir):
+    _archive(archive_dir, '2024-05-01', [9, 10])
+    _archive(archive_dir, '2024-05-02', [9, 10])
+
+    first = read_archived_logs({}, 2)
+    second = read_archived_logs({}, 2, cursor=encode_log_cursor(first[-1]))
+
+    assert [_archive_hour(log) for log in first] == [('2024-05-02', 10), ('2024-05-02', 9)]
+    assert [_archive_hour(log) for log in second] == [('2024-05-01', 10), ('2024-05-01', 9)]
+
+def test_archived_logs_filter_on_fields(archive_dir):
+    _archive(archive_dir, '2024-05-01', [9], action='status_changed')
+    _archive(archive_dir, '2024-05-01', [10])
+
+    logs = read_archived_logs({'action': 'status_changed'}, 10)
+
+    assert [log['action'] for log in logs] == ['status_changed']
+
+def _archive_hour(log):
+    local = pytz.utc.localize(log['timestamp']).astimezone(IST)
+    return local.strftime('%Y-%m-%d'), local.hour
+
+def test_cursor_round_trip_restricts_to_older_entries():
+    log = {'_id': ObjectId(), 'timestamp': IST.localize(datetime(2024, 5, 1, 10))}
+
+    query = activity_log.apply_log_cursor({'action': 'message_sent'}, encode_log_cursor(log))
+
+    assert query['action'] == 'message_sent'
+    assert query['$or'][1]['_id'] == {'$lt': log['_id']}
+
+@pytest.mark.parametrize('cursor', [
+    'not base64!',
+    base64.urlsafe_b64encode(b'2024-05-01T04:30:00').decode(),
+    base64.urlsafe_b64encode(b'yesterday|' + str(ObjectId()).encode()).decode(),
+    base64.urlsafe_b64encode(b'2024-05-01T04:30:00|not-an-id').decode()
+])
+def test_malformed_cursors_raise_value_error(cursor):
+    with pytest.raises(ValueError, match='Invalid cursor'):
+        activity_log.apply_log_cursor({}, cursor)
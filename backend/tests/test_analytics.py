@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+from bson import ObjectId
+
+import analytics
+from activity_log import ActivityLogWriter
+from analytics import get_analytics, run_analytics_rollup
+
+NOW = pytz.timezone('Asia/Kolkata').localize(datetime(2024, 5, 1, 12, 30))
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = {'value': NOW}
+    monkeypatch.setattr(analytics, '_now', lambda: now['value'])
+    return now
+
+def _message(seconds_ago, direction='inbound', phone='911', sent_by=None):
+    timestamp = NOW - timedelta(seconds=seconds_ago)
+    return {
+        '_id': ObjectId.from_datetime(timestamp),
+        'phone': phone,
+        'direction': direction,
+        'timestamp': timestamp,
+        'sentBy': sent_by
+    }
+
+def _hour(db):
+    return db.analytics_hourly.find_one({'_id': analytics.bucket_start(NOW, 'hour')}) or {}
+
+def test_documents_inside_the_settle_window_wait_for_a_later_run(db, clock):
+    db.messages.insert_many([_message(600), _message(5)])
+
+    assert run_analytics_rollup(db) == 1
+    assert _hour(db)['inbound'] == 1
+
+    clock['value'] = NOW + timedelta(seconds=analytics.ANALYTICS_SETTLE_SECONDS)
+    assert run_analytics_rollup(db) == 1
+    assert _hour(db)['inbound'] == 2
+
+def test_out_of_order_insert_below_the_horizon_is_not_skipped(db, clock):
+    db.messages.insert_one(_message(600))
+    # Newer _id already written, but still inside the settle window
+    db.messages.insert_one(_message(10))
+    run_analytics_rollup(db)
+
+    # An insert that commits late with an older (but unread) _id
+    db.messages.insert_one(_message(20))
+    clock['value'] = NOW + timedelta(seconds=analytics.ANALYTICS_SETTLE_SECONDS)
+    run_analytics_rollup(db)
+
+    assert _hour(db)['inbound'] == 3
+    assert db.analytics_state.find_one({'_id': 'messages'})['lastId'] == ObjectId.from_datetime(NOW - timedelta(seconds=10))
+
+def test_agent_response_time(db, clock):
+    db.messages.insert_many([
+        _message(900),
+        _message(840, direction='outbound'),
+        _message(600, direction='outbound', sent_by='agent-1')
+    ])
+    run_analytics_rollup(db)
+
+    bucket = _hour(db)
+    assert bucket['outboundAuto'] == 1
+    assert bucket['responseCount'] == 1
+    assert bucket['responseTimeTotalMs'] == 300000
+    [row] = get_analytics(db, 'hour', NOW - timedelta(hours=1), NOW)
+    assert row['avgResponseMs'] == 300000
+
+def test_activity_log_ids_are_minted_at_write_time(db, clock):
+    writer = ActivityLogWriter(db)
+    entry = {'action': 'status_changed', 'status': 'onboarded', 'timestamp': NOW - timedelta(hours=1)}
+    writer.log(entry)
+    assert '_id' not in entry
+
+    writer.flush()
+    logged = db.activity_logs.find_one()
+    # Minted by the flush, well inside the window the rollup reads after settling
+    assert logged['_id'].generation_time > datetime.now(pytz.utc) - timedelta(minutes=1)
+
+def test_response_times_are_tracked_per_tenant_conversation(db, clock):
+    db.messages.insert_many([
+        dict(_message(900), tenantId='sales'),
+        dict(_message(840), tenantId='support'),
+        dict(_message(600, direction='outbound', sent_by='agent-1'), tenantId='sales')
+    ])
+    run_analytics_rollup(db)
+
+    # Only the sales conversation was answered; support is still waiting
+    assert _hour(db)['responseTimeTotalMs'] == 300000
+    waiting = {c['_id']['tenantId']: c['awaitingSince'] for c in db.analytics_conversations.find()}
+    assert waiting['sales'] is None and waiting['support'] is not None
+
+def test_phone_keyed_conversations_are_moved_to_the_default_tenant(db, clock):
+    db.analytics_conversations.insert_one({'_id': '911', 'awaitingSince': NOW - timedelta(seconds=900)})
+    db.messages.insert_one(_message(600, direction='outbound', sent_by='agent-1'))
+
+    run_analytics_rollup(db)
+
+    assert _hour(db)['responseCount'] == 1
+    assert db.analytics_conversations.count_documents({'_id': {'$type': 'string'}}) == 0
@@ -0,0 +1,56 @@
+from datetime import datetime
+
+import pytz
+
+import referral_stats
+from http_cache import not_modified_headers
+from message_archive import MESSAGES_VALIDATOR_PROJECTION, mark_conversation_changed, messages_etag
+from outbound import outbound_document, queue_outbound_message
+from referral_stats import apply_user_change, mark_referrals_changed, referrals_etag
+
+def _messages_etag(db, skip=0, limit=100):
+    return messages_etag(db.users.find_one({'phone': '911'}, MESSAGES_VALIDATOR_PROJECTION), skip, limit)
+
+def test_encoded_variants_of_a_validator_match():
+    assert not_modified_headers('abc', '"abc-gzip"')['ETag'] == '"abc-gzip"'
+    assert not_modified_headers('abc', '"abd"') is None
+    assert not_modified_headers(None, '"abc"') is None
+
+def test_messages_validator_follows_the_conversation(db):
+    db.users.insert_one({'phone': '911', 'inboundSeq': 1,
+                         'lastMessageAt': datetime(2024, 5, 1, tzinfo=pytz.utc)})
+    etag = _messages_etag(db)
+    assert _messages_etag(db) == etag
+    assert _messages_etag(db, skip=100) != etag
+
+    queue_outbound_message(db, outbound_document('911', 'hi', 'temp-1', 'a1', 'Agent', '', None))
+    assert _messages_etag(db) != etag
+
+    etag = _messages_etag(db)
+    mark_conversation_changed(db, '911')
+    assert _messages_etag(db) != etag
+
+def test_conversations_without_a_user_are_hashed():
+    assert messages_etag(None, 0, 100) is None
+
+def test_referrals_validator_follows_stats_changes(db, monkeypatch):
+    monkeypatch.setattr(referral_stats.time, 'time', lambda: 1000.0)
+    args = {'page': '1', 'search': 'a'}
+    etag = referrals_etag(db, args)
+    assert referrals_etag(db, dict(args)) == etag
+    assert referrals_etag(db, {'page': '2'}) != etag
+
+    apply_user_change(db, None, {'referredBy': 'asha'})
+    assert referrals_etag(db, args) != etag
+
+    etag = referrals_etag(db, args)
+    mark_referrals_changed(db)
+    assert referrals_etag(db, args) != etag
+
+def test_referrals_validator_expires(db, monkeypatch):
+    now = {'value': 1000.0}
+    monkeypatch.setattr(referral_stats.time, 'time', lambda: now['value'])
+    etag = referrals_etag(db, {})
+
+    now['value'] += referral_stats.REFERRALS_ETAG_WINDOW
+    assert referrals_etag(db, {}) != etag
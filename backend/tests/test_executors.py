@@ -0,0 +1,35 @@
+import eventlet
+import pytest
+
+from executors import BoundedExecutor, ExecutorTimeout, Saturated
+
+def test_call_returns_the_result():
+    executor = BoundedExecutor('test', 1, 0)
+
+    assert executor.call(lambda a, b: a + b, 1, 2, timeout=1) == 3
+
+def test_overrunning_job_raises_an_ordinary_exception():
+    executor = BoundedExecutor('test', 1, 0)
+
+    with pytest.raises(ExecutorTimeout) as error:
+        executor.call(eventlet.sleep, 1, timeout=0.01)
+
+    assert isinstance(error.value, Exception)
+    assert error.value.executor == 'test'
+
+def test_full_executor_sheds_load():
+    executor = BoundedExecutor('test', 1, 1)
+    running = [executor.submit(eventlet.sleep, 0.05) for _ in range(2)]
+
+    with pytest.raises(Saturated):
+        executor.call(lambda: None, timeout=1)
+
+    for job in running:
+        job.wait()
+    assert executor.call(lambda: 'ok', timeout=1) == 'ok'
+
+def test_job_errors_propagate():
+    executor = BoundedExecutor('test', 1, 0, threads=True)
+
+    with pytest.raises(ZeroDivisionError):
+        executor.call(lambda: 1 / 0, timeout=1)
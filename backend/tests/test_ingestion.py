@@ -0,0 +1,126 @@
+from datetime import datetime
+
+import pytest
+import pytz
+
+import whatsapp_handler
+import whatsapp_messages
+from whatsapp_handler import process_incoming_message
+from whatsapp_messages import ensure_message_indexes
+
+IST = pytz.timezone('Asia/Kolkata')
+
+def _parsed(message_id, text='hello', phone='911', tenant_id=None):
+    return {
+        'phone': phone,
+        'message_text': text,
+        'message_id': message_id,
+        'timestamp': IST.localize(datetime(2024, 5, 1, 10)),
+        'message_type': 'text',
+        'button_id': None,
+        'contact_name': 'Asha',
+        'tenant_id': tenant_id
+    }
+
+@pytest.fixture(autouse=True)
+def indexes(db):
+    ensure_message_indexes(db)
+
+@pytest.fixture
+def follow_ups(monkeypatch):
+    spawned = []
+    monkeypatch.setattr(whatsapp_handler.task_registry, 'spawn', lambda kind, payload: spawned.append(payload))
+    return spawned
+
+def _user(db):
+    return db.users.find_one({'phone': '911'})
+
+def test_messages_get_consecutive_seqs(db, follow_ups):
+    assert process_incoming_message(db, None, _parsed('wamid.1'))
+    assert not process_incoming_message(db, None, _parsed('wamid.2'))
+
+    assert [m['seq'] for m in db.messages.find(sort=[('seq', 1)])] == [1, 2]
+    assert (_user(db)['inboundSeq'], _user(db)['unreadCount']) == (2, 2)
+    assert [payload['isNewUser'] for payload in follow_ups] == [True]
+
+def test_redelivery_leaves_the_counters_alone(db, follow_ups):
+    process_incoming_message(db, None, _parsed('wamid.1'))
+
+    assert not process_incoming_message(db, None, _parsed('wamid.1'))
+    process_incoming_message(db, None, _parsed('wamid.2'))
+
+    assert db.messages.count_documents({}) == 2
+    assert (_user(db)['inboundSeq'], _user(db)['unreadCount']) == (2, 2)
+    assert len(follow_ups) == 1
+
+def test_redelivery_the_conversation_forgot_is_uncounted(db, follow_ups, monkeypatch):
+    monkeypatch.setattr(whatsapp_messages, 'INBOUND_DEDUP_WINDOW', 1)
+    process_incoming_message(db, None, _parsed('wamid.1'))
+    process_incoming_message(db, None, _parsed('wamid.2'))
+
+    assert not process_incoming_message(db, None, _parsed('wamid.1'))
+
+    assert db.messages.count_documents({}) == 2
+    assert (_user(db)['inboundSeq'], _user(db)['unreadCount']) == (2, 2)
+
+def test_crash_after_counting_is_resumed_by_the_redelivery(db, follow_ups, monkeypatch):
+    def crash(*args, **kwargs):
+        raise ConnectionError('crashed')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(db.messages, 'insert_one', crash)
+        with pytest.raises(ConnectionError):
+            process_incoming_message(db, None, _parsed('wamid.1'))
+    process_incoming_message(db, None, _parsed('wamid.2'))
+
+    # The interrupted attempt created the user without welcoming them
+    assert process_incoming_message(db, None, _parsed('wamid.1'))
+
+    assert {m['messageId']: m['seq'] for m in db.messages.find()} == {'wamid.1': 1, 'wamid.2': 2}
+    assert (_user(db)['inboundSeq'], _user(db)['unreadCount']) == (2, 2)
+    assert [payload['isNewUser'] for payload in follow_ups] == [True]
+
+def test_concurrent_duplicate_storing_the_message_first_is_not_uncounted(db, follow_ups, monkeypatch):
+    insert_one = db.messages.insert_one
+
+    def duplicate_first(document):
+        # Another request for the same message resumes it before this insert
+        monkeypatch.setattr(db.messages, 'insert_one', insert_one)
+        assert process_incoming_message(db, None, _parsed('wamid.1'))
+        return insert_one(document)
+
+    monkeypatch.setattr(db.messages, 'insert_one', duplicate_first)
+
+    assert not process_incoming_message(db, None, _parsed('wamid.1'))
+
+    assert db.messages.find_one()['seq'] == 1
+    assert (_user(db)['inboundSeq'], _user(db)['unreadCount']) == (1, 1)
+    assert len(follow_ups) == 1
+
+def test_only_one_follow_up_welcomes_a_user(db):
+    db.users.insert_one({'phone': '911', 'welcomePending': True})
+    payload = {'phone': '911', 'isNewUser': True, 'referredBy': 'ravi', 'replyText': None, 'buttons': None}
+
+    whatsapp_handler._inbound_follow_up(db, None, payload)
+    whatsapp_handler._inbound_follow_up(db, None, payload)
+
+    assert 'welcomePending' not in _user(db)
+    assert db.referral_stats.find_one({'_id': 'ravi'})['totalReferred'] == 1
+
+def test_each_number_the_customer_writes_to_is_its_own_conversation(db, follow_ups):
+    process_incoming_message(db, None, _parsed('wamid.1', tenant_id='sales'))
+    process_incoming_message(db, None, _parsed('wamid.2', tenant_id='support'))
+    process_incoming_message(db, None, _parsed('wamid.3', tenant_id='sales'))
+
+    users = {user['tenantId']: user for user in db.users.find({'phone': '911'})}
+    assert (users['sales']['inboundSeq'], users['support']['inboundSeq']) == (2, 1)
+    assert [payload['isNewUser'] for payload in follow_ups] == [True, True]
+
+def test_phone_only_user_key_is_replaced(db):
+    db.users.drop_indexes()
+    db.users.create_index('phone', unique=True)
+
+    ensure_message_indexes(db)
+    db.users.insert_many([{'tenantId': 'sales', 'phone': '911'}, {'tenantId': 'support', 'phone': '911'}])
+
+    assert 'phone_1' not in db.users.index_information()
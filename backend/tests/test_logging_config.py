@@ -0,0 +1,53 @@
+import json
+import logging
+import queue
+
+import logging_config
+from logging_config import JsonFormatter, _DroppingQueueHandler
+
+def _queued(log):
+    records = queue.Queue()
+    logger = logging.getLogger('test.queued')
+    logger.propagate = False
+    logger.handlers = [_DroppingQueueHandler(records)]
+    try:
+        log(logger)
+    finally:
+        logger.handlers = []
+    return records.get_nowait()
+
+def test_queued_exceptions_keep_their_traceback_for_the_listener():
+    def log(logger):
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logger.exception("Failed for %s", '911', extra={'event': 'test.failed'})
+
+    record = _queued(log)
+    entry = json.loads(JsonFormatter().format(record))
+
+    assert record.exc_info is None
+    assert entry['msg'] == 'Failed for 911'
+    assert entry['event'] == 'test.failed'
+    assert 'ZeroDivisionError' in entry['exc']
+    # The text formatter shows it too
+    assert 'ZeroDivisionError' in logging.Formatter().format(record)
+
+def test_unknown_log_level_falls_back_to_info_with_a_warning(monkeypatch, capsys):
+    root = logging.getLogger()
+    handlers, level = root.handlers, root.level
+    monkeypatch.setattr(logging_config, 'LOG_LEVEL', 'LOUD')
+    monkeypatch.setattr(logging_config, 'LOG_FORMAT', 'json')
+    monkeypatch.setattr(logging_config, '_listener', None)
+    monkeypatch.setattr(logging_config.atexit, 'register', lambda func: None)
+    try:
+        listener = logging_config.setup_logging()
+        assert root.level == logging.INFO
+        listener.stop()
+    finally:
+        root.handlers, root.level = handlers, level
+
+    [line] = capsys.readouterr().out.splitlines()
+    entry = json.loads(line)
+    assert entry['level'] == 'WARNING'
+    assert 'LOUD' in entry['msg']
@@ -0,0 +1,103 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from PIL import Image
+
+import media
+from blob_store import LocalBlobStore
+from media import download_media
+from tenants import tenants
+
+def _png():
+    output = io.BytesIO()
+    Image.new('RGB', (640, 480), 'red').save(output, 'PNG')
+    return output.getvalue()
+
+class _GraphMedia:
+    """Graph media lookup and download, as a requests session"""
+
+    def __init__(self, content):
+        self.content = content
+
+    def get(self, url, stream=False, timeout=None):
+        return self
+
+    def json(self):
+        return {'url': 'https://lookaside.example/media', 'mime_type': 'image/png'}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield self.content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+@pytest.fixture
+def graph(monkeypatch, tmp_path):
+    monkeypatch.setattr(media, 'blob_store', LocalBlobStore(str(tmp_path)))
+    monkeypatch.setattr(tenants.default, '_session', _GraphMedia(_png()))
+
+def test_downloads_and_thumbnails_work_from_plain_threads(db, graph):
+    image = {'type': 'image', 'id': 'media-1', 'mimeType': 'image/png', 'status': 'pending'}
+    message_ids = [db.messages.insert_one({'phone': '911', 'media': dict(image)}).inserted_id for _ in range(4)]
+
+    # As the ASGI app runs them: in worker threads, no eventlet hub anywhere
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(lambda message_id: download_media(db, None, message_id, '911', image), message_ids,
+                      timeout=10))
+
+    for message in db.messages.find():
+        assert message['media']['status'] == 'stored'
+        thumbnail = b''.join(media.blob_store.iter_chunks(message['media']['thumbnailKey']))
+        assert Image.open(io.BytesIO(thumbnail)).size == (media.MEDIA_THUMBNAIL_SIZE, 240)
+
+def test_thumbnails_go_through_the_given_runner(db, graph):
+    message_id = db.messages.insert_one({'phone': '911', 'media': {'status': 'pending'}}).inserted_id
+    calls = []
+
+    def run_cpu(func, *args):
+        calls.append(func)
+        return func(*args)
+
+    download_media(db, None, message_id, '911', {'type': 'image', 'id': 'media-1'}, run_cpu=run_cpu)
+
+    assert calls == [media._make_thumbnail]
+
+def test_images_over_the_pixel_cap_get_no_thumbnail(db, graph, monkeypatch):
+    monkeypatch.setattr(media, 'MEDIA_THUMBNAIL_MAX_PIXELS', 640 * 480 - 1)
+    message_id = db.messages.insert_one({'phone': '911', 'media': {'status': 'pending'}}).inserted_id
+
+    download_media(db, None, message_id, '911', {'type': 'image', 'id': 'media-1'})
+
+    message = db.messages.find_one({'_id': message_id})
+    assert message['media']['status'] == 'stored'
+    assert 'thumbnailKey' not in message['media']
+
+class _Unseekable(io.RawIOBase):
+    """A streaming body, like S3's"""
+
+    def __init__(self, f):
+        self.f = f
+
+    def readinto(self, buffer):
+        return self.f.readinto(buffer)
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+def test_unseekable_blobs_are_spooled_for_thumbnailing(db, graph, monkeypatch):
+    store = media.blob_store
+    monkeypatch.setattr(store, 'open', lambda key, open=store.open: _Unseekable(open(key)))
+    message_id = db.messages.insert_one({'phone': '911', 'media': {'status': 'pending'}}).inserted_id
+
+    download_media(db, None, message_id, '911', {'type': 'image', 'id': 'media-1'})
+
+    message = db.messages.find_one({'_id': message_id})
+    assert message['media']['thumbnailKey']
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+import message_archive
+from message_archive import (
+    ARCHIVE_COLLECTION,
+    archive_messages,
+    conversation_cursor,
+    find_message,
+    message_page,
+    page_plan
+)
+
+NOW = datetime.now(pytz.timezone('Asia/Kolkata'))
+
+@pytest.mark.parametrize('hot_count, skip, limit, plan', [
+    (10, 0, 5, ((0, 5), (0, 0))),     # entirely hot
+    (10, 8, 5, ((8, 2), (0, 3))),     # straddles the tiers
+    (10, 10, 5, ((10, 0), (0, 5))),   # starts at the first archived message
+    (10, 25, 5, ((25, 0), (15, 5))),  # deep in the archive
+    (0, 0, 5, ((0, 0), (0, 5)))       # nothing hot
+])
+def test_page_plan(hot_count, skip, limit, plan):
+    assert page_plan(hot_count, skip, limit) == plan
+
+@pytest.fixture
+def conversation(db, monkeypatch):
+    """Twelve messages a day apart, the eight oldest archived"""
+    monkeypatch.setattr(message_archive, 'MESSAGE_ARCHIVE_AFTER_DAYS', 4)
+    db.users.insert_one({'phone': '911'})
+    db.messages.insert_many([
+        {'phone': '911', 'message': str(age), 'timestamp': NOW - timedelta(days=age, hours=1)}
+        for age in range(12)
+    ])
+    db.messages.insert_one({'phone': '922', 'message': 'other', 'timestamp': NOW - timedelta(days=30)})
+    archive_messages(db, batch_size=3)
+
+def _texts(messages):
+    return [msg['message'] for msg in messages]
+
+def test_archiving_moves_old_messages_and_counts_them(db, conversation):
+    assert db.messages.count_documents({'phone': '911'}) == 4
+    assert db[ARCHIVE_COLLECTION].count_documents({'phone': '911'}) == 8
+    user = db.users.find_one({'phone': '911'})
+    assert user['archivedMessages'] == 8
+    # Newest archived message, for the chat list
+    assert user['archivedLastMessage'] == '4'
+
+def test_pages_continue_from_hot_into_archive(db, conversation):
+    first, total = message_page(db, '911', 0, 5, None)
+    second, _ = message_page(db, '911', 5, 5, None)
+    last, _ = message_page(db, '911', 10, 5, None)
+
+    assert total == 12
+    assert _texts(first) == ['0', '1', '2', '3', '4']
+    assert _texts(second) == ['5', '6', '7', '8', '9']
+    assert _texts(last) == ['10', '11']
+
+def test_messages_in_the_outbox_stay_hot(db, monkeypatch):
+    monkeypatch.setattr(message_archive, 'MESSAGE_ARCHIVE_AFTER_DAYS', 1)
+    db.messages.insert_one({'phone': '911', 'message': 'pending', 'timestamp': NOW - timedelta(days=3),
+                            'queuedAt': NOW - timedelta(days=3)})
+
+    assert archive_messages(db) == 0
+
+def test_find_message_and_whole_conversation_span_both_tiers(db, conversation):
+    archived = db[ARCHIVE_COLLECTION].find_one({'message': '11'})
+
+    assert find_message(db, {'_id': archived['_id']})['message'] == '11'
+    assert _texts(conversation_cursor(db, '911', {'message': 1})) == [str(age) for age in range(11, -1, -1)]
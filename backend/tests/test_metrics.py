@@ -0,0 +1,41 @@
+import itertools
+
+import socketio
+from prometheus_client import REGISTRY
+
+from metrics import instrument_socketio
+from tenants import ALL_TENANTS_ROOM, tenant_room, tenant_rooms
+
+def _deliveries(event):
+    return REGISTRY.get_sample_value('crm_socketio_deliveries_total', {'event': event}) or 0
+
+class _SocketIO:
+    """Flask-SocketIO's shape: the python-socketio server is .server"""
+
+    def __init__(self):
+        self.server = socketio.Server()
+        self.emitted = []
+        self.clients = itertools.count()
+
+    def emit(self, event, *args, **kwargs):
+        self.emitted.append(event)
+
+    def join(self, room):
+        sid = self.server.manager.connect(f'eio-{next(self.clients)}', '/')
+        self.server.manager.enter_room(sid, '/', room)
+        return sid
+
+def test_room_emits_count_each_client_in_the_rooms():
+    sio = _SocketIO()
+    instrument_socketio(sio)
+    sales = [sio.join(tenant_room('sales')) for _ in range(3)]
+    sio.join(tenant_room('support'))
+    sio.join(ALL_TENANTS_ROOM)
+
+    before = _deliveries('room_event')
+    sio.emit('room_event', {}, to=tenant_rooms('sales'))
+    assert _deliveries('room_event') - before == 4
+
+    sio.emit('room_event', {}, to=sales[0])
+    assert _deliveries('room_event') - before == 5
+    assert sio.emitted == ['room_event', 'room_event']
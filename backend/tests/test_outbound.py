@@ -0,0 +1,101 @@
+from datetime import timedelta
+
+import pytest
+
+import outbound
+from outbound import (
+    INTERRUPTED_SEND_ERROR,
+    OUTBOUND_REDISPATCH_AFTER,
+    OUTBOUND_SEND_LEASE,
+    dispatch_outbound_message,
+    ensure_outbound_indexes,
+    outbound_document,
+    queue_outbound_message,
+    recover_outbound,
+    status_event
+)
+
+@pytest.fixture(autouse=True)
+def indexes(db):
+    ensure_outbound_indexes(db)
+
+def _queue(db, temp_id='temp-1'):
+    message, queued = queue_outbound_message(db, outbound_document('911', 'hi', temp_id, 'a1', 'Agent', '', 'tenant'))
+    return message, queued
+
+def _sender(response):
+    calls = []
+
+    def send(phone, message, tenant_id=None):
+        calls.append((phone, message, tenant_id))
+        return response
+    send.calls = calls
+    return send
+
+def test_successful_send_goes_pending_sending_sent(db):
+    message, queued = _queue(db)
+    assert queued and message['status'] == 'pending'
+
+    send = _sender({'messages': [{'id': 'wamid.1'}]})
+    sent = dispatch_outbound_message(db, message['_id'], send)
+
+    assert send.calls == [('911', 'hi', 'tenant')]
+    assert sent['status'] == 'sent' and sent['whatsappMessageId'] == 'wamid.1'
+    assert sent['sendAttempts'] == 1
+    assert 'queuedAt' not in sent and 'sendingAt' not in sent
+    assert status_event(sent)['tenantId'] == 'tenant'
+
+def test_only_one_dispatcher_sends(db):
+    message, _ = _queue(db)
+    send = _sender({'messages': [{'id': 'wamid.1'}]})
+
+    dispatch_outbound_message(db, message['_id'], send)
+
+    assert dispatch_outbound_message(db, message['_id'], send) is None
+    assert len(send.calls) == 1
+
+def test_failed_send_records_the_error(db):
+    message, _ = _queue(db)
+
+    failed = dispatch_outbound_message(db, message['_id'], _sender({'error': {'message': 'Rate limited'}}))
+
+    assert failed['status'] == 'failed' and failed['sendError'] == 'Rate limited'
+    assert 'queuedAt' not in failed
+
+def test_same_temp_id_is_not_sent_twice(db):
+    message, _ = _queue(db)
+    dispatch_outbound_message(db, message['_id'], _sender({'messages': [{'id': 'wamid.1'}]}))
+
+    again, queued = _queue(db)
+
+    assert not queued
+    assert again['_id'] == message['_id'] and again['status'] == 'sent'
+
+def test_failed_message_is_requeued_by_its_temp_id(db):
+    message, _ = _queue(db)
+    dispatch_outbound_message(db, message['_id'], _sender({'error': 'down'}))
+
+    again, queued = _queue(db)
+
+    assert queued
+    assert again['_id'] == message['_id'] and again['status'] == 'pending'
+    assert 'sendError' not in again
+    sent = dispatch_outbound_message(db, message['_id'], _sender({'messages': [{'id': 'wamid.2'}]}))
+    assert sent['sendAttempts'] == 2
+
+def test_recovery_redispatches_orphans_and_fails_stuck_sends(db, monkeypatch):
+    orphan, _ = _queue(db, 'temp-orphan')
+    stuck, _ = _queue(db, 'temp-stuck')
+    db.messages.update_one({'_id': stuck['_id']}, outbound.claim_update())
+    fresh, _ = _queue(db, 'temp-fresh')
+
+    later = outbound._now() + max(OUTBOUND_REDISPATCH_AFTER, OUTBOUND_SEND_LEASE) + timedelta(seconds=1)
+    db.messages.update_one({'_id': fresh['_id']}, {'$set': {'queuedAt': later}})
+    monkeypatch.setattr(outbound, '_now', lambda: later)
+
+    pending, failed = recover_outbound(db)
+
+    assert pending == [orphan['_id']]
+    assert [message['_id'] for message in failed] == [stuck['_id']]
+    assert failed[0]['status'] == 'failed' and failed[0]['sendError'] == INTERRUPTED_SEND_ERROR
+    assert recover_outbound(db) == ([orphan['_id']], [])
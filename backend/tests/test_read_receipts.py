@@ -0,0 +1,141 @@
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+from bson import ObjectId
+
+from message_archive import ARCHIVE_COLLECTION
+from read_receipts import (
+    agent_unread_count,
+    backfill_read_state_tenants,
+    ensure_read_state_indexes,
+    get_agent_read_seqs,
+    mark_conversation_read,
+    mark_read,
+    resolve_read_seq,
+    resolve_watermark
+)
+
+IST = pytz.timezone('Asia/Kolkata')
+START = IST.localize(datetime(2024, 5, 1, 10))
+
+def _inbound(db, phone, minutes, seq, collection='messages', tenant_id=None):
+    message = {
+        '_id': ObjectId(),
+        'tenantId': tenant_id,
+        'phone': phone,
+        'direction': 'inbound',
+        'timestamp': START + timedelta(minutes=minutes),
+        'isRead': False,
+        'seq': seq,
+        'messageId': f'wamid.{seq}'
+    }
+    db[collection].insert_one(message)
+    return message
+
+@pytest.fixture
+def conversation(db):
+    db.users.insert_one({'phone': '911', 'unreadCount': 3, 'inboundSeq': 3})
+    return [_inbound(db, '911', minute, seq) for seq, minute in enumerate((0, 5, 10), start=1)]
+
+def test_mark_read_up_to_watermark_updates_the_counter(db, conversation):
+    marked, unread = mark_read(db, '911', conversation[1]['timestamp'])
+
+    assert (marked, unread) == (2, 1)
+    assert db.messages.count_documents({'isRead': False}) == 1
+
+    # Marking the same range again changes nothing
+    assert mark_read(db, '911', conversation[1]['timestamp']) == (0, 1)
+
+def test_watermark_defaults_to_now_and_message_id_wins(db, conversation):
+    up_to = START + timedelta(minutes=7)
+    assert resolve_watermark(db, '911', up_to) == up_to
+    assert resolve_watermark(db, '911', up_to, str(conversation[0]['_id'])) == conversation[0]['timestamp']
+    assert resolve_watermark(db, '911') > conversation[-1]['timestamp']
+
+@pytest.mark.parametrize('resolve', [resolve_watermark, resolve_read_seq])
+def test_malformed_message_id_is_a_value_error(db, conversation, resolve):
+    with pytest.raises(ValueError, match='Invalid messageId'):
+        resolve(db, '911', message_id='not-an-id')
+
+@pytest.mark.parametrize('resolve', [resolve_watermark, resolve_read_seq])
+def test_message_of_another_conversation_is_not_found(db, conversation, resolve):
+    other = _inbound(db, '922', 0, 1)
+    with pytest.raises(ValueError, match='Message not found'):
+        resolve(db, '911', message_id=str(other['_id']))
+
+def test_archived_messages_can_be_watermarks(db, conversation):
+    archived = _inbound(db, '911', -60, 0, collection=ARCHIVE_COLLECTION)
+
+    assert resolve_watermark(db, '911', message_id=str(archived['_id'])) == archived['timestamp']
+    assert resolve_read_seq(db, '911', str(archived['_id'])) == 0
+
+def test_read_seq_of_an_outbound_message_counts_both_tiers(db, conversation):
+    _inbound(db, '911', -60, 0, collection=ARCHIVE_COLLECTION)
+    outbound = {'_id': ObjectId(), 'phone': '911', 'direction': 'outbound', 'timestamp': START + timedelta(minutes=6)}
+    db.messages.insert_one(outbound)
+
+    assert resolve_read_seq(db, '911', str(outbound['_id'])) == 3
+
+def test_mark_conversation_read_rejects_bad_ids_before_writing(db, conversation):
+    with pytest.raises(ValueError):
+        mark_conversation_read(db, '911', {'messageId': 'zzz'})
+    assert db.messages.count_documents({'isRead': False}) == 3
+
+@pytest.mark.parametrize('up_to', [1700000000, ['2024-01-01'], {'at': '2024-01-01'}])
+def test_non_string_up_to_is_a_value_error(db, conversation, up_to):
+    with pytest.raises(ValueError, match='upTo'):
+        mark_conversation_read(db, '911', {'upTo': up_to})
+    assert db.messages.count_documents({'isRead': False}) == 3
+
+def test_agent_unread_counts_are_independent(db, conversation):
+    mark_conversation_read(db, '911', {'agentId': 'a1', 'messageId': str(conversation[1]['_id'])})
+    chat = {'phone': '911', 'inboundSeq': 3, 'unreadCount': db.users.find_one({'phone': '911'})['unreadCount']}
+
+    assert agent_unread_count(chat, get_agent_read_seqs(db, 'a1')) == 1
+    # a2 has never opened the conversation: the shared counter a1 cleared doesn't apply
+    assert agent_unread_count(chat, get_agent_read_seqs(db, 'a2')) == 3
+
+def test_agent_watermark_only_moves_forward(db, conversation):
+    _, response, event = mark_conversation_read(db, '911', {'agentId': 'a1'})
+    assert response['unreadCount'] == 0 and event['agentUnreadCount'] == 0
+
+    _, response, _ = mark_conversation_read(db, '911', {'agentId': 'a1', 'messageId': str(conversation[0]['_id'])})
+    assert response['unreadCount'] == 0
+    assert get_agent_read_seqs(db, 'a1') == {(None, '911'): 3}
+
+def test_new_inbound_messages_are_unread_for_every_agent(db, conversation):
+    mark_conversation_read(db, '911', {'agentId': 'a1'})
+    _inbound(db, '911', 15, 4)
+    db.users.update_one({'phone': '911'}, {'$inc': {'inboundSeq': 1}})
+
+    chat = {'phone': '911', 'inboundSeq': 4}
+    assert agent_unread_count(chat, get_agent_read_seqs(db, 'a1')) == 1
+    assert agent_unread_count(chat, get_agent_read_seqs(db, 'a2')) == 4
+
+def test_each_number_has_its_own_read_state(db):
+    ensure_read_state_indexes(db)
+    for tenant_id in ('sales', 'support'):
+        db.users.insert_one({'tenantId': tenant_id, 'phone': '911', 'unreadCount': 2, 'inboundSeq': 2})
+        for seq in (1, 2):
+            _inbound(db, '911', seq, seq, tenant_id=tenant_id)
+
+    _, response, event = mark_conversation_read(db, '911', {'agentId': 'a1'}, tenant_id='sales')
+
+    assert response['marked'] == 2 and event['tenantId'] == 'sales'
+    assert db.users.find_one({'tenantId': 'support', 'phone': '911'})['unreadCount'] == 2
+    assert db.messages.count_documents({'tenantId': 'support', 'isRead': False}) == 2
+    read_seqs = get_agent_read_seqs(db, 'a1')
+    assert agent_unread_count({'tenantId': 'sales', 'phone': '911', 'inboundSeq': 2}, read_seqs) == 0
+    assert agent_unread_count({'tenantId': 'support', 'phone': '911', 'inboundSeq': 2}, read_seqs) == 2
+
+def test_read_states_from_before_tenants_are_moved_to_their_conversation(db):
+    db.read_states.create_index([('agentId', 1), ('phone', 1)], unique=True)
+    db.users.insert_one({'tenantId': 'sales', 'phone': '911'})
+    db.read_states.insert_one({'agentId': 'a1', 'phone': '911', 'readSeq': 2})
+
+    ensure_read_state_indexes(db)
+    backfill_read_state_tenants(db)
+
+    assert 'agentId_1_phone_1' not in db.read_states.index_information()
+    assert get_agent_read_seqs(db, 'a1') == {('sales', '911'): 2}
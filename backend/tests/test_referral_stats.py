@@ -0,0 +1,137 @@
+from datetime import timedelta
+
+import pytest
+from bson import ObjectId
+
+import referral_stats
+from referral_stats import (
+    TOTALS_ID,
+    apply_user_change,
+    get_referral_totals,
+    get_referrer_stats,
+    rebuild_referral_stats
+)
+
+def _referrer(db, name):
+    return db.referral_stats.find_one({'_id': name})
+
+def _hold_lock(db, expires_in):
+    db.referral_stats.insert_one({
+        '_id': TOTALS_ID, 'kind': 'totals', 'version': 7, 'rebuilding': ObjectId(),
+        'rebuildExpiresAt': referral_stats._now() + expires_in, 'pendingUsers': []
+    })
+
+def _locked(db):
+    return db.referral_stats.find_one({'_id': TOTALS_ID, 'rebuilding': {'$ne': None}}) is not None
+
+def test_rebuild_counts_referrers_and_totals(db):
+    db.users.insert_many([
+        {'phone': '1', 'referredBy': 'asha', 'subscriptionStatus': 'active'},
+        {'phone': '2', 'referredBy': 'asha'},
+        {'phone': '3', 'referredBy': 'ravi', 'subscriptionStatus': 'active'},
+        {'phone': '4', 'referredBy': ''},
+        {'phone': '5'}
+    ])
+
+    assert rebuild_referral_stats(db)
+
+    assert get_referral_totals(db) == {'totalUsers': 5, 'referredUsers': 3, 'subscribedUsers': 2}
+    stats = get_referrer_stats(db, ['asha', 'ravi'])
+    assert stats['asha']['totalReferred'] == 2 and stats['asha']['subscribedCount'] == 1
+    assert stats['ravi']['totalReferred'] == 1 and stats['ravi']['subscribedCount'] == 1
+    assert not _locked(db)
+
+def test_rebuild_moves_the_totals_version_on(db):
+    db.users.insert_one({'phone': '1', 'referredBy': 'asha'})
+    apply_user_change(db, None, {'phone': '2'})
+    version = db.referral_stats.find_one({'_id': TOTALS_ID})['version']
+
+    rebuild_referral_stats(db)
+
+    totals = db.referral_stats.find_one({'_id': TOTALS_ID})
+    assert totals['version'] == version + 1 and totals['updatedAt']
+    assert totals['totalUsers'] == 1
+
+def test_rebuild_removes_referrers_from_older_generations(db):
+    db.users.insert_one({'phone': '1', 'referredBy': 'asha'})
+    # Stamped by a clock far ahead of this one: only the generation decides
+    db.referral_stats.insert_one({
+        '_id': 'gone', 'kind': 'referrer', 'totalReferred': 3, 'subscribedCount': 0,
+        'generation': ObjectId(), 'updatedAt': referral_stats._now() + timedelta(days=1)
+    })
+
+    rebuild_referral_stats(db)
+
+    assert _referrer(db, 'gone') is None
+    assert _referrer(db, 'asha')['totalReferred'] == 1
+
+def test_rebuild_skips_while_another_holds_the_lock(db):
+    _hold_lock(db, timedelta(minutes=5))
+
+    assert not rebuild_referral_stats(db)
+    assert 'totalUsers' not in db.referral_stats.find_one({'_id': TOTALS_ID})
+
+def test_rebuild_takes_over_an_expired_lock(db):
+    db.users.insert_one({'phone': '1', 'referredBy': 'asha'})
+    _hold_lock(db, -timedelta(seconds=1))
+
+    assert rebuild_referral_stats(db)
+    assert _referrer(db, 'asha')['totalReferred'] == 1
+    assert not _locked(db)
+
+def test_incremental_updates_follow_user_changes(db):
+    apply_user_change(db, None, {'referredBy': 'asha'})
+    apply_user_change(db, None, {'phone': '2'})
+    apply_user_change(db, {'referredBy': 'asha'}, {'referredBy': 'asha', 'subscriptionStatus': 'active'})
+
+    assert get_referral_totals(db) == {'totalUsers': 2, 'referredUsers': 1, 'subscribedUsers': 1}
+    asha = _referrer(db, 'asha')
+    assert asha['totalReferred'] == 1 and asha['subscribedCount'] == 1
+
+    apply_user_change(db, {'referredBy': 'asha', 'subscriptionStatus': 'active'}, None)
+    assert get_referral_totals(db) == {'totalUsers': 1, 'referredUsers': 0, 'subscribedUsers': 0}
+    assert _referrer(db, 'asha')['totalReferred'] == 0
+
+def test_unchanged_user_is_a_no_op(db):
+    apply_user_change(db, {'referredBy': 'asha', 'name': 'A'}, {'referredBy': 'asha', 'name': 'B'})
+    assert db.referral_stats.count_documents({}) == 0
+
+def test_incremental_update_without_a_user_waits_for_a_running_rebuild(db, monkeypatch):
+    _hold_lock(db, timedelta(minutes=5))
+    polls = []
+
+    def finish_rebuild(seconds):
+        polls.append(seconds)
+        db.referral_stats.update_one({'_id': TOTALS_ID}, {'$unset': {'rebuilding': ''}})
+
+    monkeypatch.setattr(referral_stats.time, 'sleep', finish_rebuild)
+    apply_user_change(db, None, {'referredBy': 'asha'})
+
+    assert len(polls) == 1
+    assert _referrer(db, 'asha')['totalReferred'] == 1
+
+@pytest.mark.parametrize('step', ['_wait_for_changes', '_reconcile_pending_users'])
+def test_change_during_a_rebuild_is_counted_once(db, monkeypatch, step):
+    """The users write lands before the snapshot (it counts it) or after it (it doesn't)"""
+    db.users.insert_one({'phone': '1', 'referredBy': 'asha'})
+    original = getattr(referral_stats, step)
+
+    def change_then_continue(*args):
+        user_id = db.users.insert_one({'phone': '2', 'referredBy': 'asha', 'subscriptionStatus': 'active'}).inserted_id
+        apply_user_change(db, None, {'referredBy': 'asha', 'subscriptionStatus': 'active'}, user_id)
+        db.users.update_one({'phone': '1'}, {'$set': {'subscriptionStatus': 'active'}})
+        apply_user_change(db, {'referredBy': 'asha'}, {'referredBy': 'asha', 'subscriptionStatus': 'active'},
+                          db.users.find_one({'phone': '1'})['_id'])
+        return original(*args)
+
+    monkeypatch.setattr(referral_stats, step, change_then_continue)
+    assert rebuild_referral_stats(db)
+
+    assert get_referral_totals(db) == {'totalUsers': 2, 'referredUsers': 2, 'subscribedUsers': 2}
+    asha = _referrer(db, 'asha')
+    assert asha['totalReferred'] == 2 and asha['subscribedCount'] == 2
+    assert not _locked(db)
+
+    # Later changes go straight to the stats again
+    apply_user_change(db, None, {'phone': '3'})
+    assert get_referral_totals(db)['totalUsers'] == 3
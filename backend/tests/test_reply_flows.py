@@ -0,0 +1,135 @@
+import pytest
+
+from reply_flows import (
+    DEFAULT_RULES, FlowEngine, KeywordAutomaton, delete_rule, extract_referral, rules_fingerprint, save_rule, validate_rule
+)
+
+def _engine(*rules):
+    engine = FlowEngine()
+    engine.compile(list(rules))
+    return engine
+
+def _keyword(rule_id, keywords, priority=100, whole_word=True, template=None):
+    return {
+        '_id': rule_id, 'kind': 'keyword', 'keywords': keywords,
+        'priority': priority, 'wholeWord': whole_word, 'template': template or rule_id
+    }
+
+def test_automaton_finds_every_occurrence_including_overlaps():
+    automaton = KeywordAutomaton([('he', 'he'), ('she', 'she'), ('his', 'his'), ('hers', 'hers')])
+
+    matches = sorted(automaton.search('ushers'))
+
+    assert matches == [(1, 4, 'she'), (2, 4, 'he'), (2, 6, 'hers')]
+
+def test_automaton_is_case_insensitive_and_skips_empty_keywords():
+    automaton = KeywordAutomaton([('Refund', 'refund'), ('', 'empty')])
+
+    assert list(automaton.search('REFUND please')) == [(0, 6, 'refund')]
+
+def test_whole_word_keywords_need_word_boundaries():
+    engine = _engine(_keyword('price', ['price']))
+
+    assert engine.match_keyword('What is the price?').id == 'price'
+    assert engine.match_keyword('price').id == 'price'
+    assert engine.match_keyword('pricey stuff') is None
+    assert engine.match_keyword('overpriced') is None
+
+def test_substring_keywords_match_inside_words():
+    engine = _engine(_keyword('price', ['price'], whole_word=False))
+
+    assert engine.match_keyword('overpriced').id == 'price'
+
+def test_multi_word_keywords():
+    engine = _engine(_keyword('refund', ['money back']))
+
+    assert engine.match_keyword('I want my Money Back now').id == 'refund'
+    assert engine.match_keyword('moneyback') is None
+
+def test_lowest_priority_wins_then_rule_order():
+    engine = _engine(
+        _keyword('general', ['help'], priority=50),
+        _keyword('urgent', ['urgent'], priority=10),
+        _keyword('also_help', ['help'], priority=50)
+    )
+
+    assert engine.match_keyword('help, this is urgent').id == 'urgent'
+    assert engine.match_keyword('help me').id == 'general'
+
+def test_disabled_and_unknown_rules_are_ignored():
+    engine = _engine(
+        dict(_keyword('off', ['hello']), enabled=False),
+        {'_id': 'odd', 'kind': 'other', 'template': 'x'}
+    )
+
+    assert engine.match_keyword('hello') is None
+    assert engine.reply_for('hello') == (None, None)
+
+def test_reply_for_welcome_buttons_and_templates():
+    engine = _engine(*DEFAULT_RULES, _keyword('hi', ['hi'], template='Hi $name ($phone)'))
+
+    text, buttons = engine.reply_for('hi', is_new_user=True)
+    assert text.startswith("Hey there! I'm faff!")
+    assert [b['reply']['id'] for b in buttons] == ['know_more', 'onboard_direct']
+
+    text, buttons = engine.reply_for('', button_id='pricing')
+    assert text.startswith('Our Pricing Plans')
+    assert engine.reply_for('', button_id='unknown') == (None, None)
+
+    assert engine.reply_for('hi', context={'name': 'Asha', 'phone': '911'}) == ('Hi Asha (911)', None)
+    # Missing placeholders are left as they are
+    assert engine.reply_for('hi') == ('Hi $name ($phone)', None)
+
+@pytest.mark.parametrize('rule, error', [
+    ({'kind': 'keyword', 'template': 'x', 'keywords': ['a']}, '_id'),
+    ({'_id': 'r', 'kind': 'nope', 'template': 'x'}, 'kind'),
+    ({'_id': 'r', 'kind': 'welcome'}, 'template'),
+    ({'_id': 'r', 'kind': 'button', 'template': 'x'}, 'buttonId'),
+    ({'_id': 'r', 'kind': 'keyword', 'template': 'x', 'keywords': ['ok', ' ']}, 'keywords'),
+    ({'_id': 'r', 'kind': 'welcome', 'template': 'x', 'buttons': [{'id': 'b'}]}, 'buttons')
+])
+def test_validate_rule_rejects_malformed_rules(rule, error):
+    with pytest.raises(ValueError, match=error):
+        validate_rule(rule)
+
+def test_saved_rules_are_picked_up_on_reload(db):
+    engine = FlowEngine()
+    engine.load(db)
+    assert engine.match_keyword('refund') is None
+
+    save_rule(db, _keyword('refund', ['refund']))
+    engine.load(db)
+
+    assert engine.match_keyword('refund please').id == 'refund'
+
+def test_extract_referral():
+    assert extract_referral('Hi, I was Referred by Asha Rao.') == 'Asha Rao'
+    assert extract_referral('referred by') is None
+    assert extract_referral('hello') is None
+
+def test_compile_swaps_in_one_set_of_tables():
+    engine = _engine(_keyword('refund', ['refund']))
+    before = engine.tables
+
+    engine.compile([_keyword('price', ['price'])])
+
+    assert before.automaton is not engine.tables.automaton
+    assert engine.match_keyword('refund', before).id == 'refund'
+    assert engine.match_keyword('refund') is None
+
+def test_fingerprint_changes_on_delete_and_insert_with_the_same_count(db):
+    save_rule(db, _keyword('refund', ['refund']))
+    save_rule(db, _keyword('price', ['price']))
+    engine = FlowEngine()
+    engine.load(db)
+    latest = db.reply_rules.find_one({'_id': 'price'})['updatedAt']
+
+    # Count and newest updatedAt end up as they were
+    delete_rule(db, 'refund')
+    save_rule(db, _keyword('hours', ['hours']))
+    db.reply_rules.update_one({'_id': 'hours'}, {'$set': {'updatedAt': latest}})
+
+    assert rules_fingerprint(db) != engine.fingerprint
+    engine.load(db)
+    assert engine.match_keyword('hours').id == 'hours'
+    assert engine.match_keyword('refund') is None
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+import tracing
+from tracing import TracingMiddleware, current_trace_id, end_trace, parse_traceparent, start_trace
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+
+@pytest.fixture(autouse=True)
+def _clean_trace():
+    yield
+    end_trace()
+
+def test_well_formed_trace_id_is_kept():
+    assert start_trace(TRACE_ID) == TRACE_ID
+    assert start_trace(TRACE_ID.upper()) == TRACE_ID
+
+@pytest.mark.parametrize('header', [
+    'abc',
+    TRACE_ID + '00',
+    'g' * 32,
+    '0' * 32,
+    "<script>'" + 'a' * 23,
+    ''
+])
+def test_malformed_trace_id_is_replaced(header):
+    trace_id = start_trace(header)
+    assert trace_id != header
+    assert len(trace_id) == 32 and int(trace_id, 16)
+    assert current_trace_id() == trace_id
+
+def test_traceparent_parsing():
+    assert parse_traceparent(f'00-{TRACE_ID}-00f067aa0ba902b7-01') == (TRACE_ID, '00f067aa0ba902b7')
+    assert parse_traceparent(f'00-{TRACE_ID}-00f067aa0ba9zzzz-01') == (None, None)
+    assert parse_traceparent('00-' + '0' * 32 + '-00f067aa0ba902b7-01') == (None, None)
+    assert parse_traceparent(None) == (None, None)
+
+@pytest.fixture
+def context_vars(monkeypatch):
+    monkeypatch.setattr(tracing, '_context', tracing._ContextLocal())
+
+def test_concurrent_tasks_keep_their_own_trace(context_vars):
+    async def request(trace_id):
+        start_trace(trace_id)
+        await asyncio.sleep(0)
+        # Worker threads see the trace of the task that started them
+        return current_trace_id(), await asyncio.to_thread(current_trace_id)
+
+    async def main():
+        return await asyncio.gather(request('a' * 32), request('b' * 32))
+
+    assert asyncio.run(main()) == [('a' * 32,) * 2, ('b' * 32,) * 2]
+    assert current_trace_id() is None
+
+def test_middleware_returns_the_trace_id(context_vars):
+    seen = []
+    sent = []
+
+    async def app(scope, receive, send):
+        seen.append(current_trace_id())
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': 'GET', 'path': '/api/chats',
+             'headers': [(b'traceparent', f'00-{TRACE_ID}-00f067aa0ba902b7-01'.encode())]}
+    asyncio.run(TracingMiddleware(app)(scope, None, send))
+
+    assert seen == [TRACE_ID]
+    assert sent[0]['headers'] == [(b'x-trace-id', TRACE_ID.encode())]
@@ -0,0 +1,99 @@
+import hashlib
+import hmac
+import json
+import time
+
+import pytest
+
+from webhook_security import ReplayCache, WebhookGuard, delivery_key
+
+SECRET = b'app-secret'
+
+def _sign(body, secret=SECRET):
+    return 'sha256=' + hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+def _delivery(messages=(), statuses=(), entry_id='waba-1'):
+    return {'entry': [{'id': entry_id, 'changes': [{'field': 'messages', 'value': {
+        'messages': [{'id': message_id, 'timestamp': str(stamp)} for message_id, stamp in messages],
+        'statuses': [{'id': status_id, 'status': status, 'timestamp': str(stamp)} for status_id, status, stamp in statuses]
+    }}]}]}
+
+@pytest.fixture
+def guard():
+    return WebhookGuard(secrets=[SECRET], replay_cache=ReplayCache(10))
+
+def test_only_bodies_signed_with_a_known_secret_pass(guard):
+    body = b'{"entry": []}'
+
+    assert guard.check(body, _sign(body)) is None
+    assert guard.check(body, _sign(body).upper().replace('SHA256=', 'sha256=')) is None
+    assert guard.check(body, _sign(body, b'other')) == 403
+    assert guard.check(body + b' ', _sign(body)) == 403
+    assert guard.check(body, None) == 403
+    assert guard.check(body, _sign(body)[len('sha256='):]) == 403
+
+def test_any_tenant_secret_is_accepted():
+    guard = WebhookGuard(secrets=[SECRET, b'tenant-secret'])
+    body = b'{}'
+
+    assert guard.check(body, _sign(body, b'tenant-secret')) is None
+
+def test_missing_secret_fails_closed_unless_opted_out():
+    assert WebhookGuard(secrets=[]).check(b'{}', None) == 503
+    assert WebhookGuard(secrets=[], allow_unsigned=True).check(b'{}', None) is None
+
+def test_processed_deliveries_are_skipped_once_remembered(guard):
+    data = _delivery(messages=[('wamid.1', int(time.time()))])
+
+    status, key = guard.screen(data)
+    assert status is None
+    # Failed half-way: not remembered, so a retry is processed again
+    assert guard.screen(data) == (None, key)
+
+    guard.remember(key)
+    assert guard.screen(data) == (200, key)
+
+@pytest.mark.parametrize('data', [[], [{'entry': []}], 'entry', 42, None])
+def test_signed_bodies_that_are_not_objects_are_refused(guard, data):
+    body = json.dumps(data).encode()
+
+    assert guard.check(body, _sign(body)) is None
+    assert guard.screen(json.loads(body)) == (400, None)
+
+def test_key_ignores_layout_but_not_content():
+    now = int(time.time())
+    data = _delivery(messages=[('wamid.1', now), ('wamid.2', now)])
+    reordered = _delivery(messages=[('wamid.2', now), ('wamid.1', now)])
+    reserialized = json.loads(json.dumps(data, indent=2))
+
+    assert delivery_key(data) == delivery_key(reordered) == delivery_key(reserialized)
+    assert delivery_key(data) != delivery_key(_delivery(messages=[('wamid.1', now)]))
+    assert delivery_key(data) != delivery_key(_delivery(messages=[('wamid.1', now), ('wamid.2', now)], entry_id='waba-2'))
+
+def test_statuses_of_one_message_have_distinct_keys():
+    now = int(time.time())
+
+    assert delivery_key(_delivery(statuses=[('wamid.1', 'delivered', now)])) != \
+        delivery_key(_delivery(statuses=[('wamid.1', 'read', now)]))
+
+def test_changes_without_ids_are_keyed_by_content():
+    template = {'entry': [{'id': 'waba-1', 'changes': [{'field': 'message_template_status_update', 'value': {'event': 'APPROVED'}}]}]}
+    rejected = {'entry': [{'id': 'waba-1', 'changes': [{'field': 'message_template_status_update', 'value': {'event': 'REJECTED'}}]}]}
+
+    assert delivery_key(template) != delivery_key(rejected)
+
+def test_stale_deliveries_are_acknowledged_unprocessed(guard):
+    old = int(time.time()) - guard.max_age - 60
+
+    assert guard.screen(_delivery(messages=[('wamid.1', old)])) == (200, None)
+    assert guard.screen(_delivery(messages=[('wamid.1', old), ('wamid.2', int(time.time()))]))[0] is None
+
+def test_replay_cache_evicts_least_recently_used():
+    cache = ReplayCache(2)
+    for key in ('a', 'b'):
+        cache.remember(key)
+    cache.seen('a')
+    cache.remember('c')
+
+    assert cache.seen('a') and cache.seen('c')
+    assert not cache.seen('b')
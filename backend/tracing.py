@@ -0,0 +1,384 @@
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import requests
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Lightweight request tracing.
+#
+# Every webhook delivery or API request gets a trace id (taken from an incoming
+# traceparent/X-Trace-Id header when present). Spans for Mongo commands, outbound
+# HTTP calls and Socket.IO emits are recorded against it and exported in batches
+# by a background thread.
+#
+# TRACE_EXPORTER: none (default), file or otlp
+# TRACE_FILE: NDJSON file the file exporter appends spans to
+# TRACE_OTLP_ENDPOINT: OTLP/HTTP JSON collector, e.g. http://localhost:4318/v1/traces
+TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', 'none').lower()
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces.ndjson')
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACE_SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'faff-crm-backend')
+TRACE_BATCH_SIZE = int(os.getenv('TRACE_BATCH_SIZE', 200))
+TRACE_FLUSH_INTERVAL = float(os.getenv('TRACE_FLUSH_INTERVAL', 2))
+
+class _ContextLocal:
+    """threading.local-like attributes kept in a ContextVar.
+
+    Under asyncio every task runs on the loop's thread, so a thread local would
+    be shared by all requests. A task starts with a copy of its creator's
+    context, and each assignment replaces the stored dict rather than changing
+    it, so a trace set in one task never leaks into another.
+    """
+
+    def __init__(self):
+        object.__setattr__(self, '_state', contextvars.ContextVar('trace_context', default={}))
+
+    def __getattr__(self, name):
+        try:
+            return self._state.get()[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        self._state.set(dict(self._state.get(), **{name: value}))
+
+# Green-thread local under eventlet's monkey patching; the ASGI app switches to
+# per-task context with use_context_vars()
+_context = threading.local()
+
+def use_context_vars():
+    """Keep trace context per asyncio task (and worker threads started with
+    asyncio.to_thread) instead of per thread"""
+    global _context
+    _context = _ContextLocal()
+
+# OTLP collectors reject a whole batch over one malformed id
+_TRACE_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+_SPAN_ID_RE = re.compile(r'^[0-9a-f]{16}$')
+
+def _new_id(length):
+    return uuid.uuid4().hex[:length]
+
+def _valid_id(value, pattern):
+    """`value` lowercased if it is a well-formed, non-zero W3C id, else None"""
+    value = (value or '').strip().lower()
+    if pattern.match(value) and value.strip('0'):
+        return value
+    return None
+
+def tracing_enabled():
+    return TRACE_EXPORTER in ('file', 'otlp')
+
+def current_trace_id():
+    return getattr(_context, 'trace_id', None)
+
+def current_trace_start_ms():
+    return getattr(_context, 'started_ms', None)
+
+def start_trace(trace_id=None, parent_span_id=None):
+    """Begin a trace on the current (green) thread.
+
+    Ids from incoming headers are only kept when well formed.
+    """
+    _context.trace_id = _valid_id(trace_id, _TRACE_ID_RE) or _new_id(32)
+    parent_span_id = _valid_id(parent_span_id, _SPAN_ID_RE)
+    _context.span_stack = [parent_span_id] if parent_span_id else []
+    _context.started_ms = int(time.time() * 1000)
+    return _context.trace_id
+
+def end_trace():
+    _context.trace_id = None
+    _context.span_stack = []
+    _context.started_ms = None
+
+def parse_traceparent(header):
+    """Return (trace_id, parent_span_id) from a W3C traceparent header"""
+    parts = (header or '').split('-')
+    if len(parts) == 4:
+        trace_id, span_id = _valid_id(parts[1], _TRACE_ID_RE), _valid_id(parts[2], _SPAN_ID_RE)
+        if trace_id and span_id:
+            return trace_id, span_id
+    return None, None
+
+def traceparent():
+    """W3C traceparent header value for outbound calls, or None"""
+    trace_id = current_trace_id()
+    if not trace_id:
+        return None
+    stack = getattr(_context, 'span_stack', [])
+    span_id = stack[-1] if stack else _new_id(16)
+    return f"00-{trace_id}-{span_id}-01"
+
+def _record(name, start_ns, end_ns, span_id, parent_span_id, attributes, error=None):
+    _exporter.submit({
+        'traceId': current_trace_id(),
+        'spanId': span_id,
+        'parentSpanId': parent_span_id,
+        'name': name,
+        'startTimeUnixNano': start_ns,
+        'endTimeUnixNano': end_ns,
+        'attributes': attributes,
+        'error': error
+    })
+
+@contextmanager
+def span(name, **attributes):
+    """Time a block as a span of the current trace (no-op outside a trace)"""
+    if not tracing_enabled() or current_trace_id() is None:
+        yield None
+        return
+
+    stack = _context.span_stack
+    parent_span_id = stack[-1] if stack else None
+    span_id = _new_id(16)
+    # Replaced rather than appended to: tasks and threads started inside the
+    # span may still hold the outer stack
+    _context.span_stack = stack + [span_id]
+    start_ns = time.time_ns()
+    error = None
+    try:
+        yield span_id
+    except Exception as e:
+        error = repr(e)
+        raise
+    finally:
+        _context.span_stack = stack
+        _record(name, start_ns, time.time_ns(), span_id, parent_span_id, attributes, error)
+
+def traced(name):
+    """Decorator form of span()"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def carry_context(func):
+    """Run `func` later (e.g. in a spawned greenlet) under the current trace"""
+    trace_id = current_trace_id()
+    started_ms = current_trace_start_ms()
+    stack = list(getattr(_context, 'span_stack', []))
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if trace_id is None:
+            return func(*args, **kwargs)
+        _context.trace_id = trace_id
+        _context.started_ms = started_ms
+        _context.span_stack = list(stack)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            end_trace()
+    return wrapper
+
+class TracingCommandListener(monitoring.CommandListener):
+    """Records a span per Mongo command issued inside a trace.
+
+    PyMongo publishes command events on the thread that ran the command, so
+    the thread-local trace context is the caller's.
+    """
+
+    def __init__(self):
+        self._started = {}
+
+    def started(self, event):
+        if not tracing_enabled() or current_trace_id() is None:
+            return
+        collection = event.command.get(event.command_name)
+        stack = getattr(_context, 'span_stack', [])
+        self._started[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else '',
+            stack[-1] if stack else None
+        )
+
+    def _finish(self, event, error=None):
+        started = self._started.pop((event.connection_id, event.request_id), None)
+        if started is None:
+            return
+        collection, parent_span_id = started
+        end_ns = time.time_ns()
+        _record(
+            f"mongo.{event.command_name}",
+            end_ns - event.duration_micros * 1000, end_ns,
+            _new_id(16), parent_span_id,
+            {'db.collection': collection, 'db.operation': event.command_name},
+            error
+        )
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event, str(event.failure))
+
+def trace_socketio(socketio):
+    """Attach the trace id to emitted dict payloads and record a span per emit.
+
+    `traceStartedAt` (epoch ms when the webhook/request arrived) lets clients
+    measure end-to-end delivery lag.
+    """
+    emit = socketio.emit
+
+    def with_trace_id(args):
+        trace_id = current_trace_id()
+        if trace_id and args and isinstance(args[0], dict):
+            payload = dict(args[0], traceId=trace_id, traceStartedAt=current_trace_start_ms())
+            args = (payload,) + args[1:]
+        return args
+
+    @functools.wraps(emit)
+    def traced_emit(event, *args, **kwargs):
+        with span('socketio.emit', event=event):
+            return emit(event, *with_trace_id(args), **kwargs)
+
+    # python-socketio's AsyncServer
+    @functools.wraps(emit)
+    async def traced_async_emit(event, *args, **kwargs):
+        with span('socketio.emit', event=event):
+            return await emit(event, *with_trace_id(args), **kwargs)
+
+    socketio.emit = traced_async_emit if asyncio.iscoroutinefunction(emit) else traced_emit
+    return socketio
+
+def init_flask_tracing(app):
+    """Start a trace per request and return its id in X-Trace-Id"""
+    from flask import g, request
+
+    @app.before_request
+    def _start_request_trace():
+        trace_id, parent_span_id = parse_traceparent(request.headers.get('traceparent'))
+        start_trace(trace_id or request.headers.get('X-Trace-Id'), parent_span_id)
+        g.trace_span = span(f"{request.method} {request.url_rule.rule if request.url_rule else request.path}")
+        g.trace_span.__enter__()
+
+    @app.after_request
+    def _attach_trace_id(response):
+        trace_id = current_trace_id()
+        if trace_id:
+            response.headers['X-Trace-Id'] = trace_id
+        return response
+
+    @app.teardown_request
+    def _end_request_trace(exc):
+        trace_span = g.pop('trace_span', None)
+        if trace_span is not None:
+            trace_span.__exit__(None, None, None)
+        end_trace()
+
+class TracingMiddleware:
+    """ASGI counterpart of init_flask_tracing; needs use_context_vars()"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        trace_id, parent_span_id = parse_traceparent(headers.get('traceparent'))
+        trace_id = start_trace(trace_id or headers.get('x-trace-id'), parent_span_id)
+
+        async def send_with_trace_id(message):
+            if message['type'] == 'http.response.start':
+                message = dict(message, headers=list(message.get('headers', [])) + [(b'x-trace-id', trace_id.encode())])
+            await send(message)
+
+        try:
+            with span(f"{scope['method']} {scope['path']}"):
+                await self.app(scope, receive, send_with_trace_id)
+        finally:
+            end_trace()
+
+class _SpanExporter:
+    """Batches finished spans and writes them from a background thread"""
+
+    def __init__(self):
+        self._queue = queue.Queue(10000)
+        self._thread = None
+
+    def submit(self, record):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = []
+            deadline = time.monotonic() + TRACE_FLUSH_INTERVAL
+            while len(batch) < TRACE_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if not batch:
+                continue
+            try:
+                if TRACE_EXPORTER == 'file':
+                    self._write_file(batch)
+                elif TRACE_EXPORTER == 'otlp':
+                    self._post_otlp(batch)
+            except Exception as e:
+                logger.warning("Failed to export %d spans: %s", len(batch), e)
+
+    def _write_file(self, batch):
+        with open(TRACE_FILE, 'a') as f:
+            for record in batch:
+                f.write(json.dumps(record, default=str) + '\n')
+
+    def _post_otlp(self, batch):
+        spans = []
+        for record in batch:
+            attributes = [
+                {'key': key, 'value': {'stringValue': str(value)}}
+                for key, value in (record['attributes'] or {}).items()
+            ]
+            otlp_span = {
+                'traceId': record['traceId'],
+                'spanId': record['spanId'],
+                'name': record['name'],
+                'kind': 1,
+                'startTimeUnixNano': str(record['startTimeUnixNano']),
+                'endTimeUnixNano': str(record['endTimeUnixNano']),
+                'attributes': attributes,
+                'status': {'code': 2, 'message': record['error']} if record['error'] else {'code': 1}
+            }
+            if record['parentSpanId']:
+                otlp_span['parentSpanId'] = record['parentSpanId']
+            spans.append(otlp_span)
+
+        requests.post(TRACE_OTLP_ENDPOINT, json={
+            'resourceSpans': [{
+                'resource': {'attributes': [
+                    {'key': 'service.name', 'value': {'stringValue': TRACE_SERVICE_NAME}}
+                ]},
+                'scopeSpans': [{'scope': {'name': 'crm.tracing'}, 'spans': spans}]
+            }]
+        }, timeout=5)
+
+_exporter = _SpanExporter()
@@ -0,0 +1,209 @@
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+from metrics import WEBHOOK_REJECTED
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Cheap checks in front of webhook processing:
+#
+#   1. Before the body is parsed, X-Hub-Signature-256 must be the HMAC-SHA256
+#      of the raw body under the Meta app secret (WHATSAPP_APP_SECRET, or a
+#      tenant's "appSecret" in WHATSAPP_TENANTS when the numbers belong to
+#      different apps). Forged deliveries get a 403. Without any secret every
+#      delivery is refused with a 503, so Meta keeps retrying until the
+#      deployment is fixed, unless WEBHOOK_ALLOW_UNSIGNED=true opts out for
+#      local testing.
+#   2. After parsing, a delivery that isn't a JSON object gets a 400. The
+#      rest are keyed by what they carry: their entry ids and the ids and
+#      timestamps of their messages and statuses (and each status's value).
+#      A delivery whose key was already processed is acknowledged without
+#      being processed again. The last WEBHOOK_REPLAY_CACHE_SIZE keys are kept
+#      in an in-process LRU.
+#   3. A delivery whose newest timestamp is older than WEBHOOK_MAX_AGE is
+#      acknowledged and dropped.
+#
+# Duplicates and stale deliveries are answered 200 so Meta stops retrying
+# them. Only deliveries that were processed are remembered: one that failed
+# half-way is processed again when Meta retries it.
+#
+# The LRU and the age limit only filter cheaply; they don't guarantee
+# exactly-once processing. A replay that has left the LRU but is younger than
+# WEBHOOK_MAX_AGE is processed again. For messages that is harmless, as the
+# unique messageId index drops them. A replayed status only has an effect if
+# the message's status has moved on since, in which case it is set back. The
+# default age limit is Meta's 7 day retry period, so no genuine retry after an
+# outage is dropped. Lowering it narrows the replay window, but any retry that
+# arrives later than the new limit is lost.
+
+WHATSAPP_APP_SECRET = os.getenv('WHATSAPP_APP_SECRET')
+# Process unsigned webhooks when no app secret is configured (local testing only)
+WEBHOOK_ALLOW_UNSIGNED = os.getenv('WEBHOOK_ALLOW_UNSIGNED', 'false').lower() == 'true'
+WEBHOOK_REPLAY_CACHE_SIZE = int(os.getenv('WEBHOOK_REPLAY_CACHE_SIZE', 10000))
+# Seconds; 0 disables the check
+WEBHOOK_MAX_AGE = int(os.getenv('WEBHOOK_MAX_AGE', 7 * 24 * 3600))
+
+SIGNATURE_HEADER = 'X-Hub-Signature-256'
+_SIGNATURE_PREFIX = 'sha256='
+
+def _app_secrets():
+    secrets = [WHATSAPP_APP_SECRET] if WHATSAPP_APP_SECRET else []
+    config = os.getenv('WHATSAPP_TENANTS')
+    if config:
+        secrets += [entry['appSecret'] for entry in json.loads(config) if entry.get('appSecret')]
+    # Each distinct secret once, as bytes
+    return [secret.encode() for secret in dict.fromkeys(secrets)]
+
+class ReplayCache:
+    """Bounded LRU of recently processed delivery keys"""
+
+    def __init__(self, size=WEBHOOK_REPLAY_CACHE_SIZE):
+        self.size = size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, key):
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                return True
+            return False
+
+    def remember(self, key):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.size:
+                self._keys.popitem(last=False)
+
+class WebhookGuard:
+    """Signature and replay checks for webhook deliveries"""
+
+    def __init__(self, secrets=None, replay_cache=None, max_age=WEBHOOK_MAX_AGE,
+                 allow_unsigned=WEBHOOK_ALLOW_UNSIGNED):
+        self.secrets = _app_secrets() if secrets is None else secrets
+        self.replay_cache = replay_cache or ReplayCache()
+        self.max_age = max_age
+        self.allow_unsigned = allow_unsigned
+        if not self.secrets:
+            if allow_unsigned:
+                logger.warning("WHATSAPP_APP_SECRET is not set; webhook signatures are not verified")
+            else:
+                logger.error("WHATSAPP_APP_SECRET is not set; webhooks are refused "
+                             "(set WEBHOOK_ALLOW_UNSIGNED=true to accept unsigned ones)")
+
+    def check(self, body, signature):
+        """Verify a raw delivery's signature before parsing.
+
+        Returns None to go on, else the HTTP status to answer with straight away.
+        """
+        if not self.secrets:
+            if self.allow_unsigned:
+                return None
+            WEBHOOK_REJECTED.labels(reason='unconfigured').inc()
+            return 503
+        if not self._verified(body, signature):
+            WEBHOOK_REJECTED.labels(reason='signature').inc()
+            logger.warning("Rejected webhook with a bad signature",
+                           extra={'event': 'webhook.rejected', 'reason': 'signature'})
+            return 403
+        return None
+
+    def _verified(self, body, signature):
+        if not signature or not signature.startswith(_SIGNATURE_PREFIX):
+            return False
+        received = signature[len(_SIGNATURE_PREFIX):].strip().lower()
+        for secret in self.secrets:
+            digest = hmac.new(secret, body, hashlib.sha256).hexdigest()
+            if hmac.compare_digest(digest, received):
+                return True
+        return False
+
+    def screen(self, data):
+        """Replay checks for a parsed delivery.
+
+        Returns (status, key): status is None to process the delivery, 400 if
+        it isn't a JSON object, else 200 to acknowledge it unprocessed. `key`
+        identifies the delivery for remember().
+        """
+        if not isinstance(data, dict):
+            WEBHOOK_REJECTED.labels(reason='malformed').inc()
+            logger.warning("Rejected webhook whose body is not a JSON object",
+                           extra={'event': 'webhook.rejected', 'reason': 'malformed'})
+            return 400, None
+        if self.is_stale(data):
+            return 200, None
+        key = delivery_key(data)
+        if self.replay_cache.seen(key):
+            WEBHOOK_REJECTED.labels(reason='duplicate').inc()
+            logger.info("Skipped duplicate webhook delivery",
+                        extra={'event': 'webhook.rejected', 'reason': 'duplicate'})
+            return 200, key
+        return None, key
+
+    def is_stale(self, data):
+        """Whether a parsed delivery is older than the replay window"""
+        if self.max_age <= 0:
+            return False
+        newest = newest_timestamp(data)
+        if newest is None or time.time() - newest <= self.max_age:
+            return False
+        WEBHOOK_REJECTED.labels(reason='stale').inc()
+        logger.warning("Dropped stale webhook delivery from %d", newest,
+                       extra={'event': 'webhook.rejected', 'reason': 'stale'})
+        return True
+
+    def remember(self, key):
+        """Record a processed delivery so a replay of it is skipped"""
+        if key is not None:
+            self.replay_cache.remember(key)
+
+def delivery_key(data):
+    """Replay key of a parsed delivery: its entry, message and status ids and timestamps.
+
+    Independent of how the JSON is laid out, so a retry that Meta
+    re-serializes still matches.
+    """
+    parts = []
+    for entry in (data or {}).get('entry') or []:
+        parts.append(f"e:{entry.get('id')}:{entry.get('time')}")
+        for change in entry.get('changes') or []:
+            value = change.get('value') or {}
+            messages, statuses = value.get('messages') or [], value.get('statuses') or []
+            parts += [f"m:{item.get('id')}:{item.get('timestamp')}" for item in messages]
+            parts += [f"s:{item.get('id')}:{item.get('status')}:{item.get('timestamp')}" for item in statuses]
+            if not messages and not statuses:
+                # Other change fields carry no ids; key them by their content
+                parts.append('c:' + json.dumps(change, sort_keys=True, default=str))
+    return hashlib.blake2b('|'.join(sorted(parts)).encode(), digest_size=16).hexdigest()
+
+def newest_timestamp(data):
+    """Newest Unix timestamp across a delivery's entries, messages and statuses"""
+    newest = None
+    for entry in (data or {}).get('entry') or []:
+        stamps = [entry.get('time')]
+        for change in entry.get('changes') or []:
+            value = change.get('value') or {}
+            stamps += [item.get('timestamp') for item in value.get('messages') or []]
+            stamps += [item.get('timestamp') for item in value.get('statuses') or []]
+        for stamp in stamps:
+            try:
+                stamp = int(stamp)
+            except (TypeError, ValueError):
+                continue
+            if newest is None or stamp > newest:
+                newest = stamp
+    return newest
+
+webhook_guard = WebhookGuard()
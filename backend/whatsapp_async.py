@@ -0,0 +1,365 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import httpx
+import pytz
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from media import MEDIA_DOWNLOAD_CONCURRENCY, download_media, media_urls
+from message_archive import conversation_changed_update
+from metrics import GRAPH_API_ERRORS, GRAPH_API_LATENCY, timed
+from outbound import claim_filter, claim_update, requeue_filter, requeue_update, result_update
+from referral_stats import apply_user_change
+from reply_flows import extract_referral, flow_engine
+from tenants import conversation_key, tenant_rooms, tenants, webhook_tenant_id
+from whatsapp_messages import (
+    GRAPH_API_BASE_URL,
+    UNCOUNT_INBOUND_UPDATE,
+    claim_welcome_filter,
+    claim_welcome_update,
+    inbound_message_document,
+    inbound_user_filter,
+    inbound_user_update,
+    message_payload,
+    recorded_inbound_seq,
+    uncount_inbound_filter
+)
+
+logger = logging.getLogger(__name__)
+
+# asyncio counterparts of whatsapp_handler for the ASGI app: Graph calls go
+# through httpx and Mongo through Motor. Shared logic is in whatsapp_messages,
+# and nothing here imports eventlet. Work that only has a synchronous
+# implementation (referral stats, media downloads) runs in worker threads
+# against the Motor client's underlying PyMongo database.
+
+def create_graph_client():
+    """Pooled async Graph API client; call aclose() on shutdown.
+
+    Shared by all tenants: each request carries its tenant's token.
+    """
+    return httpx.AsyncClient(
+        headers={'Content-Type': 'application/json'},
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        # Connection failures only; the sync client's status retries don't
+        # apply to sends, which must not be duplicated
+        transport=httpx.AsyncHTTPTransport(retries=2),
+        timeout=5
+    )
+
+class ThreadsafeEmitter:
+    """Sync emit() for code running in worker threads, delivered on the event loop"""
+
+    def __init__(self, sio, loop):
+        self.sio = sio
+        self.loop = loop
+
+    def emit(self, event, data=None, **kwargs):
+        asyncio.run_coroutine_threadsafe(self.sio.emit(event, data, **kwargs), self.loop)
+
+# Media downloads block for as long as Graph takes: they get their own threads
+# so they can't use up the default executor asyncio.to_thread callers share
+_media_pool = ThreadPoolExecutor(MEDIA_DOWNLOAD_CONCURRENCY, thread_name_prefix='media')
+_background_tasks = set()
+
+def spawn(coro):
+    """Run a coroutine in the background, keeping a reference until it finishes"""
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def send_whatsapp_message(graph, phone, message, buttons=None, tenant_id=None):
+    """Send message via WhatsApp API from a tenant's number"""
+    tenant = tenants.get(tenant_id)
+    url = f"{GRAPH_API_BASE_URL}/{tenant.id}/messages"
+    wait = tenant.limiter.reserve()
+    if wait:
+        await asyncio.sleep(wait)
+    start = time.perf_counter()
+    try:
+        response = await graph.post(url, json=message_payload(phone, message, buttons), headers=tenant.auth_headers())
+        result = response.json()
+        if 'error' in result:
+            GRAPH_API_ERRORS.labels('send_message', str(response.status_code)).inc()
+        return result
+    except httpx.TimeoutException:
+        GRAPH_API_ERRORS.labels('send_message', 'timeout').inc()
+        return {"error": "Request timeout"}
+    except Exception as e:
+        GRAPH_API_ERRORS.labels('send_message', 'exception').inc()
+        return {"error": str(e)}
+    finally:
+        GRAPH_API_LATENCY.labels('send_message').observe(time.perf_counter() - start)
+
+async def queue_outbound_message(db, doc):
+    """Async outbound.queue_outbound_message"""
+    try:
+        await db.messages.insert_one(doc)
+        await db.users.update_one(conversation_key(doc['phone'], doc.get('tenantId')),
+                                  conversation_changed_update())
+        return doc, True
+    except DuplicateKeyError:
+        pass
+    requeued = await db.messages.find_one_and_update(
+        requeue_filter(doc['tempId']), requeue_update(), return_document=ReturnDocument.AFTER
+    )
+    if requeued is not None:
+        await db.users.update_one(conversation_key(requeued['phone'], requeued.get('tenantId')),
+                                  conversation_changed_update())
+        return requeued, True
+    return await db.messages.find_one({'tempId': doc['tempId']}), False
+
+async def dispatch_outbound_message(db, graph, message_id):
+    """Async outbound.dispatch_outbound_message"""
+    message = await db.messages.find_one_and_update(
+        claim_filter(message_id), claim_update(),
+        projection={'phone': 1, 'message': 1, 'tenantId': 1}
+    )
+    if message is None:
+        return None
+    api_response = await send_whatsapp_message(graph, message['phone'], message['message'],
+                                               tenant_id=message.get('tenantId'))
+    result = await db.messages.find_one_and_update(
+        {'_id': message_id, 'status': 'sending'}, result_update(api_response),
+        return_document=ReturnDocument.AFTER
+    )
+    await db.users.update_one(conversation_key(message['phone'], message.get('tenantId')),
+                              conversation_changed_update())
+    return result
+
+async def _upsert_inbound_user(db, parsed_data, referred_by):
+    """Async _upsert_inbound_user: returns (created, inbound_seq), or None for a counted message id"""
+    phone, tenant_id, message_id = parsed_data['phone'], parsed_data.get('tenant_id'), parsed_data['message_id']
+    update = inbound_user_update(parsed_data['contact_name'], referred_by, parsed_data['timestamp'], message_id)
+    for attempt in range(2):
+        try:
+            before = await db.users.find_one_and_update(
+                inbound_user_filter(phone, tenant_id, message_id),
+                update,
+                projection={'inboundSeq': 1},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+            before = before or {}
+            return not before, before.get('inboundSeq', 0) + 1
+        except DuplicateKeyError:
+            if attempt:
+                return None
+
+async def _resume_inbound_message(db, parsed_data):
+    """Async _resume_inbound_message: returns (welcome_pending, inbound_seq) for a counted, unstored message"""
+    if await db.messages.find_one({'messageId': parsed_data['message_id']}, {'_id': 1}):
+        return None
+    user = await db.users.find_one(
+        conversation_key(parsed_data['phone'], parsed_data.get('tenant_id')),
+        {'inboundSeq': 1, 'recentInboundIds': 1, 'welcomePending': 1}
+    )
+    inbound_seq = recorded_inbound_seq(user, parsed_data['message_id'])
+    if inbound_seq is None:
+        return None
+    return user.get('welcomePending', False), inbound_seq
+
+async def _store_inbound_message(db, parsed_data, inbound_seq):
+    """Async _store_inbound_message: returns the _id, or None when another delivery stored it first"""
+    try:
+        return (await db.messages.insert_one(inbound_message_document(parsed_data, inbound_seq))).inserted_id
+    except DuplicateKeyError:
+        pass
+    stored = await db.messages.find_one({'messageId': parsed_data['message_id']}, {'seq': 1})
+    if stored is not None and stored.get('seq') != inbound_seq:
+        phone, tenant_id = parsed_data['phone'], parsed_data.get('tenant_id')
+        uncounted = await db.users.update_one(uncount_inbound_filter(phone, tenant_id, inbound_seq),
+                                              UNCOUNT_INBOUND_UPDATE)
+        if not uncounted.matched_count:
+            await db.users.update_one(conversation_key(phone, tenant_id), {'$inc': {'unreadCount': -1}})
+    return None
+
+async def _send_auto_reply(db, graph, sio, phone, reply_text, buttons, tenant_id=None):
+    api_response = await send_whatsapp_message(graph, phone, reply_text, buttons, tenant_id)
+
+    message_status = 'failed'
+    whatsapp_message_id = None
+    if 'messages' in api_response and len(api_response['messages']) > 0:
+        message_status = 'sent'
+        whatsapp_message_id = api_response['messages'][0].get('id')
+    else:
+        logger.warning("Auto-reply to %s failed: %s", phone, api_response.get('error', api_response))
+
+    timestamp = datetime.now(pytz.timezone('Asia/Kolkata'))
+    await db.messages.insert_one({
+        'phone': phone,
+        'message': reply_text,
+        'direction': 'outbound',
+        'timestamp': timestamp,
+        'messageType': 'interactive' if buttons else 'text',
+        'isRead': True,
+        'status': message_status,
+        'whatsappMessageId': whatsapp_message_id,
+        'buttons': buttons,
+        'tenantId': tenant_id
+    })
+    await db.users.update_one(conversation_key(phone, tenant_id), conversation_changed_update())
+
+    await sio.emit('new_message', {
+        'phone': phone,
+        'message': reply_text,
+        'direction': 'outbound',
+        'timestamp': timestamp.isoformat(),
+        'buttons': buttons,
+        'tenantId': tenant_id
+    }, to=tenant_rooms(tenant_id))
+
+async def _download_media(sync_db, emitter, message_id, phone, media, tenant_id=None):
+    # Thumbnails are made in the same worker thread (media.call_directly)
+    context = contextvars.copy_context()
+    await asyncio.get_running_loop().run_in_executor(_media_pool, functools.partial(
+        context.run, download_media, sync_db, emitter, message_id, phone, media, tenant_id
+    ))
+
+@timed('process_incoming_message')
+async def process_incoming_message(db, graph, sio, parsed_data):
+    """Async process_incoming_message: same two round trips, events and follow-ups.
+
+    Returns True when the message created a new user.
+    """
+    phone = parsed_data['phone']
+    message_text = parsed_data['message_text']
+    message_id = parsed_data['message_id']
+    timestamp = parsed_data['timestamp']
+    message_type = parsed_data['message_type']
+    contact_name = parsed_data['contact_name']
+    media = parsed_data.get('media')
+    location = parsed_data.get('location')
+    tenant_id = parsed_data.get('tenant_id')
+    rooms = tenant_rooms(tenant_id)
+
+    referred_by = extract_referral(message_text)
+    counted = await _upsert_inbound_user(db, parsed_data, referred_by)
+    if counted is None:
+        counted = await _resume_inbound_message(db, parsed_data)
+    inserted_id = await _store_inbound_message(db, parsed_data, counted[1]) if counted else None
+    if inserted_id is None:
+        logger.info("Skipping duplicate message %s", message_id, extra={'event': 'message.duplicate'})
+        return False
+    is_new_user = counted[0]
+
+    logger.info(
+        "Received %s message %s from %s", message_type, message_id, phone,
+        extra={'event': 'message.inbound', 'newUser': is_new_user}
+    )
+
+    if is_new_user:
+        logger.info("Created new user %s", phone, extra={'event': 'user.created', 'referredBy': referred_by})
+        await sio.emit('new_user_created', {
+            'phone': phone,
+            'name': contact_name,
+            'status': 'priority',
+            'referredBy': referred_by,
+            'lastMessage': message_text,
+            'lastMessageTime': timestamp.isoformat(),
+            'tenantId': tenant_id
+        }, to=rooms)
+
+    if media:
+        emitter = ThreadsafeEmitter(sio, asyncio.get_running_loop())
+        spawn(_download_media(db.delegate, emitter, inserted_id, phone, media, tenant_id))
+
+    await sio.emit('new_message', {
+        'phone': phone,
+        'message': message_text,
+        'direction': 'inbound',
+        'timestamp': timestamp.isoformat(),
+        'messageId': str(inserted_id),
+        'messageType': message_type,
+        'media': media_urls(str(inserted_id), media),
+        'location': location,
+        'tenantId': tenant_id
+    }, to=rooms)
+
+    reply_text, buttons = flow_engine.reply_for(
+        message_text,
+        button_id=parsed_data['button_id'],
+        is_new_user=is_new_user,
+        context={'name': contact_name, 'phone': phone}
+    )
+
+    async def follow_up():
+        try:
+            if is_new_user:
+                welcome = await db.users.find_one_and_update(
+                    claim_welcome_filter(phone, tenant_id), claim_welcome_update(), projection={'_id': 1}
+                )
+                if welcome is None:
+                    return
+                await asyncio.to_thread(
+                    apply_user_change, db.delegate, None, {'referredBy': referred_by}, welcome['_id']
+                )
+            if reply_text:
+                await _send_auto_reply(db, graph, sio, phone, reply_text, buttons, tenant_id)
+        except Exception as e:
+            logger.exception("Error in follow-up for message %s: %s", message_id, e)
+
+    if is_new_user or reply_text:
+        spawn(follow_up())
+
+    return is_new_user
+
+@timed('process_status_update')
+async def process_status_update(db, sio, data):
+    """Async process_status_update"""
+    try:
+        if 'entry' not in data or not data['entry']:
+            return False
+
+        for entry in data['entry']:
+            for change in entry.get('changes', []):
+                value = change.get('value', {})
+                if 'statuses' not in value:
+                    continue
+                tenant = tenants.resolve(webhook_tenant_id(value))
+                if tenant is None:
+                    logger.warning("Ignoring statuses for unknown phone number %s", webhook_tenant_id(value))
+                    return True
+
+                for status in value['statuses']:
+                    message_id = status.get('id')
+                    status_type = status.get('status')
+                    recipient = status.get('recipient_id')
+                    timestamp = datetime.fromtimestamp(int(status.get('timestamp', 0)), tz=pytz.timezone('Asia/Kolkata'))
+
+                    # One round trip; unchanged statuses aren't re-emitted
+                    message = await db.messages.find_one_and_update(
+                        {'whatsappMessageId': message_id, 'status': {'$ne': status_type}},
+                        {'$set': {'status': status_type, 'statusTimestamp': timestamp}},
+                        projection={'_id': 1}
+                    )
+                    if message is None:
+                        logger.debug("No message to update with WhatsApp ID %s", message_id)
+                        continue
+                    await db.users.update_one(conversation_key(recipient, tenant.id), conversation_changed_update())
+
+                    logger.info(
+                        "Message %s is %s", message_id, status_type,
+                        extra={'event': 'message.status', 'phone': recipient}
+                    )
+                    await sio.emit('message_status_update', {
+                        'messageId': str(message['_id']),
+                        'whatsappMessageId': message_id,
+                        'phone': recipient,
+                        'status': status_type,
+                        'timestamp': timestamp.isoformat(),
+                        'tenantId': tenant.id
+                    }, to=tenant_rooms(tenant.id))
+
+                return True
+
+        return False
+    except Exception as e:
+        logger.exception("Error processing status update: %s", e)
+        return False
@@ -1,178 +1,166 @@
-import os
-import requests
-from datetime import datetime, timezone, timedelta
+import logging
+from datetime import datetime
 import pytz
 from dotenv import load_dotenv
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from eventlet import tpool
+from eventlet.semaphore import Semaphore
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from message_archive import mark_conversation_changed
+from referral_stats import apply_user_change
+from metrics import timed
+from background_tasks import task_registry
+from reply_flows import extract_referral, flow_engine
+from media import MEDIA_DOWNLOAD_CONCURRENCY, download_media, media_urls
+from tenants import conversation_key, emit_to_tenant, tenants, webhook_tenant_id
+from whatsapp_messages import (
+    claim_welcome_filter,
+    claim_welcome_update,
+    UNCOUNT_INBOUND_UPDATE,
+    inbound_message_document,
+    inbound_user_filter,
+    inbound_user_update,
+    recorded_inbound_seq,
+    send_whatsapp_message,
+    uncount_inbound_filter
+)
 
 load_dotenv()
 
-WHATSAPP_TOKEN = os.getenv('WHATSAPP_TOKEN')
-WHATSAPP_PHONE_ID = os.getenv('WHATSAPP_PHONE_ID')
+logger = logging.getLogger(__name__)
 
-# Create a session with connection pooling and keep-alive
-session = requests.Session()
+# The eventlet app's message processing: green threads and the task registry.
+# The ASGI app's counterpart is whatsapp_async.py; what they share is in
+# whatsapp_messages.py.
 
-# Configure retry strategy
-retry_strategy = Retry(
-    total=2,
-    backoff_factor=0.3,
-    status_forcelist=[429, 500, 502, 503, 504],
-)
+_download_slots = Semaphore(MEDIA_DOWNLOAD_CONCURRENCY)
 
-# Mount adapter with connection pooling
-adapter = HTTPAdapter(
-    pool_connections=10,
-    pool_maxsize=20,
-    max_retries=retry_strategy
-)
-session.mount("http://", adapter)
-session.mount("https://", adapter)
+def _upsert_inbound_user(db, parsed_data, referred_by):
+    """Bump the conversation counters for a new message, creating the user if needed.
 
-# Set default headers
-session.headers.update({
-    'Authorization': f'Bearer {WHATSAPP_TOKEN}',
-    'Content-Type': 'application/json',
-    'Connection': 'keep-alive'
-})
+    Returns (created, inbound_seq), or None when the conversation already
+    counted this message id. A concurrent first message from the same phone
+    loses the unique-index race and is retried as an update.
+    """
+    phone, tenant_id, message_id = parsed_data['phone'], parsed_data.get('tenant_id'), parsed_data['message_id']
+    update = inbound_user_update(parsed_data['contact_name'], referred_by, parsed_data['timestamp'], message_id)
+    for attempt in range(2):
+        try:
+            before = db.users.find_one_and_update(
+                inbound_user_filter(phone, tenant_id, message_id),
+                update,
+                projection={'inboundSeq': 1},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+            before = before or {}
+            return not before, before.get('inboundSeq', 0) + 1
+        except DuplicateKeyError:
+            # The second time the conversation exists, so the id is already counted
+            if attempt:
+                return None
 
-def send_whatsapp_message(phone, message, buttons=None):
-    """Send message via WhatsApp API with optimized connection"""
-    url = f"https://graph.facebook.com/v17.0/{WHATSAPP_PHONE_ID}/messages"
-    
-    if buttons:
-        payload = {
-            "messaging_product": "whatsapp",
-            "to": phone,
-            "type": "interactive",
-            "interactive": {
-                "type": "button",
-                "body": {"text": message},
-                "action": {"buttons": buttons}
-            }
-        }
-    else:
-        payload = {
-            "messaging_product": "whatsapp",
-            "to": phone,
-            "type": "text",
-            "text": {"body": message}
-        }
-    
-    # Use session with connection pooling (much faster)
+def _resume_inbound_message(db, parsed_data):
+    """A redelivery of a counted message: (welcome_pending, inbound_seq) if it was never stored.
+
+    That happens when the request that counted it died before the insert, or
+    is still running; the unique messageId index picks one of them.
+    """
+    if db.messages.find_one({'messageId': parsed_data['message_id']}, {'_id': 1}):
+        return None
+    user = db.users.find_one(
+        conversation_key(parsed_data['phone'], parsed_data.get('tenant_id')),
+        {'inboundSeq': 1, 'recentInboundIds': 1, 'welcomePending': 1}
+    )
+    inbound_seq = recorded_inbound_seq(user, parsed_data['message_id'])
+    if inbound_seq is None:
+        return None
+    return user.get('welcomePending', False), inbound_seq
+
+def _store_inbound_message(db, parsed_data, inbound_seq):
+    """Insert the counted message. Returns its _id, or None when another delivery stored it first."""
     try:
-        response = session.post(url, json=payload, timeout=5)
-        return response.json()
-    except requests.exceptions.Timeout:
-        return {"error": "Request timeout"}
-    except Exception as e:
-        return {"error": str(e)}
+        return db.messages.insert_one(inbound_message_document(parsed_data, inbound_seq)).inserted_id
+    except DuplicateKeyError:
+        pass
+    stored = db.messages.find_one({'messageId': parsed_data['message_id']}, {'seq': 1})
+    if stored is not None and stored.get('seq') != inbound_seq:
+        # Redelivered after the conversation forgot the id: it was counted twice
+        phone, tenant_id = parsed_data['phone'], parsed_data.get('tenant_id')
+        if not db.users.update_one(uncount_inbound_filter(phone, tenant_id, inbound_seq),
+                                   UNCOUNT_INBOUND_UPDATE).matched_count:
+            db.users.update_one(conversation_key(phone, tenant_id), {'$inc': {'unreadCount': -1}})
+    return None
 
-def get_auto_reply(message_text, is_new_user=True):
-    """Generate auto-reply based on message content"""
-    message_lower = message_text.lower()
-    
-    if is_new_user: 
-        # Check for referral
-        referred_by = None
-        if "referred by" in message_lower:
-            try:
-                referred_by = message_text.split("referred by")[1].strip().rstrip('.')
-            except:
-                pass
-        
-        reply_text = "Hey there! I'm faff!\nWe're an affordable personal assistant service for people who value their time. You can hire us and delegate your personal chores over WhatsApp.\n\nHow would you like to proceed?\nChoose an option below"
-        
-        buttons = [
-            {"type": "reply", "reply": {"id": "know_more", "title": "Know more"}},
-            {"type": "reply", "reply": {"id": "onboard_direct", "title": "Onboard me directly"}}
-        ]
-        
-        return reply_text, buttons, referred_by
+def _send_auto_reply(db, socketio, phone, reply_text, buttons, tenant_id=None):
+    """Send an auto-reply and record it. Runs off the webhook's critical path."""
+    api_response = send_whatsapp_message(phone, reply_text, buttons, tenant_id)
+    logger.debug("Auto-reply API response for %s: %s", phone, api_response)
     
-    return None, None, None
-
-def handle_button_reply(button_id):
-    """Handle interactive button replies"""
-    reply_text = None
-    buttons = None
+    # Determine message status based on API response
+    message_status = 'failed'
+    whatsapp_message_id = None
+    if 'messages' in api_response and len(api_response['messages']) > 0:
+        message_status = 'sent'
+        whatsapp_message_id = api_response['messages'][0].get('id')
+    else:
+        logger.warning("Auto-reply to %s failed: %s", phone, api_response.get('error', api_response))
     
-    if button_id == 'know_more':
-        reply_text = "We offer a wide range of services:\n\n📱 Digital Tasks\n• Online research & bookings\n• Email management\n• Social media handling\n\n🏠 Personal Errands\n• Shopping assistance\n• Bill payments\n• Appointment scheduling\n\n💼 Professional Support\n• Document preparation\n• Travel planning\n• Event coordination\n\nAll for just ₹999/month! Ready to get started?"
-        buttons = [
-            {"type": "reply", "reply": {"id": "start_trial", "title": "Start Free Trial"}},
-            {"type": "reply", "reply": {"id": "pricing", "title": "View Pricing"}}
-        ]
-    elif button_id == 'onboard_direct':
-        reply_text = "Great! Let's get you started.\n\nPlease share your email address to create your account and start your free trial."
-    elif button_id == 'start_trial':
-        reply_text = "Excellent choice! 🎉\n\nYour 7-day free trial has been activated.\n\nTo get started:\n1. Save this number\n2. Send us your first task\n3. We'll handle it within 2 hours\n\nWhat would you like help with today?"
-    elif button_id == 'pricing':
-        reply_text = "Our Pricing Plans:\n\n📌 Basic Plan - ₹999/month\n• 10 tasks per month\n• 2-hour response time\n• WhatsApp support\n\n⭐ Premium Plan - ₹2499/month\n• Unlimited tasks\n• 30-min response time\n• Priority support\n• Dedicated assistant\n\n💎 Business Plan - ₹4999/month\n• Everything in Premium\n• Team collaboration\n• API access\n• Custom integrations\n\nWhich plan interests you?"
-        buttons = [
-            {"type": "reply", "reply": {"id": "start_trial", "title": "Start Free Trial"}},
-            {"type": "reply", "reply": {"id": "contact_sales", "title": "Contact Sales"}}
-        ]
+    timestamp = datetime.now(pytz.timezone('Asia/Kolkata'))
+    db.messages.insert_one({
+        'phone': phone,
+        'message': reply_text,
+        'direction': 'outbound',
+        'timestamp': timestamp,
+        'messageType': 'interactive' if buttons else 'text',
+        'isRead': True,
+        'status': message_status,
+        'whatsappMessageId': whatsapp_message_id,
+        'buttons': buttons,  # Store button data if present
+        'tenantId': tenant_id
+    })
+    mark_conversation_changed(db, phone, tenant_id)
     
-    return reply_text, buttons
-
-def parse_message_data(data):
-    """Parse incoming WhatsApp webhook data"""
-    try:
-        if 'entry' not in data or not data['entry']:
-            return None
-            
-        changes = data['entry'][0].get('changes', [])
-        if not changes:
-            return None
-            
-        value = changes[0].get('value', {})
-        
-        # Check if this is a message (not just a status update)
-        if 'messages' not in value:
-            return None
-            
-        message_data = value['messages'][0]
-        contact_data = value['contacts'][0]
-        
-        # Extract basic info
-        phone = message_data['from']
-        message_id = message_data['id']
-        # Convert timestamp to IST
-        timestamp = datetime.fromtimestamp(int(message_data['timestamp']), tz=pytz.timezone('Asia/Kolkata'))
-        
-        # Handle different message types
-        message_type = message_data.get('type', 'text')
-        message_text = ''
-        button_id = None
-        
-        if message_type == 'text':
-            message_text = message_data.get('text', {}).get('body', '')
-        elif message_type == 'interactive':
-            interactive = message_data.get('interactive', {})
-            if interactive.get('type') == 'button_reply':
-                button_reply = interactive.get('button_reply', {})
-                message_text = f"Button: {button_reply.get('title', '')}"
-                button_id = button_reply.get('id', '')
-        else:
-            message_text = f"Unsupported message type: {message_type}"
-        
-        return {
+    if socketio:
+        emit_to_tenant(socketio, 'new_message', {
             'phone': phone,
-            'message_text': message_text,
-            'message_id': message_id,
-            'timestamp': timestamp,
-            'message_type': message_type,
-            'button_id': button_id,
-            'contact_name': contact_data.get('profile', {}).get('name', f'User {phone[-4:]}')
-        }
-    except Exception as e:
-        print(f"Error parsing message data: {e}")
-        return None
+            'message': reply_text,
+            'direction': 'outbound',
+            'timestamp': timestamp.isoformat(),
+            'buttons': buttons,  # Include buttons in socket emission
+            'tenantId': tenant_id
+        }, tenant_id)
+
+@task_registry.handler('media.download')
+def _download_task(db, socketio, payload):
+    with _download_slots:
+        # Thumbnails in eventlet's OS thread pool, off the hub
+        download_media(db, socketio, payload['messageId'], payload['phone'], payload['media'],
+                       payload.get('tenantId'), run_cpu=tpool.execute)
 
+def queue_media_download(db, socketio, message_id, phone, media, tenant_id=None):
+    """Download in the background; Graph media URLs expire, so don't wait for a reader.
+
+    Never blocks the caller: excess downloads wait for a slot in their own green
+    thread. Downloads cut off by a shutdown are retried by the next process.
+    """
+    task_registry.spawn('media.download', {
+        'messageId': message_id, 'phone': phone, 'media': media, 'tenantId': tenant_id
+    })
+
+@timed('process_incoming_message')
 def process_incoming_message(db, socketio, parsed_data):
-    """Process incoming WhatsApp message and generate response"""
+    """Store an incoming WhatsApp message and queue any auto-reply.
+
+    Two Mongo round trips on the critical path: the user upsert, which skips
+    message ids the conversation already counted and assigns the message its
+    inbound sequence number, then the message insert carrying that seq. A
+    redelivery of a message that was counted but never stored resumes it
+    instead of being dropped. Referral stats, the auto-reply and its Graph
+    call run in a separate green thread.
+
+    Returns True when the message created a new user.
+    """
     phone = parsed_data['phone']
     message_text = parsed_data['message_text']
     message_id = parsed_data['message_id']
@@ -180,140 +168,98 @@ def process_incoming_message(db, socketio, parsed_data):
     message_type = parsed_data['message_type']
     button_id = parsed_data['button_id']
     contact_name = parsed_data['contact_name']
+    media = parsed_data.get('media')
+    location = parsed_data.get('location')
+    tenant_id = parsed_data.get('tenant_id')
     
-    print(f"Processing message from {phone}: '{message_text}'")
-    print(f"Message ID: {message_id}, Type: {message_type}")
-    
-    # Check if user exists
-    user = db.users.find_one({'phone': phone})
-    is_new_user = user is None
-    print(f"User lookup for {phone}: {'NEW USER' if is_new_user else 'EXISTING USER'}")
-    
-    # Check if message already exists (to prevent duplicates)
-    existing_message = db.messages.find_one({'messageId': message_id})
-    if existing_message:
-        print(f"Message {message_id} already exists, skipping duplicate")
-        return True
+    logger.debug("Processing message %s from %s (%s)", message_id, phone, message_type)
     
-    # Save incoming message
-    message_doc = {
-        'messageId': message_id,
-        'phone': phone,
-        'message': message_text,
-        'direction': 'inbound',
-        'timestamp': timestamp,
-        'messageType': message_type,
-        'isRead': False,
-        'status': 'received',  # For incoming messages
-        'buttonId': button_id  # Store button ID if present
-    }
-    db.messages.insert_one(message_doc)
+    # Only used if this message creates the user
+    referred_by = extract_referral(message_text)
+    counted = _upsert_inbound_user(db, parsed_data, referred_by)
+    if counted is None:
+        # The interrupted attempt may have created the user without welcoming them
+        counted = _resume_inbound_message(db, parsed_data)
+    inserted_id = _store_inbound_message(db, parsed_data, counted[1]) if counted else None
+    if inserted_id is None:
+        logger.info("Skipping duplicate message %s", message_id, extra={'event': 'message.duplicate'})
+        return False
+    is_new_user = counted[0]
     
-    # Determine reply
-    reply_text = None
-    buttons = None
-    referred_by = None
+    logger.info(
+        "Received %s message %s from %s", message_type, message_id, phone,
+        extra={'event': 'message.inbound', 'newUser': is_new_user}
+    )
     
     if is_new_user:
-        print(f"Getting auto-reply for new user message: '{message_text}'")
-        reply_text, buttons, referred_by = get_auto_reply(message_text, True)
-        print(f"Auto-reply result: reply_text={bool(reply_text)}, has_buttons={bool(buttons)}, referred_by={referred_by}")
-    elif button_id:
-        print(f"Handling button reply: {button_id}")
-        reply_text, buttons = handle_button_reply(button_id)
-        print(f"Button handler result: reply_text={bool(reply_text)}, has_buttons={bool(buttons)}")
-    
-    # Handle user creation/update
-    if is_new_user and reply_text:
-        # Create new user
-        user_doc = {
-            'phone': phone,
-            'name': contact_name,
-            'status': 'priority',
-            'referredBy': referred_by,
-            'createdAt': datetime.now(pytz.timezone('Asia/Kolkata')),
-            'lastMessageAt': timestamp
-        }
-        print(f"Creating new user: {user_doc}")
-        db.users.insert_one(user_doc)
-        
+        logger.info("Created new user %s", phone, extra={'event': 'user.created', 'referredBy': referred_by})
         # Emit new user event to update frontend immediately
         if socketio:
-            socketio.emit('new_user_created', {
+            emit_to_tenant(socketio, 'new_user_created', {
                 'phone': phone,
                 'name': contact_name,
                 'status': 'priority',
                 'referredBy': referred_by,
                 'lastMessage': message_text,
-                'lastMessageTime': timestamp.isoformat()
-            })
-    elif not is_new_user:
-        # Update existing user
-        print(f"Updating existing user {phone} with lastMessageAt: {timestamp}")
-        db.users.update_one(
-            {'phone': phone},
-            {'$set': {'lastMessageAt': timestamp}}
-        )
+                'lastMessageTime': timestamp.isoformat(),
+                'tenantId': tenant_id
+            }, tenant_id)
     
-    # Send reply if we have one
-    if reply_text:
-        print(f"Sending auto-reply to {phone}: '{reply_text[:50]}...'")
-        api_response = send_whatsapp_message(phone, reply_text, buttons)
-        print(f"WhatsApp API response: {api_response}")
-        
-        # Determine message status based on API response
-        message_status = 'failed'
-        whatsapp_message_id = None
-        if 'messages' in api_response and len(api_response['messages']) > 0:
-            message_status = 'sent'
-            whatsapp_message_id = api_response['messages'][0].get('id')
-        
-        # Check if this outbound message already exists
-        if whatsapp_message_id:
-            existing_reply = db.messages.find_one({'whatsappMessageId': whatsapp_message_id})
-            if existing_reply:
-                print(f"Outbound message {whatsapp_message_id} already exists, skipping duplicate")
-                return True
-        
-        # Save outbound message
-        reply_doc = {
-            'phone': phone,
-            'message': reply_text,
-            'direction': 'outbound',
-            'timestamp': datetime.now(pytz.timezone('Asia/Kolkata')),
-            'messageType': 'interactive' if buttons else 'text',
-            'isRead': True,
-            'status': message_status,
-            'whatsappMessageId': whatsapp_message_id,
-            'buttons': buttons  # Store button data if present
-        }
-        db.messages.insert_one(reply_doc)
-        
-        # Emit outbound message to frontend
-        if socketio:
-            print(f"Emitting outbound new_message event to frontend for {phone}")
-            socketio.emit('new_message', {
-                'phone': phone,
-                'message': reply_text,
-                'direction': 'outbound',
-                'timestamp': datetime.now(pytz.timezone('Asia/Kolkata')).isoformat(),
-                'buttons': buttons  # Include buttons in socket emission
-            })
-            print(f"Outbound new_message event emitted successfully")
+    # Media is fetched in the background; clients get lazy URLs now and a
+    # media_ready event once it's stored
+    if media:
+        queue_media_download(db, socketio, inserted_id, phone, media, tenant_id)
     
     # Emit incoming message to frontend
     if socketio:
-        print(f"Emitting new_message event to frontend for {phone}")
-        socketio.emit('new_message', {
+        emit_to_tenant(socketio, 'new_message', {
             'phone': phone,
             'message': message_text,
             'direction': 'inbound',
-            'timestamp': timestamp.isoformat()
+            'timestamp': timestamp.isoformat(),
+            'messageId': str(inserted_id),
+            'messageType': message_type,
+            'media': media_urls(str(inserted_id), media),
+            'location': location,
+            'tenantId': tenant_id
+        }, tenant_id)
+    
+    reply_text, buttons = flow_engine.reply_for(
+        message_text,
+        button_id=button_id,
+        is_new_user=is_new_user,
+        context={'name': contact_name, 'phone': phone}
+    )
+    
+    if is_new_user or reply_text:
+        task_registry.spawn('inbound_message.follow_up', {
+            'messageId': message_id,
+            'phone': phone,
+            'isNewUser': is_new_user,
+            'referredBy': referred_by,
+            'replyText': reply_text,
+            'buttons': buttons,
+            'tenantId': tenant_id
         })
-        print(f"new_message event emitted successfully")
     
-    return True
+    return is_new_user
+
+@task_registry.handler('inbound_message.follow_up')
+def _inbound_follow_up(db, socketio, payload):
+    """Referral stats and the auto-reply for a stored inbound message"""
+    if payload['isNewUser']:
+        # Only one follow-up welcomes a user, even when ingestion was resumed
+        welcome = db.users.find_one_and_update(claim_welcome_filter(payload['phone'], payload.get('tenantId')),
+                                               claim_welcome_update(),
+                                               projection={'_id': 1})
+        if welcome is None:
+            return
+        apply_user_change(db, None, {'referredBy': payload['referredBy']}, welcome['_id'])
+    if payload['replyText']:
+        _send_auto_reply(db, socketio, payload['phone'], payload['replyText'], payload['buttons'],
+                         payload.get('tenantId'))
 
+@timed('process_status_update')
 def process_status_update(db, socketio, data):
     """Process WhatsApp message status updates (delivered, read, etc.)"""
     try:
@@ -329,7 +275,10 @@ def process_status_update(db, socketio, data):
                 # Check if this change contains statuses
                 if 'statuses' in value:
                     statuses = value['statuses']
-                    print(f"Processing {len(statuses)} status updates")
+                    tenant = tenants.resolve(webhook_tenant_id(value))
+                    if tenant is None:
+                        logger.warning("Ignoring statuses for unknown phone number %s", webhook_tenant_id(value))
+                        return True
                     
                     for status in statuses:
                         message_id = status.get('id')
@@ -337,7 +286,6 @@ def process_status_update(db, socketio, data):
                         recipient = status.get('recipient_id')
                         timestamp = datetime.fromtimestamp(int(status.get('timestamp', 0)), tz=pytz.timezone('Asia/Kolkata'))
                         
-                        print(f"Status update: Message {message_id} to {recipient} is {status_type}")
                         
                         # Update message status in database by WhatsApp message ID
                         result = db.messages.update_one(
@@ -351,28 +299,31 @@ def process_status_update(db, socketio, data):
                         )
                         
                         if result.modified_count > 0:
-                            print(f"Updated message {message_id} status to {status_type}")
+                            mark_conversation_changed(db, recipient, tenant.id)
+                            logger.info(
+                                "Message %s is %s", message_id, status_type,
+                                extra={'event': 'message.status', 'phone': recipient}
+                            )
                             
                             # Get the message to have full context for frontend
                             message = db.messages.find_one({'whatsappMessageId': message_id})
                             
                             if message and socketio:
                                 # Emit status update to frontend with message details
-                                socketio.emit('message_status_update', {
+                                emit_to_tenant(socketio, 'message_status_update', {
                                     'messageId': str(message.get('_id')),
                                     'whatsappMessageId': message_id,
                                     'phone': recipient,
                                     'status': status_type,
-                                    'timestamp': timestamp.isoformat()
-                                })
+                                    'timestamp': timestamp.isoformat(),
+                                    'tenantId': tenant.id
+                                }, tenant.id)
                         else:
-                            print(f"No message found with WhatsApp ID: {message_id}")
+                            logger.debug("No message found with WhatsApp ID %s", message_id)
                     
                     return True  # We processed status updates
                     
         return False  # No status updates in this webhook
     except Exception as e:
-        print(f"Error processing status update: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error processing status update: %s", e)
         return False
\ No newline at end of file
@@ -0,0 +1,279 @@
+import os
+import logging
+import time
+import requests
+from datetime import datetime
+import pytz
+from dotenv import load_dotenv
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from message_archive import ARCHIVE_COLLECTION
+from metrics import GRAPH_API_ERRORS, GRAPH_API_LATENCY
+from tracing import span, traceparent
+from media import describe_media, parse_media
+from tenants import conversation_key, tenants, webhook_tenant_id
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Graph calls, webhook parsing and the ingestion documents shared by the
+# eventlet app (whatsapp_handler.py) and the ASGI app (whatsapp_async.py).
+# Nothing here spawns or imports eventlet, so both serving modes can use it.
+
+# Point at a local stub/simulator for benchmarks and offline testing
+GRAPH_API_BASE_URL = os.getenv('GRAPH_API_BASE_URL', 'https://graph.facebook.com/v17.0').rstrip('/')
+
+def _trace_headers():
+    header = traceparent()
+    return {'traceparent': header} if header else None
+
+def message_payload(phone, message, buttons=None):
+    """Graph API body for a text or interactive button message"""
+    if buttons:
+        return {
+            "messaging_product": "whatsapp",
+            "to": phone,
+            "type": "interactive",
+            "interactive": {
+                "type": "button",
+                "body": {"text": message},
+                "action": {"buttons": buttons}
+            }
+        }
+    return {
+        "messaging_product": "whatsapp",
+        "to": phone,
+        "type": "text",
+        "text": {"body": message}
+    }
+
+def send_whatsapp_message(phone, message, buttons=None, tenant_id=None):
+    """Send message via WhatsApp API from a tenant's number (the default one without `tenant_id`)"""
+    tenant = tenants.get(tenant_id)
+    url = f"{GRAPH_API_BASE_URL}/{tenant.id}/messages"
+    payload = message_payload(phone, message, buttons)
+    
+    # Per-number send rate, then the number's pooled session
+    tenant.throttle()
+    start = time.perf_counter()
+    try:
+        with span('graph.send_message', **{'http.url': url}):
+            response = tenant.session.post(url, json=payload, headers=_trace_headers(), timeout=5)
+        result = response.json()
+        if 'error' in result:
+            GRAPH_API_ERRORS.labels('send_message', str(response.status_code)).inc()
+        return result
+    except requests.exceptions.Timeout:
+        GRAPH_API_ERRORS.labels('send_message', 'timeout').inc()
+        return {"error": "Request timeout"}
+    except Exception as e:
+        GRAPH_API_ERRORS.labels('send_message', 'exception').inc()
+        return {"error": str(e)}
+    finally:
+        GRAPH_API_LATENCY.labels('send_message').observe(time.perf_counter() - start)
+
+def send_read_receipt(message_id, tenant_id=None):
+    """Mark an inbound WhatsApp message (and everything before it) as read"""
+    tenant = tenants.get(tenant_id)
+    url = f"{GRAPH_API_BASE_URL}/{tenant.id}/messages"
+    payload = {
+        "messaging_product": "whatsapp",
+        "status": "read",
+        "message_id": message_id
+    }
+    
+    tenant.throttle()
+    try:
+        with span('graph.read_receipt', **{'http.url': url}):
+            response = tenant.session.post(url, json=payload, headers=_trace_headers(), timeout=5)
+        return response.json()
+    except requests.exceptions.Timeout:
+        return {"error": "Request timeout"}
+    except Exception as e:
+        return {"error": str(e)}
+
+def parse_message_data(data):
+    """Parse incoming WhatsApp webhook data"""
+    try:
+        if 'entry' not in data or not data['entry']:
+            return None
+            
+        changes = data['entry'][0].get('changes', [])
+        if not changes:
+            return None
+            
+        value = changes[0].get('value', {})
+        
+        # Check if this is a message (not just a status update)
+        if 'messages' not in value:
+            return None
+        
+        tenant = tenants.resolve(webhook_tenant_id(value))
+        if tenant is None:
+            logger.warning("Ignoring message for unknown phone number %s", webhook_tenant_id(value))
+            return None
+            
+        message_data = value['messages'][0]
+        contact_data = value['contacts'][0]
+        
+        # Extract basic info
+        phone = message_data['from']
+        message_id = message_data['id']
+        # Convert timestamp to IST
+        timestamp = datetime.fromtimestamp(int(message_data['timestamp']), tz=pytz.timezone('Asia/Kolkata'))
+        
+        # Handle different message types
+        message_type = message_data.get('type', 'text')
+        message_text = ''
+        button_id = None
+        media = parse_media(message_type, message_data)
+        location = None
+        
+        if message_type == 'text':
+            message_text = message_data.get('text', {}).get('body', '')
+        elif message_type == 'interactive':
+            interactive = message_data.get('interactive', {})
+            if interactive.get('type') == 'button_reply':
+                button_reply = interactive.get('button_reply', {})
+                message_text = f"Button: {button_reply.get('title', '')}"
+                button_id = button_reply.get('id', '')
+        elif media:
+            message_text = describe_media(media)
+        elif message_type == 'location':
+            loc = message_data.get('location', {})
+            location = {
+                'latitude': loc.get('latitude'),
+                'longitude': loc.get('longitude'),
+                'name': loc.get('name'),
+                'address': loc.get('address')
+            }
+            label = loc.get('name') or loc.get('address') or 'Location'
+            message_text = f"📍 {label} ({loc.get('latitude')}, {loc.get('longitude')})"
+        else:
+            message_text = f"Unsupported message type: {message_type}"
+        
+        return {
+            'phone': phone,
+            'message_text': message_text,
+            'message_id': message_id,
+            'timestamp': timestamp,
+            'message_type': message_type,
+            'button_id': button_id,
+            'media': media,
+            'location': location,
+            'contact_name': contact_data.get('profile', {}).get('name', f'User {phone[-4:]}'),
+            'tenant_id': tenant.id
+        }
+    except Exception as e:
+        logger.warning("Error parsing message data: %s", e)
+        return None
+
+def _drop_phone_only_user_key(db):
+    """Conversations used to be unique per phone; they are per (tenantId, phone) now"""
+    index = db.users.index_information().get('phone_1')
+    if index and index.get('unique'):
+        db.users.drop_index('phone_1')
+        logger.info("Dropped the unique users.phone index for the per-tenant conversation key")
+
+def ensure_message_indexes(db):
+    """Unique keys the ingestion path relies on for deduplication"""
+    _drop_phone_only_user_key(db)
+    for collection, keys, options in (
+        (db.users, [('tenantId', ASCENDING), ('phone', ASCENDING)], {}),
+        (db.messages, [('messageId', ASCENDING)], {'partialFilterExpression': {'messageId': {'$type': 'string'}}})
+    ):
+        try:
+            collection.create_index(keys, unique=True, **options)
+        except OperationFailure as e:
+            # Existing duplicates: fall back to a plain index and keep going
+            logger.warning("Could not create unique index on %s %s: %s", collection.name, keys, e)
+            collection.create_index(keys)
+    # Status webhooks look messages up by their WhatsApp id
+    db.messages.create_index([('whatsappMessageId', ASCENDING)], sparse=True)
+    # Per-tenant chat lists and conversation reads; a phone's latest conversation
+    db.users.create_index([('tenantId', ASCENDING), ('lastMessageAt', DESCENDING)])
+    db.users.create_index([('phone', ASCENDING), ('lastMessageAt', DESCENDING)])
+    db.messages.create_index([('tenantId', ASCENDING), ('phone', ASCENDING), ('timestamp', DESCENDING)])
+
+def backfill_tenant_ids(db, tenant_id):
+    """Assign conversations and messages from before multi-tenancy to `tenant_id` once"""
+    if db.migrations.find_one({'_id': 'tenant_ids'}):
+        return
+    users = db.users.update_many({'tenantId': {'$exists': False}}, {'$set': {'tenantId': tenant_id}})
+    messages = db.messages.update_many({'tenantId': {'$exists': False}}, {'$set': {'tenantId': tenant_id}})
+    db[ARCHIVE_COLLECTION].update_many({'tenantId': {'$exists': False}}, {'$set': {'tenantId': tenant_id}})
+    db.migrations.insert_one({'_id': 'tenant_ids', 'appliedAt': datetime.now(pytz.timezone('Asia/Kolkata'))})
+    logger.info("Assigned %d conversations and %d messages to tenant %s",
+                users.modified_count, messages.modified_count, tenant_id)
+
+# How many of a conversation's latest inbound message ids its user document
+# remembers. Redeliveries of those are recognised by the user update itself,
+# so a new message costs two writes: the user update, which assigns its seq,
+# and the message insert. An older redelivery is caught by the unique
+# messageId index instead and its counter bump is undone.
+INBOUND_DEDUP_WINDOW = 50
+
+def inbound_user_filter(phone, tenant_id, message_id):
+    """The conversation, unless it already counted message `message_id`"""
+    return dict(conversation_key(phone, tenant_id), recentInboundIds={'$ne': message_id})
+
+def inbound_user_update(contact_name, referred_by, timestamp, message_id):
+    """Upsert bumping a conversation's counters for one inbound message.
+
+    tenantId and phone come from the inbound_user_filter() filter.
+    """
+    return {
+        '$set': {'lastMessageAt': timestamp},
+        '$inc': {'unreadCount': 1, 'inboundSeq': 1},
+        '$push': {'recentInboundIds': {'$each': [message_id], '$slice': -INBOUND_DEDUP_WINDOW}},
+        '$setOnInsert': {
+            'name': contact_name,
+            'status': 'priority',
+            'referredBy': referred_by,
+            # Cleared by the follow-up that sends the welcome and counts the referral
+            'welcomePending': True,
+            'createdAt': datetime.now(pytz.timezone('Asia/Kolkata'))
+        }
+    }
+
+def recorded_inbound_seq(user, message_id):
+    """The seq the user update gave `message_id`, or None if it's no longer remembered.
+
+    Every update bumps inboundSeq and appends to recentInboundIds together,
+    so the newest id has the current seq and each older one a seq less.
+    """
+    recent = (user or {}).get('recentInboundIds', [])
+    if message_id not in recent:
+        return None
+    return user.get('inboundSeq', 0) - (len(recent) - 1 - recent.index(message_id))
+
+def inbound_message_document(parsed_data, inbound_seq):
+    """messages document for a parsed inbound webhook message, with the seq its user update assigned"""
+    return {
+        'messageId': parsed_data['message_id'],
+        'phone': parsed_data['phone'],
+        'message': parsed_data['message_text'],
+        'direction': 'inbound',
+        'timestamp': parsed_data['timestamp'],
+        'messageType': parsed_data['message_type'],
+        'isRead': False,
+        'status': 'received',  # For incoming messages
+        'buttonId': parsed_data['button_id'],  # Store button ID if present
+        'media': parsed_data.get('media'),
+        'location': parsed_data.get('location'),
+        'seq': inbound_seq,
+        'tenantId': parsed_data.get('tenant_id')
+    }
+
+def uncount_inbound_filter(phone, tenant_id, inbound_seq):
+    """The conversation, if nothing was counted after the message with `inbound_seq`"""
+    return dict(conversation_key(phone, tenant_id), inboundSeq=inbound_seq)
+
+UNCOUNT_INBOUND_UPDATE = {'$inc': {'inboundSeq': -1, 'unreadCount': -1}}
+
+def claim_welcome_filter(phone, tenant_id=None):
+    return dict(conversation_key(phone, tenant_id), welcomePending=True)
+
+def claim_welcome_update():
+    return {'$unset': {'welcomePending': ''}}
@@ -276,6 +276,11 @@ function App() {
         }
       }
       
+      // The open chat is being read as messages arrive
+      if (messageData.direction === 'inbound' && currentChat && messageData.phone === currentChat.phone) {
+        markChatRead(messageData.phone);
+      }
+      
       if (currentChat && messageData.phone === currentChat.phone) {
         // Add the new message directly and sort
         const newMessage = {
@@ -284,7 +289,10 @@ function App() {
           direction: messageData.direction,
           timestamp: messageData.timestamp,
           status: messageData.status || 'sent',
-          whatsappMessageId: messageData.whatsappMessageId
+          whatsappMessageId: messageData.whatsappMessageId,
+          messageType: messageData.messageType,
+          media: messageData.media,
+          location: messageData.location
         };
         
         setMessages(prevMessages => {
@@ -423,11 +431,19 @@ function App() {
         if (!prevMessages || prevMessages.length === 0) return prevMessages;
         
         const updated = prevMessages.map(msg => {
-          // Match by MongoDB ID or WhatsApp message ID
+          // Match by MongoDB ID, WhatsApp message ID or (before the send
+          // request has returned) the optimistic message's tempId
           if (msg.id === statusData.messageId || 
-              msg.whatsappMessageId === statusData.whatsappMessageId) {
+              (statusData.whatsappMessageId && msg.whatsappMessageId === statusData.whatsappMessageId) ||
+              (statusData.tempId && msg.tempId === statusData.tempId)) {
             console.log(`Updating message ${msg.id} status from ${msg.status} to ${statusData.status}`);
-            return { ...msg, status: statusData.status };
+            return {
+              ...msg,
+              id: statusData.messageId || msg.id,
+              status: statusData.status,
+              whatsappMessageId: statusData.whatsappMessageId || msg.whatsappMessageId,
+              tempId: undefined
+            };
           }
           return msg;
         });
@@ -437,6 +453,36 @@ function App() {
       });
     });
 
+    // Media finished downloading (or failed); swap in the stored URLs
+    socket.on('media_ready', (data) => {
+      console.log('Media ready:', data);
+      setMessages(prevMessages => prevMessages.map(msg =>
+        msg.id === data.messageId ? { ...msg, media: data.media } : msg
+      ));
+      if (messagesCache.current[data.phone]) {
+        delete cacheTimestamps.current[data.phone];
+      }
+    });
+
+    // Listen for read watermarks; read state is per agent, so only our own reads
+    // (e.g. from another tab) change our badges
+    socket.on('messages_read', (data) => {
+      console.log('Messages read:', data);
+      if (data.readBy && data.readBy !== user?.id) {
+        return;
+      }
+      const unreadCount = data.agentUnreadCount ?? data.unreadCount;
+      setUnreadCounts(prev => {
+        const updated = { ...prev };
+        if (unreadCount > 0) {
+          updated[data.phone] = unreadCount;
+        } else {
+          delete updated[data.phone];
+        }
+        return updated;
+      });
+    });
+
     // Listen for invite sent events
     socket.on('invite_sent', (data) => {
       console.log('Invite sent:', data);
@@ -452,6 +498,8 @@ function App() {
       socket.off('status_updated');
       socket.off('payment_status_updated');
       socket.off('message_status_update');
+      socket.off('media_ready');
+      socket.off('messages_read');
       socket.off('invite_sent');
     };
   }, [socket, isSignedIn]); // Re-setup when socket or auth changes
@@ -459,7 +507,8 @@ function App() {
   const fetchChats = async () => {
     console.log('Fetching chats...');
     try {
-      const response = await fetch(`${config.API_URL}/api/chats`);
+      const agentQuery = user?.id ? `?agentId=${encodeURIComponent(user.id)}` : '';
+      const response = await fetch(`${config.API_URL}/api/chats${agentQuery}`);
       
       if (!response.ok) {
         console.error('Failed to fetch chats:', response.status, response.statusText);
@@ -472,6 +521,15 @@ function App() {
       const data = await response.json();
       console.log('Fetched chats:', data);
       setChats(data);
+      
+      // Seed unread badges from this agent's read watermarks
+      const counts = {};
+      data.forEach(chat => {
+        if (chat.unreadCount > 0) {
+          counts[chat.phone] = chat.unreadCount;
+        }
+      });
+      setUnreadCounts(counts);
       setLoading(false);
     } catch (error) {
       console.error('Error fetching chats:', error);
@@ -574,6 +632,20 @@ function App() {
     }
   };
 
+  const markChatRead = async (phone) => {
+    try {
+      await fetch(`${config.API_URL}/api/messages/${phone}/read`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ agentId: user?.id })
+      });
+    } catch (error) {
+      console.error('Error marking messages as read:', error);
+    }
+  };
+
   const handleChatSelect = (chat) => {
     // Immediately switch chat (optimistic update)
     setSelectedChat(chat);
@@ -591,6 +663,7 @@ function App() {
       delete updated[chat.phone];
       return updated;
     });
+    markChatRead(chat.phone);
     
     // Show cached messages immediately if available
     if (messagesCache.current[chat.phone]) {
@@ -697,16 +770,17 @@ function App() {
       if (response.ok) {
         const data = await response.json();
         
-        // Update the optimistic message with the real ID and sent status
+        // The message is queued; its real ID comes back now and the send
+        // outcome arrives as a message_status_update
         setMessages(prevMessages => 
           prevMessages.map(msg => 
             msg.tempId === tempId 
               ? { 
                   ...msg, 
                   id: data.messageId || msg.id, 
-                  status: 'sent', 
+                  status: data.status || 'sent', 
                   whatsappMessageId: data.whatsappMessageId,
-                  tempId: undefined  // Clear tempId after successful send
+                  tempId: undefined  // Clear tempId once the server has it
                 }
               : msg
           )
@@ -380,6 +380,39 @@ const ChatWindow = ({ chat, messages, onSendMessage, onStatusUpdate, onScheduleC
               data-status={message.status}
             >
               <div className="message-content">
+                {message.media && message.media.status === 'stored' && (
+                  ['image', 'sticker'].includes(message.media.type) ? (
+                    <a href={`${config.API_URL}${message.media.url}`} target="_blank" rel="noopener noreferrer">
+                      <img
+                        src={`${config.API_URL}${message.media.thumbnailUrl || message.media.url}`}
+                        alt={message.media.caption || message.media.type}
+                        loading="lazy"
+                        style={{ maxWidth: '240px', borderRadius: '6px', display: 'block', marginBottom: '4px' }}
+                      />
+                    </a>
+                  ) : message.media.type === 'audio' ? (
+                    <audio controls preload="none" src={`${config.API_URL}${message.media.url}`} />
+                  ) : message.media.type === 'video' ? (
+                    <video controls preload="none" style={{ maxWidth: '240px' }} src={`${config.API_URL}${message.media.url}`} />
+                  ) : (
+                    <a href={`${config.API_URL}${message.media.url}`} target="_blank" rel="noopener noreferrer">
+                      {message.media.filename || `Open ${message.media.type}`}
+                    </a>
+                  )
+                )}
+                {message.media && message.media.status === 'pending' && (
+                  <div style={{ fontStyle: 'italic', color: '#666' }}>Downloading {message.media.type}…</div>
+                )}
+                {message.location && (
+                  <a
+                    href={`https://maps.google.com/?q=${message.location.latitude},${message.location.longitude}`}
+                    target="_blank"
+                    rel="noopener noreferrer"
+                    style={{ display: 'block' }}
+                  >
+                    View on map
+                  </a>
+                )}
                 {message.text || message.message}
                 {message.buttons && message.buttons.length > 0 && (
                   <div className="message-buttons" style={{